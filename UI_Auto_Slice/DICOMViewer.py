@@ -1,13 +1,13 @@
 import os
-from typing import Tuple
-import pydicom
 import numpy as np
 import tkinter as tk
 import matplotlib.pyplot as plt
-import pickle
+import queue
+import threading
 
-from analysis_script import calculate_metrics
-from find_reccomended_image import find_recc_file
+from find_reccomended_image import find_recc_file, coarse_to_fine_metrics, volumetric_metrics
+from metrics import RECOMMENDER_METRICS, metric_series
+from recommendation import IncrementalRecommender, recommend
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from tkinter import Toplevel, Frame, Label, ttk, Button, messagebox
@@ -18,31 +18,84 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 # Set to true only if you are using linux
 LINUX_MODE = True
 
+# Number of worker processes the ingest pipeline reads, detects and measures the slices in
+INGEST_WORKERS = os.cpu_count() or 1
+
+# Only process a strided subset of the slices plus the window the recommendation depends on
+COARSE_TO_FINE = False
+
+# Restrict full leg scans to the slices around the knee before any detection runs, knee only scans are searched whole
+PRUNE_Z_RANGE = True
+
+# Seed each slice's detection with the previous slice's boxes, the detection then runs in a single worker
+TRACK_BOXES = False
+
+# Read the whole range first and detect it in one pass over the volume, the viewer then only opens once every
+# slice is measured. Finds the same boxes as the per slice detection but is slower on a single core, so it is off
+VOLUMETRIC_DETECTION = False
+
+# Furthest the viewer offers to move from a chosen slice without two knee boxes, the slice sets the resection depth
+MAX_JUMP_SLICES = 3
+
+# How often the Tk loop polls the background loader for progress, in milliseconds
+LOADER_POLL_MS = 50
+
 
 from functions import ls_circle, \
-    detect_knee_bounding_boxes, \
-    process_image
+    detect_knee_bounding_boxes_hu
+
+from series_index import index_folder
+from knee_range import find_knee_range
+from volume import Volume
+from detection_index import DetectionIndex
+from pipeline import process_slices, read_slices, stage_pool
+from slice_provider import SliceProvider
+from study_cache import CacheVersionError, cache_path, read_cache, write_cache
+
+
+# Raised on the loader thread when the user cancels loading
+class LoadCancelled(Exception):
+    pass
 
 
 """ DICOM LOADER
     root - A TKinter root object, i.e. our root GUI Object
-    dicom_folder - A the folder path for the dicom_folder"""
+    dicom_folder - A the folder path for the dicom_folder
+    workers - Number of processes used to ingest the slices, defaults to INGEST_WORKERS
+    use_memmap - Back the volume with a temporary file next to the dicom folder instead of memory
+    coarse_to_fine - Skip the slices the recommendation does not need, defaults to COARSE_TO_FINE
+    prune_z_range - Only process the slices around the knee of full leg scans, defaults to PRUNE_Z_RANGE
+    track_boxes - Search each slice around the previous slice's knee boxes, defaults to TRACK_BOXES
+    volumetric - Detect the knee in the whole volume at once, defaults to VOLUMETRIC_DETECTION"""
 
 class DICOMLoader:
-    def __init__(self, root: tk.Tk, folder_path: str) -> None:
+    def __init__(self, root: tk.Tk, folder_path: str, workers: int | None = None, use_memmap: bool = False,
+                 coarse_to_fine: bool | None = None, prune_z_range: bool | None = None,
+                 track_boxes: bool | None = None, volumetric: bool | None = None) -> None:
         self.folder_path = folder_path
-        self.cache_file = f"{folder_path}_cache.pkl"
+        self.workers = workers if workers is not None else INGEST_WORKERS
+        self.coarse_to_fine = coarse_to_fine if coarse_to_fine is not None else COARSE_TO_FINE
+        self.prune_z_range = prune_z_range if prune_z_range is not None else PRUNE_Z_RANGE
+        self.track_boxes = track_boxes if track_boxes is not None else TRACK_BOXES
+        self.volumetric = volumetric if volumetric is not None else VOLUMETRIC_DETECTION
+        self.cache_file = cache_path(folder_path)
+        self.memmap_dir = os.path.dirname(os.path.abspath(folder_path)) if use_memmap else None
 
         self.root = root
         self.root.title("Loading DICOM Files...")
-        self.root.geometry('500x100')
-        self.root.protocol("WM_DELETE_WINDOW", self.close_window)
+        self.root.geometry('500x160')
+        self.root.protocol("WM_DELETE_WINDOW", self.cancel_loading)
 
         self.dicom_folder = folder_path
-        self.dicom_filename_array = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.dcm')]
-        self.dicom_filename_array.sort()
+        self.dicom_filename_array = []
 
         self.recc_file_no = 0
+        self.recc_confidence = None
+        self.candidates = []
+        self.detections = None
+        self.metrics = None
+        self.first_slice = 0
+        self.viewer_shown = False
 
         self.progress_frame = Frame(root)
         self.progress_frame.pack(pady=10)
@@ -56,24 +109,122 @@ class DICOMLoader:
         self.label_message = Label(self.progress_frame, text="Processing...", font=('Helvetica', 12))
         self.label_message.pack()
 
-        self.recc_file_no = 0
+        self.label_range = Label(self.progress_frame, text="", font=('Helvetica', 10))
+        self.label_range.pack()
 
-        """ CACHING SECTION
-            Store results calculated already in file in the dicom_folder provided """
+        self.button_cancel = Button(self.progress_frame, text="Cancel", command=self.cancel_loading)
+        self.button_cancel.pack(pady=(5, 0))
 
-        if os.path.exists(self.cache_file):
-            self.label_title.config(text="Loading from Cache...")
+        """ BACKGROUND LOADING SECTION
+            The worker thread never touches Tk, it only posts messages to the queue which the Tk loop polls """
 
-            try:
-                self.multichannel_image_array, self.dicom_filename_array, self.dicom_data, self.recc_file_no = self.load_from_cache()
+        self.message_queue = queue.Queue()
+        self.cancel_event = threading.Event()
 
-            except:
-                self.multichannel_image_array, self.bounding_boxes, self.dicom_data = self.process_dicom_files()
+        self.load_thread = threading.Thread(target=self.load_worker, daemon=True)
+        self.load_thread.start()
+
+        self.root.after(LOADER_POLL_MS, self.poll_queue)
+
+
+    """ RUNS ON THE WORKER THREAD
+        Loads from cache if one exists, otherwise processes every file and finds the recommended slice """
+    def load_worker(self):
+        try:
+            if os.path.exists(self.cache_file):
+                self.message_queue.put(('status', "Loading from Cache..."))
+
+                try:
+                    self.message_queue.put(('loaded', read_cache(self.cache_file), False))
+                    return
+
+                except CacheVersionError:
+                    # Written by another version, processed again and replaced if the user caches the result
+                    self.message_queue.put(('status', "Cache is out of date, processing the DICOM files..."))
+
+            result = self.process_dicom_files()
+
+            if result is None:
+                self.message_queue.put(('cancelled',))
+            else:
+                self.message_queue.put(('loaded', result, True))
+
+        except Exception as e:
+            self.message_queue.put(('error', str(e)))
 
-        else:
-            self.multichannel_image_array, self.bounding_boxes, self.dicom_data = self.process_dicom_files()
 
-        self.root.after(100, self.close_window)  # Close window after 100ms (adjust as needed)
+    """ RUNS ON THE TK THREAD
+        Drains the worker messages and reschedules itself until loading is finished """
+    def poll_queue(self):
+        try:
+            while True:
+                message = self.message_queue.get_nowait()
+                kind = message[0]
+
+                if kind == 'progress':
+                    _, completed, total = message
+                    self.progress_bar['value'] = completed / total * 100
+                    self.label_message.config(text=f"Processing {completed}/{total}...")
+
+                elif kind == 'status':
+                    self.label_title.config(text=message[1])
+
+                elif kind == 'range':
+                    self.label_range.config(text=message[1])
+
+                elif kind == 'warning':
+                    messagebox.showwarning("Missing Slices", message[1])
+
+                elif kind == 'recommended' and not self.cancel_event.is_set():
+                    # Open the viewer early, the rest of the study keeps loading in the background
+                    _, self.volume, self.recc_file_no, self.recc_confidence, self.candidates = message
+                    self.close_window()
+
+                elif kind == 'loaded' and self.cancel_event.is_set():
+                    self.exit_application()
+                    return
+
+                elif kind == 'loaded':
+                    _, result, ask_to_cache = message
+                    self.on_loaded(result, ask_to_cache)
+                    return
+
+                elif kind == 'cancelled':
+                    self.exit_application()
+                    return
+
+                elif kind == 'error':
+                    messagebox.showerror("Error", f"Could not load the DICOM files: {message[1]}")
+                    self.exit_application()
+                    return
+
+        except queue.Empty:
+            pass
+
+        self.root.after(LOADER_POLL_MS, self.poll_queue)
+
+
+    def on_loaded(self, result, ask_to_cache):
+        self.volume, self.recc_file_no, self.detections, self.metrics, self.first_slice = result
+        self.label_message.config(text="Processing completed. Please close this window if it hasn't automatically.")
+
+        # The viewer opens as soon as the recommended slice is known, the cache is written afterwards
+        if not self.viewer_shown:
+            # Ranked from the cached metrics in a few milliseconds
+            self.candidates = recommend(self.metrics, first_slice=self.first_slice)
+            if self.candidates:
+                self.recc_confidence = self.candidates[0][1]
+
+            self.close_window()
+
+        if ask_to_cache:
+            self.ask_to_cache_data(self.volume, self.recc_file_no, self.detections, self.metrics, self.first_slice)
+
+
+    def cancel_loading(self):
+        self.cancel_event.set()
+        self.button_cancel.config(state='disabled')
+        self.label_message.config(text="Cancelling...")
 
 
     """ Hide the current window for DICOMViewer to show """
@@ -83,11 +234,14 @@ class DICOMLoader:
 
 
     def show_viewer(self):
+        self.viewer_shown = True
+
         viewer_root = Toplevel()
         viewer_root.title("DICOM Viewer")
         viewer_root.protocol("WM_DELETE_WINDOW", self.exit_application)  # Handle close event
 
-        viewer = DICOMViewer(viewer_root, self.multichannel_image_array, self.dicom_filename_array, self.dicom_data, self.recc_file_no)
+        viewer = DICOMViewer(viewer_root, self.volume, self.recc_file_no, self.recc_confidence, self.detections,
+                             self.candidates)
         _ = viewer
 
 
@@ -95,79 +249,141 @@ class DICOMLoader:
         self.root.destroy()  # Destroy the main window to exit the application
 
 
-    """ LOAD ONE DICOM FILE """
-    def load_dicom(self, file_path: str) -> Tuple:
-        dicom_data = pydicom.dcmread(file_path)
-        bounding_boxes, _, edge_points = detect_knee_bounding_boxes(dicom_data)
-        multichannel_image = process_image(dicom_data)
+    """ PROCESS ALL DICOM FILES IN DIR, REPORTING PROGRESS TO THE QUEUE
+        Returns None if loading was cancelled """
+    def process_dicom_files(self):
+        # Started once per load, the coarse to fine scan runs the pipeline several times and a pool takes seconds to start
+        self.pool = stage_pool(self.workers) if self.workers > 1 and not (self.track_boxes or self.volumetric) else None
 
-        file_metrics = None
+        try:
+            # Header only pre-pass, orders the slices of the largest series along the scan axis
+            self.message_queue.put(('status', "Indexing DICOM Files..."))
+            self.series_index = index_folder(self.folder_path, check=self.check_cancelled)
+            self.dicom_filename_array = self.series_index.file_paths
 
-        if len(bounding_boxes) == 2:
-            metrics = calculate_metrics(dicom_data.pixel_array, bounding_boxes)
+            # Missing slices shift every slice index after them, the user should know before trusting the recommendation
+            if self.series_index.gaps:
+                self.message_queue.put(('warning', self.missing_slices_text()))
 
-            file_metrics = {
-                'file_name': os.path.basename(file_path),
-                'metrics': metrics
-            }
+            volume = Volume.from_series_index(self.series_index, self.memmap_dir)
+            self.detections = DetectionIndex(len(volume))
 
-        return os.path.basename(file_path), bounding_boxes, multichannel_image, edge_points, file_metrics, dicom_data
+            # Cheap header and intensity profile pass, bounds the slices that go through detection
+            slice_range = range(len(volume))
 
+            if self.prune_z_range:
+                self.message_queue.put(('status', "Locating Knee..."))
+                slice_range = find_knee_range(self.series_index, check=self.check_cancelled)
 
-    """ PROCESS ALL DICOM FILES IN DIR AND SHOWS PROGRESS BAR """
-    def process_dicom_files(self):
-        multichannel_image_array = []
-        bounding_boxes = []
-        file_names = []
-        metrics = []
-        dicom_data = []
+            self.slices_loaded = 0
+            self.slices_to_load = len(slice_range)
 
-        for i, file_path in enumerate(self.dicom_filename_array):
-            result = self.load_dicom(file_path)
+            # Slices only arrive in order without the coarse pass, so the recommendation can be made on the fly
+            self.recommender = (None if self.coarse_to_fine or self.volumetric
+                                else IncrementalRecommender(first_slice=slice_range.start))
+            self.message_queue.put(('range', f"Searching slices {slice_range.start + 1}-{slice_range.stop} of {len(volume)}"))
+            self.message_queue.put(('status', "Loading DICOM Files..."))
 
-            file_name, bounding_boxes, multichannel_image, _, file_metrics, dicom_data_file = result
-            multichannel_image_array.append(multichannel_image)
-            bounding_boxes.append(bounding_boxes)
-            file_names.append(file_name)
-            dicom_data.append(dicom_data_file)
+            # Slices that are skipped stay unloaded in the volume, the viewer decodes them when shown
+            if self.volumetric:
+                metrics = self.load_volumetric(volume, slice_range)
 
-            if file_metrics:
-                metrics.append(file_metrics)
+            elif self.coarse_to_fine:
+                metrics = metric_series(coarse_to_fine_metrics(slice_range, lambda indices: self.load_slices(volume, indices)),
+                                        RECOMMENDER_METRICS)
 
-            self.progress_bar['value'] = (i + 1) / len(self.dicom_filename_array) * 100
-            self.root.update_idletasks()
+            else:
+                results = self.load_slices(volume, slice_range)
+                metrics = metric_series([results[i] for i in sorted(results) if results[i]], RECOMMENDER_METRICS)
 
-        self.label_message.config(text="Processing completed. Please close this window if it hasn't automatically.")
+        except LoadCancelled:
+            return None
+
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+
+        # Gaps are counted from the start of the searched range, not from the start of the scan
+        recc_file_no = find_recc_file(self.folder_path, metrics, slice_range.start)
+
+        return volume, recc_file_no, self.detections, metrics, slice_range.start
+
+
+    def missing_slices_text(self):
+        gaps = ", ".join(f"{i}-{i + 1}" for i in self.series_index.gaps)
+        return (f"The slices are {self.series_index.spacing:.2f} mm apart, but the spacing is larger between "
+                f"Images {gaps}. Slices may be missing from the series.")
+
+
+    """ LOAD SLICES INTO THE VOLUME
+        Returns the metrics result of each slice keyed by its index, raises LoadCancelled on cancel """
+    def load_slices(self, volume, indices):
+        results = {}
+        # Only the metrics the recommendation reads, the full set is for the analysis scripts
+        items = process_slices(self.series_index, indices, self.workers, self.track_boxes, RECOMMENDER_METRICS,
+                               self.pool)
+
+        for item in items:
+            i = item['slice_index']
+            self.detections.set(i, item['bounding_boxes'], item['edge_points'])
+            results[i] = item['metrics']
+            volume.set_slice(i, item['slice_data'].hu, item['slice_data'].header)
+
+            if self.recommender is not None and results[i] and self.recommender.recommendation is None:
+                if self.recommender.add(results[i]) is not None:
+                    self.message_queue.put(('recommended', volume, self.recommender.recommendation,
+                                            self.recommender.confidence, self.recommender.candidates))
+
+            self.slices_loaded += 1
+            self.message_queue.put(('progress', self.slices_loaded, self.slices_to_load))
+
+            if self.cancel_event.is_set():
+                items.close()
+                raise LoadCancelled()
+
+        return results
+
+
+    """ LOAD SLICES AND DETECT THE KNEE IN 3D
+        Reads every slice of the range into the volume, then detects them in one pass, raises LoadCancelled on cancel """
+    def load_volumetric(self, volume, slice_range):
+        items = read_slices(self.series_index, slice_range)
+
+        for item in items:
+            volume.set_slice(item['slice_index'], item['slice_data'].hu, item['slice_data'].header)
+
+            self.slices_loaded += 1
+            self.message_queue.put(('progress', self.slices_loaded, self.slices_to_load))
 
-        self.recc_file_no = find_recc_file(self.folder_path, metrics)
+            if self.cancel_event.is_set():
+                items.close()
+                raise LoadCancelled()
 
-        self.dicom_data = dicom_data
+        self.message_queue.put(('status', "Detecting Knee..."))
+        return volumetric_metrics(volume, slice_range, RECOMMENDER_METRICS, self.detections, self.check_cancelled)
 
-        # Ask user if they want to cache the processed data
-        self.ask_to_cache_data(multichannel_image_array, self.dicom_filename_array, self.dicom_data, self.recc_file_no)
 
-        return multichannel_image_array, bounding_boxes, dicom_data
+    """ Raises LoadCancelled once cancel was pressed, checked between files by the indexing and knee range passes """
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise LoadCancelled()
 
 
     """ CACHE FUNCTIONS FOR STORING CACLULATED DATA """
-    def ask_to_cache_data(self, multichannel_image_array, dicom_filename_array, dicom_data, recc_file_no):
+    def ask_to_cache_data(self, volume, recc_file_no, detections, metrics, first_slice):
         if messagebox.askyesno("Cache Data", "Do you want to cache the processed data?\n This will make next run much quicker. \
             Please Delete the Cache file loacted in the dicom folder provided manually should you want to remove the cache."):
-            self.save_to_cache(multichannel_image_array, dicom_filename_array, dicom_data, recc_file_no)
+            # Not a daemon so the application waits for the pickle to be fully written before exiting
+            threading.Thread(target=self.save_to_cache, args=(volume, recc_file_no, detections, metrics, first_slice)).start()
 
 
-    def save_to_cache(self, multichannel_image_array, dicom_filename_array, dicom_data, recc_file_no):
-        with open(self.cache_file, 'wb') as f:
-            pickle.dump((multichannel_image_array, dicom_filename_array, dicom_data, recc_file_no), f)
-
-
-    def load_from_cache(self):
-        with open(self.cache_file, 'rb') as f:
-            return pickle.load(f)
+    def save_to_cache(self, volume, recc_file_no, detections, metrics, first_slice):
+        write_cache(self.cache_file, volume, recc_file_no, detections, metrics, first_slice)
 
 
 class DICOMViewer:
-    def __init__(self, root, multichannel_image_array, dicom_filename_array, dicom_data_array, recc_index: int | None = 0):
+    def __init__(self, root, volume: Volume, recc_index: int | None = 0, recc_confidence: float | None = None,
+                 detections: DetectionIndex | None = None, candidates=None):
         recc_def_text = ""
         if recc_index is None or recc_index < 0:
             recc_index = 0
@@ -175,16 +391,25 @@ class DICOMViewer:
 
 
         self.root = root
-        self.multichannel_image_array = multichannel_image_array
-        self.dicom_filename_array = dicom_filename_array
-        self.dicom_data_array = dicom_data_array
+        self.volume = volume
         self.recc_index = recc_index
+        self.recc_confidence = recc_confidence
         self.index = recc_index
 
+        # Ranked (slice index, confidence) pairs, the recommendation first
+        self.candidates = list(candidates) if candidates else []
+
+        # Boxes and contours the loader already found, slices it skipped are detected here on first use
+        self.detections = detections if detections is not None else DetectionIndex(len(volume))
+
+        # Frames are windowed on demand, only the slices around the one on screen are kept
+        self.slices = SliceProvider(volume)
+        self.slices.pin(index for index, _ in self.candidates)
+        self.scroll_direction = 0
+
         self.fig, self.ax = plt.subplots()
-        self.im = self.ax.imshow(self.multichannel_image_array[self.index], cmap='gray')
-        self.dicom_data = self.multichannel_image_array[self.index]
-        self.ax.set_title(f'Image {self.index + 1}/{len(self.dicom_filename_array)}')
+        self.im = self.ax.imshow(self.slices.get(self.index), cmap='gray', vmin=0, vmax=255)
+        self.ax.set_title(f'Image {self.index + 1}/{len(self.volume)}')
 
         self.canvas_frame = Frame(self.root, width=600, height=600)
         self.canvas_frame.pack(side='left', fill='both', expand=True)
@@ -210,6 +435,12 @@ class DICOMViewer:
         self.button_next = Button(self.sub_frame, text="Next", command=self.switch_to_bounding_box_selection)
         self.button_next.pack(pady=10, padx=20, fill='x')
 
+        # Candidates after the recommendation, one button each to jump to them
+        for rank, (index, confidence) in enumerate(self.candidates[1:], start=2):
+            button = Button(self.sub_frame, text=f"Candidate {rank}: Image {index + 1} ({confidence:.0%})",
+                            command=lambda index=index: self.jump_to(index))
+            button.pack(pady=2, padx=20, fill='x')
+
         self.root.bind('<KeyPress-Up>', self.on_key_press)
         self.root.bind('<KeyPress-Down>', self.on_key_press)
         self.root.bind('<KeyRelease-Up>', self.on_key_release)
@@ -231,13 +462,31 @@ class DICOMViewer:
 
     """ UPDATES IMAGE ON KEY PRESS """
     def update_image(self):
-        self.im.set_data(self.multichannel_image_array[self.index])
-        self.dicom_data = self.dicom_data_array[self.index]
-        self.ax.set_title(f'Image {self.index + 1}/{len(self.dicom_filename_array)}')
-        self.recommended_label.config(text="Recommended File" if self.index == self.recc_index else "")
+        self.im.set_data(self.slices.get(self.index, self.scroll_direction))
+        self.ax.set_title(f'Image {self.index + 1}/{len(self.volume)}')
+        self.recommended_label.config(text=self.recommended_text())
         self.canvas.draw_idle()
 
 
+    def recommended_text(self):
+        if self.index == self.recc_index:
+            if self.recc_confidence is None:
+                return "Recommended File"
+            return f"Recommended File (confidence {self.recc_confidence:.0%})"
+
+        for rank, (index, confidence) in enumerate(self.candidates, start=1):
+            if index == self.index:
+                return f"Candidate {rank} (confidence {confidence:.0%})"
+
+        return ""
+
+
+    def jump_to(self, index):
+        self.index = index
+        self.scroll_direction = 0
+        self.update_image()
+
+
     """ KEY PRESS HANDLERS """
     def on_key_press(self, event):
         if event.keysym == 'Up':
@@ -253,12 +502,14 @@ class DICOMViewer:
     def prev_image(self):
         if self.index > 0:
             self.index -= 1
+            self.scroll_direction = -1
             self.update_image()
 
 
     def next_image(self):
-        if self.index < len(self.dicom_filename_array) - 1:
+        if self.index < len(self.volume) - 1:
             self.index += 1
+            self.scroll_direction = 1
             self.update_image()
 
 
@@ -279,23 +530,51 @@ class DICOMViewer:
 
 
     def exit_application(self):
+        self.slices.close()
         self.root.destroy()  # Destroy the viewer window to exit the application
         # self.root.withdraw()  # Hide the loading window
 
 
+    def detect_slice(self, index):
+        if not self.detections.detected[index]:
+            if not self.volume.is_loaded(index):
+                self.volume.load_slice(index)
+
+            bounding_boxes, _, edge_points = detect_knee_bounding_boxes_hu(self.volume.hu_image(index))
+            self.detections.set(index, bounding_boxes, edge_points)
+
+        return self.detections.get(index)
+
+
     def switch_to_bounding_box_selection(self):
-        self.bounding_boxes, _, self.edge_points = detect_knee_bounding_boxes(self.dicom_data)
+        self.detect_slice(self.index)
+
+        if not self.detections.is_valid(self.index):
+            nearest = self.detections.nearest_valid(self.index, MAX_JUMP_SLICES)
+
+            if nearest is None:
+                self.bounding_boxes = None
+                messagebox.showerror("Error", "These slice is of poor quality we did not find two bounding boxes. \
+                    Please select another")
+                return
+
+            # The chosen slice is the resection depth, a close one with both knees is only used once the user agrees
+            if not messagebox.askyesno("Use Nearby Slice", f"Image {self.index + 1} does not have two knee boxes. "
+                                       f"Continue on Image {nearest + 1}, {abs(nearest - self.index)} slice(s) away?"):
+                self.bounding_boxes = None
+                return
+
+            self.label.config(text=f"Image {self.index + 1} has no two knee boxes, moved to Image {nearest + 1}")
+            self.scroll_direction = 1 if nearest > self.index else -1
+            self.index = nearest
+            self.update_image()
 
-        if len(self.bounding_boxes) != 2:
-            self.bounding_boxes = None
-            messagebox.showerror("Error", "These slice is of poor quality we did not find two bounding boxes. \
-                Please select another")
-            return
+        self.bounding_boxes, self.edge_points = self.detections.get(self.index)
 
         for widget in self.sub_frame.winfo_children():
             widget.destroy()
 
-        self.multichannel_image = process_image(self.dicom_data)  # Preprocess the image?
+        self.display_image = self.slices.get(self.index)
 
         self.root.unbind('<KeyPress-Up>')
         self.root.unbind('<KeyPress-Down>')
@@ -924,7 +1203,7 @@ class DICOMViewer:
             x, y, w, h = self.bounding_boxes[selected_box_index]
 
             # We are getting min max values of our entire image
-            height, width, _ = self.multichannel_image.shape
+            height, width = self.display_image.shape
 
             # Define padding for our bounding box
             x_padding = w // 2
@@ -936,24 +1215,18 @@ class DICOMViewer:
             x_max = min(width, x + w + x_padding)
             y_max = min(height, y + h + x_padding)
 
-            cropped_image = self.multichannel_image[y_min:y_max, x_min:x_max]
+            cropped_image = self.display_image[y_min:y_max, x_min:x_max]
 
             # Use the Axes object to show the image
-            self.ax.imshow(cropped_image)
+            self.ax.imshow(cropped_image, cmap='gray', vmin=0, vmax=255)
             self.ax.axis('off')  # Turn off the axis
 
             for point in self.test_d:
                 point.remove()
                 self.test_d = []
 
-            self.filtered_points = []
-            # print(filtered_points, "\n", self.edge_points)
-            for point in self.edge_points:
-                px, py = point
-
-                # Key is to not check point within padded margins but with margins
-                if x <= px <= x + w and y <= py <= y + h:
-                    self.filtered_points.append((point[0] - x_min, point[1] - y_min))
+            # Key is to not check point within padded margins but with margins, the detection grouped them per box
+            self.filtered_points = self.edge_points.box(selected_box_index) - np.array([x_min, y_min], dtype=np.int32)
 
             # Redraw the canvas where the figure is embedded
             self.canvas.draw_idle()
@@ -0,0 +1,122 @@
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from skimage.segmentation import slic, mark_boundaries
+
+from functions import apply_ct_window
+from metrics import box_metrics, percentile_counts
+from multiframe import read_dataset
+from series_index import index_folder
+from volume import SliceData
+
+
+""" THE SLICE PATH BEFORE THE SERIES INDEX
+    load_dicom and the functions it called as they were, kept here so the benchmark compares against them """
+
+def original_detection(dicom_data):
+    # detect_knee_bounding_boxes, every stage on a float64 rescale including SLIC, which nothing used
+    dicom_image = dicom_data.pixel_array
+
+    if 'RescaleSlope' in dicom_data and 'RescaleIntercept' in dicom_data:
+        hu_image = dicom_image * dicom_data.RescaleSlope + dicom_data.RescaleIntercept
+    else:
+        hu_image = dicom_image
+
+    multichannel_image = np.stack((hu_image,) * 3, axis=-1)
+    segments = slic(multichannel_image, n_segments=100, compactness=10)
+    blurred_image = cv2.GaussianBlur(hu_image, (3, 3), 0)
+    laplacian = cv2.Laplacian(blurred_image, cv2.CV_64F)
+    sharpened_image = np.uint8(np.clip(blurred_image + laplacian, 0, 255))
+    mark_boundaries(sharpened_image, segments, color=(1, 0, 0))
+    _, binary_image = cv2.threshold(blurred_image, 160, 255, cv2.THRESH_BINARY)
+    sobel_x = cv2.Sobel(binary_image, cv2.CV_64F, 1, 0, ksize=3)
+    sobel_y = cv2.Sobel(binary_image, cv2.CV_64F, 0, 1, ksize=3)
+    sobel_edge = np.sqrt(sobel_x ** 2 + sobel_y ** 2)
+    sobel_edge_resized = cv2.resize(sobel_edge.astype(np.uint8), (dicom_image.shape[1], dicom_image.shape[0]))
+    contours, _ = cv2.findContours(sobel_edge_resized, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    edge_points = []
+    bounding_boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w > 70 and h > 70:
+            bounding_boxes.append((x, y, w, h))
+        for point in contour:
+            edge_points.append(tuple(point[0]))
+
+    bounding_boxes.sort(key=lambda x: x[0])
+    return bounding_boxes, multichannel_image, edge_points
+
+
+def original_display_image(dicom_data):
+    # process_image, a second float64 rescale windowed into a three channel uint8 frame
+    img = dicom_data.pixel_array.astype(float)
+    if 'RescaleSlope' in dicom_data and 'RescaleIntercept' in dicom_data:
+        img = img * dicom_data.RescaleSlope + dicom_data.RescaleIntercept
+
+    img = apply_ct_window(img, [400, 50])
+    img = (img - np.min(img)) / (np.max(img) - np.min(img)) * 255
+    return np.stack((img,) * 3, axis=-1).astype('uint8')
+
+
+def original_load(dicom_data):
+    # load_dicom, the metrics were percentiles of the raw pixel_array
+    bounding_boxes, _, _ = original_detection(dicom_data)
+    original_display_image(dicom_data)
+    if len(bounding_boxes) == 2:
+        for x, y, w, h in bounding_boxes:
+            box_metrics(w * h, w * h, *percentile_counts(dicom_data.pixel_array[y:y+h, x:x+w]))
+
+
+def shared_decode(dicom_data):
+    slice_data = SliceData.from_dataset(dicom_data)
+    bounding_boxes, _, _ = slice_data.detect()
+    slice_data.display_image()
+    if len(bounding_boxes) == 2:
+        slice_data.metrics(bounding_boxes)
+
+
+def measure(process, series_index, indices):
+    # Peak bytes allocated while processing one slice, above what was held before it, and the time it took
+    peaks = []
+    elapsed = 0
+
+    for i in indices:
+        dicom_data = read_dataset(series_index.file_paths[i], series_index.frames[i])
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        process(dicom_data)
+        elapsed += time.perf_counter() - start
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return np.mean(peaks), np.max(peaks), elapsed / len(indices)
+
+
+def run_benchmark(folder_path, step=5):
+    """
+    Allocations of decoding, detecting, windowing and measuring one slice, the way load_dicom did it and with
+    SliceData.
+
+    tracemalloc sees numpy's allocations, including the arrays cv2 returns, but not cv2's internal buffers.
+    Both paths pay for the pixel_array decode itself.
+    """
+    series_index = index_folder(folder_path)
+    indices = range(0, len(series_index), step)
+    rows, columns = series_index.shape
+
+    print(f"{len(indices)} slices of {rows}x{columns}, one decoded slice is {rows * columns * 2 / 1e6:.2f} MB")
+
+    for name, process in (('load_dicom', original_load), ('SliceData', shared_decode)):
+        mean_peak, max_peak, mean_time = measure(process, series_index, indices)
+        print(f"{name}: peak {mean_peak / 1e6:.2f} MB per slice on average, {max_peak / 1e6:.2f} MB at most, "
+              f"{mean_time * 1000:.1f} ms per slice")
+
+
+if __name__ == "__main__":
+    folder_path = sys.argv[1] if len(sys.argv) == 2 else "../Data/ChimpIJ"
+    run_benchmark(folder_path)
@@ -3,50 +3,13 @@ folder_paths = ['../Data/ChimpIJ', "../Data/FalconIJ", "../Data/IguanaIJ", "../D
 # folder_paths = ['../Data/GorillaIJ', "../Data/KangarooIJ", "../Data/ArmadilloIJ"]
 
 import os
-import pydicom
-import numpy as np
 import plotly.express as px
 import pandas as pd
 import pickle
 
-from functions import detect_knee_bounding_boxes
-
-def calculate_metrics(image, bounding_boxes):
-    metrics = []
-    for box in bounding_boxes:
-        x, y, w, h = box
-        bbox_image = image[y:y+h, x:x+w]
-        total_pixels = w * h
-
-        # Compute dynamic thresholds using percentiles
-        flattened = bbox_image.flatten()
-        white_threshold = np.percentile(flattened, 99)
-        black_threshold = np.percentile(flattened, 1)
-        almost_white_threshold = np.percentile(flattened, 95)
-        almost_black_threshold = np.percentile(flattened, 5)
-
-        white_pixels = np.sum(bbox_image >= white_threshold)
-        black_pixels = np.sum(bbox_image <= black_threshold)
-        almost_white_pixels = np.sum((bbox_image >= almost_white_threshold) & (bbox_image < white_threshold))
-        almost_black_pixels = np.sum((bbox_image > black_threshold) & (bbox_image <= almost_black_threshold))
-        gray_pixels = np.sum((bbox_image > almost_black_threshold) & (bbox_image < almost_white_threshold))
-
-        area = w * h
-        metrics.append({
-            'total_pixels': total_pixels,
-            'white_pixels': white_pixels,
-            'almost_white_pixels': almost_white_pixels,
-            'gray_pixels': gray_pixels,
-            'almost_black_pixels': almost_black_pixels,
-            'black_pixels': black_pixels,
-            'area': area,
-            'white_proportion': white_pixels / total_pixels,
-            'almost_white_proportion': almost_white_pixels / total_pixels,
-            'gray_proportion': gray_pixels / total_pixels,
-            'almost_black_proportion': almost_black_pixels / total_pixels,
-            'black_proportion': black_pixels / total_pixels
-        })
-    return metrics
+from metrics import metric_series, require_metrics, COUNT_FIELDS, PROPORTION_FIELDS
+from pipeline import process_slices
+from series_index import index_folder
 
 def process_folders(folder_paths):
     all_results = []
@@ -57,35 +20,23 @@ def process_folders(folder_paths):
 
         results = []
 
-        dicom_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.dcm')]
-        dicom_files.sort()
+        series_index = index_folder(folder_path)
         steps = 1
-        dicom_files = dicom_files[::steps]
-
-        index = 0
-
-        for dicom_file in dicom_files:
-            dicom_data = pydicom.dcmread(dicom_file)
-            bounding_boxes, multichannel_image, edge_points = detect_knee_bounding_boxes(dicom_data)
 
-            print(f"{index * steps + 1} ... ", end="")
-            index += 1
+        for item in process_slices(series_index, range(0, len(series_index), steps)):
+            print(f"{item['slice_index'] + 1} ... ", end="")
 
-            if len(bounding_boxes) != 2:
+            if item['metrics'] is None:
                 print("Skipped")
                 continue
 
-            metrics = calculate_metrics(dicom_data.pixel_array, bounding_boxes)
-            results.append({
-                'file_name': os.path.basename(dicom_file),
-                'metrics': metrics
-            })
+            results.append(item['metrics'])
 
             print("Done")
 
         all_results.append({
             'folder_name': folder_name,
-            'results': results
+            'results': metric_series(results)
         })
 
         print("")
@@ -95,40 +46,25 @@ def process_folders(folder_paths):
 def plot_metrics(results):
     for folder_result in results:
         folder_name = folder_result['folder_name']
-        folder_metrics = folder_result['results']
+        folder_metrics = metric_series(folder_result['results'])
+        require_metrics(folder_metrics, COUNT_FIELDS + PROPORTION_FIELDS)
 
         absolute_data = []
         proportion_data = []
 
-        for result in folder_metrics:
-            left_box_metrics = result['metrics'][0]
-            right_box_metrics = result['metrics'][1]
-
-            absolute_data.extend([
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'White Pixels', 'Value': left_box_metrics['white_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Almost White Pixels', 'Value': left_box_metrics['almost_white_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Gray Pixels', 'Value': left_box_metrics['gray_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Almost Black Pixels', 'Value': left_box_metrics['almost_black_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Black Pixels', 'Value': left_box_metrics['black_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'White Pixels', 'Value': right_box_metrics['white_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Almost White Pixels', 'Value': right_box_metrics['almost_white_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Gray Pixels', 'Value': right_box_metrics['gray_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Almost Black Pixels', 'Value': right_box_metrics['almost_black_pixels']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Black Pixels', 'Value': right_box_metrics['black_pixels']}
-            ])
-
-            proportion_data.extend([
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'White Proportion', 'Value': left_box_metrics['white_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Almost White Proportion', 'Value': left_box_metrics['almost_white_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Gray Proportion', 'Value': left_box_metrics['gray_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Almost Black Proportion', 'Value': left_box_metrics['almost_black_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Left', 'Metric': 'Black Proportion', 'Value': left_box_metrics['black_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'White Proportion', 'Value': right_box_metrics['white_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Almost White Proportion', 'Value': right_box_metrics['almost_white_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Gray Proportion', 'Value': right_box_metrics['gray_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Almost Black Proportion', 'Value': right_box_metrics['almost_black_proportion']},
-                {'Folder': folder_name, 'File': result['file_name'], 'Box': 'Right', 'Metric': 'Black Proportion', 'Value': right_box_metrics['black_proportion']}
-            ])
+        # One column per box and metric straight from the structured array, no per slice dicts
+        file_names = folder_metrics['file_name'].tolist()
+        metrics = folder_metrics['metrics']
+
+        for box, box_name in enumerate(['Left', 'Right']):
+            for fields, data in ((COUNT_FIELDS, absolute_data), (PROPORTION_FIELDS, proportion_data)):
+                for field in fields:
+                    metric_name = field.replace('_', ' ').title()
+
+                    data.extend(
+                        {'Folder': folder_name, 'File': file_name, 'Box': box_name, 'Metric': metric_name, 'Value': value}
+                        for file_name, value in zip(file_names, metrics[field][:, box].tolist())
+                    )
 
         # Convert to DataFrames for Plotly
         df_absolute = pd.DataFrame(absolute_data)
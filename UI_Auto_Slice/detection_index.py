@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class DetectionIndex:
+    """
+    Knee detection result of every slice of a volume, filled in by the loader and reused by the viewer.
+
+    bounding_boxes (list): Per slice, the (x, y, w, h) boxes sorted by x, None until the slice is detected.
+    edge_points (list): Per slice, the EdgePoints of the same detection, None until the slice is detected.
+    detected (np.ndarray): Whether each slice has been through the detection.
+    valid (np.ndarray): Whether each detected slice has the two knee boxes the viewer and the metrics need.
+    """
+
+    def __init__(self, n_slices):
+        self.bounding_boxes = [None] * n_slices
+        self.edge_points = [None] * n_slices
+        self.detected = np.zeros(n_slices, dtype=bool)
+        self.valid = np.zeros(n_slices, dtype=bool)
+
+    def __len__(self):
+        return len(self.bounding_boxes)
+
+    def set(self, index, bounding_boxes, edge_points):
+        # The flags go last, the viewer may read a slice while the loader thread is still filling the index
+        self.bounding_boxes[index] = [tuple(int(v) for v in box) for box in bounding_boxes]
+        self.edge_points[index] = edge_points
+        self.valid[index] = len(bounding_boxes) == 2
+        self.detected[index] = True
+
+    def get(self, index):
+        """ (bounding_boxes, edge_points) of a slice, None when it has not been detected """
+        if not self.detected[index]:
+            return None
+        return self.bounding_boxes[index], self.edge_points[index]
+
+    def is_valid(self, index):
+        return bool(self.valid[index])
+
+    def nearest_valid(self, index, max_distance=None):
+        """
+        The valid slice closest to index, the earlier one on ties. None when no detected slice is valid, or none is
+        within max_distance slices of index.
+        """
+        candidates = np.flatnonzero(self.valid)
+        if len(candidates) == 0:
+            return None
+
+        nearest = int(candidates[np.argmin(np.abs(candidates - index))])
+        if max_distance is not None and abs(nearest - index) > max_distance:
+            return None
+
+        return nearest
@@ -1,168 +1,170 @@
 import os
-from typing import List
-import pydicom
+from typing import List, Tuple
 import numpy as np
 
 from tqdm import tqdm
 from datetime import datetime
-from sklearn.linear_model import LinearRegression
 
-from analysis_extended_id_min_point import filter_local_minima, find_line_segments, identify_local_minima_and_maxima
-from analysis_script import calculate_metrics
-from functions import detect_knee_bounding_boxes
+from metrics import ALL_METRICS, batch_metrics, metric_series
+from knee_range import find_knee_range
+from pipeline import process_slices, read_slices
+from recommendation import GAP_SLICES, find_gaps, recommend
+from series_index import index_folder, slice_name
+from volume import Volume
+from volume_detection import detect_volume
+
+# Every n-th slice is processed in the first pass of the coarse to fine scan
+COARSE_STRIDE = 4
+
+
+def process_folder(folder_path: str, coarse_to_fine: bool = False, prune_z_range: bool = False,
+                   volumetric: bool = False) -> Tuple:
+    """
+    Metrics of every slice with two knee boxes, as a SLICE_METRICS_DTYPE array in slice order, and the first
+    slice searched, which find_recc_file counts the gaps from. volumetric detects the whole range at once with
+    detect_volume instead of slice by slice.
+    """
+    series_index = index_folder(folder_path)
+
+    slice_range = find_knee_range(series_index) if prune_z_range else range(len(series_index))
+
+    with tqdm(total=len(slice_range), desc=f'Processing DICOM files in {folder_path}', unit=' files') as pbar:
+        if volumetric:
+            volume = Volume.from_series_index(series_index)
+            for item in read_slices(series_index, slice_range):
+                volume.set_slice(item['slice_index'], item['slice_data'].hu, item['slice_data'].header)
+                pbar.update(1)
+            return volumetric_metrics(volume, slice_range), slice_range.start
+
+        def process_metrics(indices):
+            results = {}
+            for item in process_slices(series_index, indices):
+                results[item['slice_index']] = item['metrics']
+                pbar.update(1)
+            return results
+
+        if coarse_to_fine:
+            return metric_series(coarse_to_fine_metrics(slice_range, process_metrics)), slice_range.start
+
+        results = process_metrics(slice_range)
+        return metric_series([results[i] for i in sorted(results) if results[i]]), slice_range.start
+
+
+def volumetric_metrics(volume: Volume, slice_range: range, metrics: List[str] = ALL_METRICS, detections=None,
+                       check=None) -> np.ndarray:
+    """
+    Metric series of the slices in range with two knee boxes, detected in one pass over the volume.
+
+    Parameters:
+    volume (Volume): Volume with every slice of the range loaded.
+    slice_range (range): Indices of the slices to detect.
+    metrics (list of str): Metrics to compute, see METRIC_STAGES.
+    detections (DetectionIndex | None): Filled with the boxes and edge points of every slice in range.
+    check (callable | None): Passed on to detect_volume, may raise to stop between slabs.
+
+    Returns:
+    np.ndarray: slice_metrics_dtype(metrics) array in slice order, like metric_series of the per slice results.
+    """
+    detection = detect_volume(volume.hu[slice_range.start:slice_range.stop], check=check)
+
+    valid = []
+    for offset, i in enumerate(slice_range):
+        bounding_boxes, _, edge_points = detection.detect(offset)
+        if detections is not None:
+            detections.set(i, bounding_boxes, edge_points)
+        if len(bounding_boxes) == 2:
+            valid.append(i)
+
+    bounding_boxes = [detection.bounding_boxes[i - slice_range.start] for i in valid]
+    file_names = [slice_name(volume.file_paths[i], volume.frames[i]) for i in valid]
+    return batch_metrics(volume.hu, bounding_boxes, valid, file_names, metrics)
+
+
+def coarse_to_fine_metrics(slice_range: range, process_metrics, stride: int = COARSE_STRIDE) -> List:
+    """
+    Metrics for the slices find_recc_file depends on, without processing the whole study.
+
+    A strided pass locates the runs of slices without two boxes, both ends of every run long enough to be a
+    gap are then processed densely so the gaps are exact, and finally every slice from the first gap up to the
+    run before the second, where the plateau is searched for, is processed. Falls back to every slice when fewer than two gaps are
+    found. The result only differs from the exhaustive scan if two boxes are found on a slice hidden between
+    coarse samples that had none.
+
+    Parameters:
+    slice_range (range): Indices of the slices that may be processed.
+    process_metrics (callable): Takes a list of slice indices, returns a dict of index to metrics result or None.
+    stride (int): Step of the coarse pass.
+
+    Returns:
+    list of dict: Metrics results in slice order, sparse outside the refined window.
+    """
+    results = {}
+
+    def process(indices):
+        indices = [i for i in indices if i in slice_range and i not in results]
+        if indices:
+            results.update(process_metrics(indices))
+
+    def valid_results():
+        return [results[i] for i in sorted(results) if results[i]]
+
+    process(slice_range[::stride])
+
+    # Refine both ends of every run that may be a gap, the exact end slices lie within a stride of the samples
+    prev_index = slice_range.start - 1
+    for result in valid_results():
+        index = result['slice_index']
+
+        if index - prev_index >= GAP_SLICES:
+            if prev_index >= slice_range.start:
+                process(range(prev_index + 1, prev_index + stride))
+            process(range(index - stride + 1, index))
+
+        prev_index = index
+
+    folder_metrics = valid_results()
+    gaps = find_gaps([result['slice_index'] for result in folder_metrics], first_slice=slice_range.start)
 
-def process_folder(folder_path: str) -> List:
-    folder_name = os.path.basename(folder_path)
-    results = []
-
-    dicom_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.dcm')]
-    dicom_files.sort()
-
-    steps = 1
-    dicom_files = dicom_files[::steps]
-
-    with tqdm(total=len(dicom_files), desc=f'Processing DICOM files in {folder_path}', unit=' files') as pbar:
-        for dicom_file in dicom_files:
-            dicom_data = pydicom.dcmread(dicom_file)
-            bounding_boxes, _, _ = detect_knee_bounding_boxes(dicom_data)
-
-            pbar.update(steps)
-
-            if len(bounding_boxes) != 2:
-                continue
-
-            metrics = calculate_metrics(dicom_data.pixel_array, bounding_boxes)
-            results.append({
-                'file_name': os.path.basename(dicom_file),
-                'metrics': metrics
-            })
-
-
-    return results
+    if len(gaps) < 2:
+        process(slice_range)
+    else:
+        # Up to the last slice with two boxes before the second gap, the run after it was refined above
+        process(range(folder_metrics[gaps[0]]['slice_index'], folder_metrics[gaps[1] - 1]['slice_index']))
+
+    return valid_results()
 
 
-def process_metrics_from_data(file_names, dicom_data, bounding_boxes):
-    results = []
-    for i, dicom_data in enumerate(dicom_data):
-        bounding_boxes = bounding_boxes[i]
-        file_name = file_names[i]
-
-        if len(bounding_boxes) != 2:
-            continue
-
-        metrics = calculate_metrics(dicom_data.pixel_array, bounding_boxes)
-        results.append({
-            'file_name': os.path.basename(file_name),
-            'metrics': metrics
-        })
-
-
-    return results
-
-
-def find_recc_file(folder_path, folder_metrics) -> int | None:
+def find_recc_file(folder_path, folder_metrics, first_slice=0) -> int | None:
     folder_name = os.path.basename(folder_path)
+    series = metric_series(folder_metrics)
 
-    # Initialize lists to store metrics for both bounding boxes
-    bounding_box_metrics1 = []
-    bounding_box_metrics2 = []
-
-    gaps = []
-    prev_file_number = 0
-
-    for i, result in enumerate(folder_metrics):
-        file_name = (result['file_name'])
-        file_number = int(file_name.split(".")[0][-3:])
-
-        if prev_file_number + 100 <= file_number:
-            gaps.append(i)
-
-        # print(file_number)
-        prev_file_number = file_number
-
-    if not gaps:
-        print("No Gaps")
+    candidates = recommend(series, n_candidates=1, first_slice=first_slice)
+    if not candidates:
+        print(f"No plateau between two gaps in {folder_name}")
         return None
 
-    # Extract file names and corresponding metrics values for both bounding boxes
-    file_names = []
-    for result in folder_metrics:
-        file_names.append(result['file_name'])
-
-        # Example metrics to process (using gray pixels for both bounding boxes)
-        metrics_bb1 = result['metrics'][0]['gray_pixels']
-        metrics_bb2 = result['metrics'][1]['gray_pixels']
-
-        bounding_box_metrics1.append(metrics_bb1)
-        bounding_box_metrics2.append(metrics_bb2)
-
-    try:
-        # Identify local minima and maxima for both bounding boxes
-        peaks_bb1, minima_bb1 = identify_local_minima_and_maxima(bounding_box_metrics1)
-        peaks_bb2, minima_bb2 = identify_local_minima_and_maxima(bounding_box_metrics2)
-
-        # Filter local minima after the latest maxima
-        filtered_minima_bb1, filtered_minima_bb2, latest_peak_index = filter_local_minima(peaks_bb1, minima_bb1, peaks_bb2, minima_bb2)
-
-        # Find line segments meeting intensity criteria (7000 - 13000) after the latest peak index
-        intensity_range = (7000, 13000)
-        line_segments_bb1 = find_line_segments(bounding_box_metrics1, gaps[0], gaps[1], intensity_range)
-        line_segments_bb2 = find_line_segments(bounding_box_metrics2, gaps[0], gaps[1], intensity_range)
-
-        # Plot identified line segments with best-fit lines and median line
-        all_segments_indices_bb1 = []
-        all_segments_indices_bb2 = []
-
-        for segment in line_segments_bb1:
-            if len(segment) < 5:
-                continue  # Skip segments with fewer than 5 points
+    recc_index = candidates[0][0]
 
-            segment_indices, segment_values = zip(*segment)
+    # Print the file name corresponding to the median index
+    median_file_name = series['file_name'][np.flatnonzero(series['slice_index'] == recc_index)[0]]
+    print(f"Median file name: {median_file_name}")
 
-            # Perform linear regression
-            segment_indices = np.array(segment_indices).reshape(-1, 1)
-            model = LinearRegression().fit(segment_indices, segment_values)
-            line_of_best_fit = model.predict(segment_indices)
-            slope = model.coef_[0]
-            average_height = np.mean(line_of_best_fit)
-            if abs(slope) < 250 and 9000 <= average_height <= 12000:
-                all_segments_indices_bb1.extend(segment_indices)
+    return recc_index
 
-        for segment in line_segments_bb2:
-            if len(segment) < 5:
-                continue  # Skip segments with fewer than 5 points
 
-            segment_indices, segment_values = zip(*segment)
-
-            # Perform linear regression
-            segment_indices = np.array(segment_indices).reshape(-1, 1)
-            model = LinearRegression().fit(segment_indices, segment_values)
-            line_of_best_fit = model.predict(segment_indices)
-            slope = model.coef_[0]
-            average_height = np.mean(line_of_best_fit)
-            if abs(slope) < 250 and 9000 <= average_height <= 12000:
-                all_segments_indices_bb2.extend(segment_indices)
-
-        if len(all_segments_indices_bb1) == 0 or len(all_segments_indices_bb2) == 0:
-            print("No Line Segments")
-            return None
-
-        # Plot median line between minimum and maximum indices of all segments
-        min_index = min(min(all_segments_indices_bb1), min(all_segments_indices_bb2))
-        max_index = max(max(all_segments_indices_bb1), max(all_segments_indices_bb2))
-        median_index = int(np.median([min_index, max_index]))
-
-        # Print the file name corresponding to the median index
-        median_file_name = file_names[median_index]
-        print(f"Median file name: {median_file_name}")
+if __name__ == "__main__":
+    folder_path = "../Data/ChimpIJ"
 
-        return int(median_file_name.split(".")[0][-3:]) - 1
+    recc_index = find_recc_file(folder_path, *process_folder(folder_path))
 
-    except ValueError as e:
-        print(f"Error processing folder {folder_name}: {e}")
+    # The coarse to fine scan has to agree with the exhaustive one
+    coarse_recc_index = find_recc_file(folder_path, *process_folder(folder_path, coarse_to_fine=True))
+    print(f"Exhaustive: {recc_index}, coarse to fine: {coarse_recc_index}")
 
-if __name__ == "__main__":
-    folder_path = "../Data/ChimpIJ"
+    # And the scan pruned to the knee, whose gaps are counted from the start of the knee range
+    pruned_recc_index = find_recc_file(folder_path, *process_folder(folder_path, prune_z_range=True))
+    print(f"Exhaustive: {recc_index}, pruned to the knee: {pruned_recc_index}")
 
-    folder_metrics = process_folder(folder_path)
-    find_recc_file(folder_path, folder_metrics)
+    # The volumetric detection finds the same boxes as the per slice one
+    volumetric_recc_index = find_recc_file(folder_path, *process_folder(folder_path, volumetric=True))
+    print(f"Exhaustive: {recc_index}, volumetric: {volumetric_recc_index}")
@@ -3,29 +3,33 @@ import cv2
 from skimage.segmentation import slic, mark_boundaries
 from scipy.interpolate import splprep, splev
 import math
-import os
-import pydicom
 import time
 
+from knee_range import find_knee_range
+from multiframe import read_dataset
+from series_index import index_folder
+
 
 # Define the function to process DICOM files and plot the bounding box with the least white pixels
 def process_dicom_files(dicom_folder):
 
     time_prev = time.process_time()
 
-    dicom_files = read_dicom_folder(dicom_folder)
+    series_index = index_folder(dicom_folder, recursive=True)
+    dicom_files = list(zip(series_index.file_paths, series_index.frames))
     print(f"Time Taken - Folder Read: {(time.process_time() - time_prev)}")
 
-    # Define the range of slices to process (4/10 to 6/10)
-    start_index = int(len(dicom_files) * (9 / 20))
-    end_index = int(len(dicom_files) * (11 / 20))
+    # Only the slices around the knee of full leg scans, knee only scans keep the 9/20 to 11/20 window
+    slice_range = find_knee_range(series_index)
+    if len(slice_range) == len(series_index):
+        slice_range = range(int(len(dicom_files) * (9 / 20)), int(len(dicom_files) * (11 / 20)))
 
     min_white_pixels = float('inf')
     best_dicom_data = None
 
-    for dicom_file in dicom_files[start_index:end_index]:
-        dicom_data = pydicom.dcmread(dicom_file)
-        bounding_boxes, multichannel_image, edge_points = detect_knee_bounding_boxes(dicom_data)
+    for dicom_file, frame in dicom_files[slice_range.start:slice_range.stop]:
+        dicom_data = read_dataset(dicom_file, frame)
+        bounding_boxes, multichannel_image, edge_points = detect_knee_bounding_boxes(dicom_data, debug=True)
 
         # Check for similar sized bounding boxes
         if has_similar_sized_boxes(bounding_boxes, tolerance=10):
@@ -67,25 +71,50 @@ def process_image(dicom_data):
             intercept = dicom_data.RescaleIntercept
             img = img * slope + intercept
 
-        img = apply_ct_window(img, [400, 50])
-        img = (img - np.min(img)) / (np.max(img) - np.min(img)) * 255
-        multichannel_image = np.stack((img,) * 3, axis=-1).astype('uint8')
+        multichannel_image = np.stack((window_image(img),) * 3, axis=-1)
         return multichannel_image
 
 
+# Soft tissue window scaled to a single channel uint8 display image
+def window_image(hu_image):
+    hu_image = np.asarray(hu_image)
 
-# Define the function to read DICOM files from a folder and sort them numerically
-def read_dicom_folder(folder_path):
-    dicom_files = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith('.dcm'):
-                dicom_files.append(os.path.join(root, file))
+    if hu_image.dtype == np.int16:
+        return window_lookup(hu_image)
+
+    img = apply_ct_window(np.asarray(hu_image, dtype=float), [400, 50])
+    img = (img - np.min(img)) / (np.max(img) - np.min(img)) * 255
+    return img.astype('uint8')
 
-    # Sort DICOM files numerically
-    dicom_files.sort(key=lambda x: int(os.path.basename(x).split('-')[2].split('.')[0]))
 
-    return dicom_files
+def window_lookup(hu_image):
+    # The same window computed once per HU value in the slice's range and looked up through a uint16 view of the
+    # pixels, which numpy indexes without converting them, so only the uint8 result is allocated
+    low, high = int(hu_image.min()), int(hu_image.max())
+    values = np.arange(low, high + 1)
+
+    lut = np.zeros(1 << 16, dtype=np.uint8)
+    lut[values.astype(np.uint16)] = window_image(values.astype(float))
+    return lut[hu_image.view(np.uint16)]
+
+
+# Pixel data rescaled to Hounsfield units, left in the stored dtype when there is no rescale
+def get_hu_image(dicom_data):
+    dicom_image = dicom_data.pixel_array
+
+    if 'RescaleSlope' in dicom_data and 'RescaleIntercept' in dicom_data:
+        slope = dicom_data.RescaleSlope
+        intercept = dicom_data.RescaleIntercept
+        return dicom_image * slope + intercept
+
+    return dicom_image
+
+
+
+# Define the function to read DICOM files from a folder, ordered along the scan axis using only their headers
+# A multi-frame file is listed once per frame, use index_folder for the frame of each entry
+def read_dicom_folder(folder_path):
+    return index_folder(folder_path, recursive=True).file_paths
 
 
 def find_outliers_with_bspline(points, threshold=1.0):
@@ -165,42 +194,355 @@ def apply_ct_window(img, window):
     return R
 
 
-def detect_knee_bounding_boxes(dicom_data):
-    dicom_image = dicom_data.pixel_array
+def detect_knee_bounding_boxes(dicom_data, debug=False):
+    return detect_knee_bounding_boxes_hu(get_hu_image(dicom_data), debug)
 
-    if 'RescaleSlope' in dicom_data and 'RescaleIntercept' in dicom_data:
-        slope = dicom_data.RescaleSlope
-        intercept = dicom_data.RescaleIntercept
-        hu_image = dicom_image * slope + intercept
-    else:
-        hu_image = dicom_image
 
-    multichannel_image = np.stack((hu_image,) * 3, axis=-1)
-    segments = slic(multichannel_image, n_segments=100, compactness=10)
-    blurred_image = cv2.GaussianBlur(hu_image, (3, 3), 0)
-    laplacian = cv2.Laplacian(blurred_image, cv2.CV_64F)
-    sharpened_image = np.uint8(np.clip(blurred_image + laplacian, 0, 255))
-    superpixel_edges = mark_boundaries(sharpened_image, segments, color=(1, 0, 0))
-    _, binary_image = cv2.threshold(blurred_image, 160, 255, cv2.THRESH_BINARY)
-    sobel_x = cv2.Sobel(binary_image, cv2.CV_64F, 1, 0, ksize=3)
-    sobel_y = cv2.Sobel(binary_image, cv2.CV_64F, 0, 1, ksize=3)
-    sobel_edge = np.sqrt(sobel_x ** 2 + sobel_y ** 2)
-    sobel_edge_resized = cv2.resize(sobel_edge.astype(np.uint8), (dicom_image.shape[1], dicom_image.shape[0]))
+# Contours narrower or shorter than this are not knee bones
+MIN_BOX_SIZE = 70
+
+# Above 1 the knee is first found on a slice downsampled this many times, see detect_knee_bounding_boxes_pyramid
+DETECTION_SCALE = 1
+
+# Full resolution pixels added around every downsampled candidate box before it is refined
+PYRAMID_PADDING = 8
+
+# The blur and Sobel stages each read one pixel around every output pixel
+STAGE_REACH = 2
+
+
+class EdgePoints:
+    """
+    Contour points of a slice, grouped by the knee box they fall in.
+
+    points (np.ndarray): (N, 2) int32 x, y of every contour point, in contour order.
+    box_points (np.ndarray): (M, 2) int32 points inside each box, inclusive of its far edges, one box after the other.
+    box_offsets (np.ndarray): The points of box b are box_points[box_offsets[b]:box_offsets[b + 1]].
+
+    Iterating gives the (x, y) tuples of all points, like the flat list the detection used to return.
+    """
+
+    def __init__(self, contours, bounding_boxes):
+        if contours:
+            self.points = np.concatenate(contours).reshape(-1, 2).astype(np.int32, copy=False)
+        else:
+            self.points = np.empty((0, 2), dtype=np.int32)
+
+        px, py = self.points[:, 0], self.points[:, 1]
+        groups = [self.points[(x <= px) & (px <= x + w) & (y <= py) & (py <= y + h)] for x, y, w, h in bounding_boxes]
+
+        self.box_offsets = np.cumsum([0] + [len(group) for group in groups])
+        self.box_points = np.concatenate(groups) if groups else np.empty((0, 2), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.points)
 
+    def __iter__(self):
+        return iter(map(tuple, self.points.tolist()))
+
+    def box(self, index):
+        """ (n, 2) view of the points inside box index """
+        return self.box_points[self.box_offsets[index]:self.box_offsets[index + 1]]
+
+
+""" KNEE DETECTION STAGES
+    Every stage computes one output from the outputs of the stages it depends on. Only the stages the requested
+    outputs depend on are run, the superpixel and overlay stages only feed debugging and visualisation. """
+
+# cv2's 3x3 Gaussian, separable as [1, 2, 1] / 4 in each direction
+GAUSSIAN_KERNEL = np.array([0.25, 0.5, 0.25])
+
+
+def blur_stage(outputs):
+    hu_image = outputs['hu_image']
+
+    # The two dtypes SliceData produces, int16 is read directly into a float32 result, exact since every sum is a
+    # multiple of 1/16 of an integral HU, and float32 blurs the same as GaussianBlur would
+    if hu_image.dtype in (np.int16, np.float32):
+        return cv2.sepFilter2D(hu_image, cv2.CV_32F, GAUSSIAN_KERNEL, GAUSSIAN_KERNEL)
+
+    # cv2 has no blur for 32 and 64 bit integers, they are rescaled pixel arrays and get the float64 rescale's dtype
+    if hu_image.dtype.kind in 'iu' and hu_image.dtype.itemsize >= 4:
+        hu_image = hu_image.astype(np.float64)
+
+    # Anything else, a uint16 pixel array without a rescale for one, is blurred as it always was, in its own dtype
+    return cv2.GaussianBlur(hu_image, (3, 3), 0)
+
+
+def threshold_stage(outputs):
+    _, binary_image = cv2.threshold(outputs['blurred_image'], 160, 255, cv2.THRESH_BINARY)
+    return binary_image
+
+
+def sobel_stage(outputs):
+    # Gradients of a 0/255 image are small multiples of 255, float32 holds them and their magnitude truncates the same
+    depth = cv2.CV_64F if outputs['binary_image'].dtype == np.float64 else cv2.CV_32F
+    sobel_x = cv2.Sobel(outputs['binary_image'], depth, 1, 0, ksize=3)
+    sobel_y = cv2.Sobel(outputs['binary_image'], depth, 0, 1, ksize=3)
+    sobel_edge = cv2.magnitude(sobel_x, sobel_y)
+    return sobel_edge.astype(np.uint8)
+
+
+def contour_stage(outputs):
     # Find contours representing edges
-    contours, _ = cv2.findContours(sobel_edge_resized, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours, _ = cv2.findContours(outputs['sobel_edge'], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contours
 
-    # Extract coordinates of contours and store them with corresponding bounding boxes
-    edge_points = []
+
+def bounding_box_stage(outputs):
     bounding_boxes = []
-    for contour in contours:
+    for contour in outputs['contours']:
         x, y, w, h = cv2.boundingRect(contour)
-        if w > 70 and h > 70:
+        if w > MIN_BOX_SIZE and h > MIN_BOX_SIZE:
             bounding_boxes.append((x, y, w, h))
-        for point in contour:
-            edge_points.append(tuple(point[0]))
 
     # Sort bounding boxes by x-coordinate
     bounding_boxes.sort(key=lambda x: x[0])
+    return bounding_boxes
+
+
+def edge_point_stage(outputs):
+    return EdgePoints(outputs['contours'], outputs['bounding_boxes'])
+
+
+def multichannel_stage(outputs):
+    return np.stack((outputs['hu_image'],) * 3, axis=-1, dtype=np.float64)
+
+
+def superpixel_stage(outputs):
+    return slic(outputs['multichannel_image'], n_segments=100, compactness=10)
+
+
+def sharpen_stage(outputs):
+    blurred_image = outputs['blurred_image'].astype(np.float64, copy=False)
+    laplacian = cv2.Laplacian(blurred_image, cv2.CV_64F)
+    return np.uint8(np.clip(blurred_image + laplacian, 0, 255))
+
+
+def superpixel_edge_stage(outputs):
+    return mark_boundaries(outputs['sharpened_image'], outputs['segments'], color=(1, 0, 0))
+
+
+# Output name -> (stage, outputs it depends on)
+DETECTION_STAGES = {
+    'blurred_image': (blur_stage, ['hu_image']),
+    'binary_image': (threshold_stage, ['blurred_image']),
+    'sobel_edge': (sobel_stage, ['binary_image']),
+    'contours': (contour_stage, ['sobel_edge']),
+    'bounding_boxes': (bounding_box_stage, ['contours']),
+    'edge_points': (edge_point_stage, ['contours', 'bounding_boxes']),
+    'multichannel_image': (multichannel_stage, ['hu_image']),
+    'segments': (superpixel_stage, ['multichannel_image']),
+    'sharpened_image': (sharpen_stage, ['blurred_image']),
+    'superpixel_edges': (superpixel_edge_stage, ['sharpened_image', 'segments']),
+}
+
+# blur -> threshold -> Sobel -> contours, all the ingest needs
+PRODUCTION_OUTPUTS = ['bounding_boxes', 'edge_points']
+
+# Adds the superpixel map and overlays for inspecting a detection
+DEBUG_OUTPUTS = PRODUCTION_OUTPUTS + ['multichannel_image', 'segments', 'sharpened_image', 'superpixel_edges']
+
+
+def run_detection(hu_image, outputs=PRODUCTION_OUTPUTS):
+    """
+    Run the knee detection stages needed for the requested outputs.
+
+    Parameters:
+    hu_image (np.ndarray): Slice in Hounsfield units, float64 like the rescaled pixel_array.
+    outputs (list of str): Names of the DETECTION_STAGES outputs wanted.
+
+    Returns:
+    dict: The requested outputs, along with the intermediate ones computed on the way.
+    """
+    results = {'hu_image': hu_image}
+
+    def compute(name):
+        if name not in results:
+            stage, dependencies = DETECTION_STAGES[name]
+            for dependency in dependencies:
+                compute(dependency)
+            results[name] = stage(results)
+
+    for name in outputs:
+        compute(name)
+
+    return results
+
+
+def detect_knee_bounding_boxes_hu(hu_image, debug=False, scale=None):
+    # The multichannel image is only built for debugging, it is None otherwise
+    scale = DETECTION_SCALE if scale is None else scale
+
+    if scale > 1 and not debug:
+        return detect_knee_bounding_boxes_pyramid(hu_image, scale)
+
+    results = run_detection(hu_image, DEBUG_OUTPUTS if debug else PRODUCTION_OUTPUTS)
+    return results['bounding_boxes'], results.get('multichannel_image'), results['edge_points']
+
+
+""" PYRAMID DETECTION
+    Candidate boxes from a downsampled slice, contours traced at full resolution only around them """
+
+def merge_rois(rois):
+    # Overlapping regions are traced together so no contour is found twice
+    rois = sorted(rois)
+    merged = True
+
+    while merged:
+        merged = False
+        for i in range(len(rois)):
+            for j in range(i + 1, len(rois)):
+                a, b = rois[i], rois[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rois[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del rois[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return rois
+
+
+def grow_roi(roi, padding, width, height):
+    x0, y0, x1, y1 = roi
+    return max(x0 - padding, 0), max(y0 - padding, 0), min(x1 + padding, width), min(y1 + padding, height)
+
+
+def refine_roi(hu_image, roi):
+    """ Full resolution contours inside roi = (x0, y0, x1, y1), None if an edge runs into a side of the roi """
+    height, width = hu_image.shape
+    x0, y0, x1, y1 = roi
+
+    # The stages are run on a slightly larger crop so the edges inside the roi are exactly the full image ones
+    ex0, ey0 = max(x0 - STAGE_REACH, 0), max(y0 - STAGE_REACH, 0)
+    ex1, ey1 = min(x1 + STAGE_REACH, width), min(y1 + STAGE_REACH, height)
+
+    sobel_edge = run_detection(hu_image[ey0:ey1, ex0:ex1], ['sobel_edge'])['sobel_edge']
+    sobel_edge = np.ascontiguousarray(sobel_edge[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0])
+
+    # A contour cut by the roi would not match the full image one, image borders cut both the same way
+    if ((x0 > 0 and sobel_edge[:, 0].any()) or (x1 < width and sobel_edge[:, -1].any())
+            or (y0 > 0 and sobel_edge[0].any()) or (y1 < height and sobel_edge[-1].any())):
+        return None
+
+    contours, _ = cv2.findContours(sobel_edge, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    return list(contours)
+
+
+def trace_rois(hu_image, rois, growth):
+    """ Full resolution contours inside the rois, which grow by growth pixels until none of them cuts a contour """
+    height, width = hu_image.shape
+
+    rois = merge_rois(rois)
+    traced = [refine_roi(hu_image, roi) for roi in rois]
+
+    # Regions cutting a contour grow and every region is traced again, growing stops at the image borders
+    while any(roi_contours is None for roi_contours in traced):
+        rois = merge_rois([roi if roi_contours is not None else grow_roi(roi, growth, width, height)
+                           for roi, roi_contours in zip(rois, traced)])
+        traced = [refine_roi(hu_image, roi) for roi in rois]
+
+    return [contour for roi_contours in traced for contour in roi_contours]
+
+
+def detect_knee_bounding_boxes_pyramid(hu_image, scale=2, padding=PYRAMID_PADDING):
+    """
+    detect_knee_bounding_boxes_hu on a downsampled slice, refined at full resolution.
+
+    The slice is area averaged down by scale and the usual stages find the candidate knee boxes on it. Each
+    candidate, padded, is then traced at full resolution, growing it until none of its edges touch its sides, so
+    the boxes and their contours are exactly the full resolution ones. Contours away from the candidates, which
+    the full resolution path also returns as edge points, are never traced.
+
+    Parameters:
+    hu_image (np.ndarray): Slice in Hounsfield units, float64 like the rescaled pixel_array.
+    scale (int): Downsampling factor, e.g. 2 or 4.
+    padding (int): Full resolution pixels added around each candidate box.
+
+    Returns:
+    tuple: (bounding_boxes, None, edge_points) like detect_knee_bounding_boxes_hu.
+    """
+    height, width = hu_image.shape
+    small = cv2.resize(hu_image, (width // scale, height // scale), interpolation=cv2.INTER_AREA)
+
+    # Knee bones can come out a little smaller once averaged, the threshold is relaxed by a pixel each side
+    min_size = MIN_BOX_SIZE / scale - 2
+
+    rois = []
+    for contour in run_detection(small, ['contours'])['contours']:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w > min_size and h > min_size:
+            rois.append(grow_roi((x * scale, y * scale, (x + w) * scale, (y + h) * scale), padding + scale, width, height))
+
+    results = {'contours': trace_rois(hu_image, rois, padding + scale)}
+    results['bounding_boxes'] = bounding_box_stage(results)
+    return results['bounding_boxes'], None, edge_point_stage(results)
+
+
+
+""" INTER-SLICE TRACKING
+    Neighbouring slices have nearly the same knee boxes, the previous ones seed the search of the next slice """
+
+# Pixels added around the previous slice's boxes
+TRACK_MARGIN = 16
+
+# A box that moves or resizes by more than this many pixels from one slice to the next is not trusted
+TRACK_MAX_DRIFT = 12
+
+# A full frame detection is run at least this often, so bones appearing away from the tracked ones are found
+TRACK_REFRESH_SLICES = 16
+
+
+def boxes_drifted(previous_boxes, bounding_boxes, max_drift=TRACK_MAX_DRIFT):
+    return any(max(abs(a - b) for a, b in zip(previous, box)) > max_drift for previous, box in zip(previous_boxes, bounding_boxes))
+
+
+class BoxTracker:
+    """
+    Detects the knee in consecutive slices, tracing contours only around the boxes of the previous slice.
+
+    Falls back to a full frame detection for the first slice, after a jump in slice index, when the tracked
+    slice does not have exactly two boxes, when the boxes drift more than max_drift and every refresh slices.
+    Tracked slices return only the edge points around the knee.
+
+    Parameters:
+    margin (int): Pixels added around each previous box.
+    max_drift (int): Largest change in any of x, y, w, h accepted between two slices.
+    refresh (int): Longest run of tracked slices.
+    """
+
+    def __init__(self, margin=TRACK_MARGIN, max_drift=TRACK_MAX_DRIFT, refresh=TRACK_REFRESH_SLICES):
+        self.margin = margin
+        self.max_drift = max_drift
+        self.refresh = refresh
+
+        self.previous_index = None
+        self.previous_boxes = []
+        self.tracked_run = 0
+
+    def detect(self, index, hu_image):
+        """ Same return value as detect_knee_bounding_boxes_hu for the slice at index """
+        tracking = (self.previous_index is not None and abs(index - self.previous_index) == 1
+                    and len(self.previous_boxes) == 2 and self.tracked_run < self.refresh)
+
+        result = None
+        if tracking:
+            height, width = hu_image.shape
+            rois = [grow_roi((x, y, x + w, y + h), self.margin, width, height) for x, y, w, h in self.previous_boxes]
+
+            results = {'contours': trace_rois(hu_image, rois, self.margin)}
+            results['bounding_boxes'] = bounding_boxes = bounding_box_stage(results)
+
+            if len(bounding_boxes) == 2 and not boxes_drifted(self.previous_boxes, bounding_boxes, self.max_drift):
+                result = bounding_boxes, None, edge_point_stage(results)
+                self.tracked_run += 1
+
+        if result is None:
+            result = detect_knee_bounding_boxes_hu(hu_image)
+            self.tracked_run = 0
 
-    return bounding_boxes, multichannel_image, edge_points
+        self.previous_index = index
+        self.previous_boxes = result[0]
+        return result
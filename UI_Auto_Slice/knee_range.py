@@ -0,0 +1,85 @@
+import numpy as np
+
+from multiframe import read_dataset
+
+
+# Scans longer than this along the slice normal are full leg scans and get pruned to the knee
+KNEE_SCAN_LENGTH_MM = 500
+
+# Length kept either side of the widest bone cross section, before the safety margin
+KNEE_HALF_RANGE_MM = 150
+
+# Extra length kept either side of the pruned range
+SAFETY_MARGIN_MM = 25
+
+# The profile samples one slice every this many mm, and every n-th pixel of it in each direction
+PROFILE_SPACING_MM = 5
+PROFILE_PIXEL_STEP = 8
+
+# Same threshold the knee detection uses to separate bone
+BONE_HU = 160
+
+# Hip and foot bone is larger than the knee, the knee is searched for away from the scan ends
+END_FRACTION = 0.2
+
+
+def bone_area(file_path, frame=-1, step=PROFILE_PIXEL_STEP):
+    # pydicom always decodes the full slice, only every step-th pixel of it is rescaled and thresholded
+    dicom_data = read_dataset(file_path, frame)
+    pixels = dicom_data.pixel_array[::step, ::step]
+    slope = float(dicom_data.get('RescaleSlope', 1))
+    intercept = float(dicom_data.get('RescaleIntercept', 0))
+    return np.count_nonzero(pixels * slope + intercept > BONE_HU)
+
+
+def slice_distances(series_index):
+    # Distance of every slice from the first one in mm, None when the geometry is unknown
+    if not np.isnan(series_index.positions).any():
+        return np.abs(series_index.positions - series_index.positions[0])
+
+    if series_index.slice_thickness:
+        return np.arange(len(series_index)) * series_index.slice_thickness
+
+    return None
+
+
+def find_knee_range(series_index, margin_mm=SAFETY_MARGIN_MM, check=None):
+    """
+    Range of slices the tibial resection depth is searched in.
+
+    Knee only scans are returned whole. For longer scans a bone area profile, from a sparse subset of the slices
+    each decoded in full but thresholded on a coarse pixel grid, locates the widest bone cross section away from the hip and foot ends, and
+    only the slices within KNEE_HALF_RANGE_MM plus the margin of it are kept.
+
+    Parameters:
+    series_index (SeriesIndex): Ordered slices of the series.
+    margin_mm (float): Safety margin added either side of the range.
+    check (callable | None): Called before each profile slice is read, may raise to stop, e.g. on cancel.
+
+    Returns:
+    range: Slice indices to process.
+    """
+    full_range = range(len(series_index))
+    distances = slice_distances(series_index)
+
+    if distances is None or distances[-1] <= KNEE_SCAN_LENGTH_MM:
+        return full_range
+
+    # Sample one slice every PROFILE_SPACING_MM, away from the ends of the scan
+    length = distances[-1]
+    targets = np.arange(length * END_FRACTION, length * (1 - END_FRACTION), PROFILE_SPACING_MM)
+    samples = np.unique(np.searchsorted(distances, targets))
+
+    profile = []
+    for i in samples:
+        if check is not None:
+            check()
+        profile.append(bone_area(series_index.file_paths[i], series_index.frames[i]))
+
+    knee_distance = distances[samples[int(np.argmax(profile))]]
+
+    half_range = KNEE_HALF_RANGE_MM + margin_mm
+    start = int(np.searchsorted(distances, knee_distance - half_range, side='left'))
+    stop = int(np.searchsorted(distances, knee_distance + half_range, side='right'))
+
+    return range(start, stop)
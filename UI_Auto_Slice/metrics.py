@@ -0,0 +1,496 @@
+import numpy as np
+
+from series_index import slice_number
+
+
+# Percentiles of a box that split its pixels into white, almost white, gray, almost black and black
+WHITE_PERCENTILE = 99
+ALMOST_WHITE_PERCENTILE = 95
+ALMOST_BLACK_PERCENTILE = 5
+BLACK_PERCENTILE = 1
+
+COUNT_FIELDS = ['white_pixels', 'almost_white_pixels', 'gray_pixels', 'almost_black_pixels', 'black_pixels']
+PROPORTION_FIELDS = ['white_proportion', 'almost_white_proportion', 'gray_proportion', 'almost_black_proportion', 'black_proportion']
+
+# The calculate_metrics dict of one box as a record
+METRICS_DTYPE = np.dtype(
+    [('total_pixels', np.int64)]
+    + [(field, np.int64) for field in COUNT_FIELDS]
+    + [('area', np.int64)]
+    + [(field, np.float64) for field in PROPORTION_FIELDS]
+)
+
+
+def metrics_dtype(metrics):
+    # The METRICS_DTYPE record cut down to the given fields, in METRICS_DTYPE order
+    return np.dtype([(name, METRICS_DTYPE[name]) for name in METRICS_DTYPE.names if name in metrics])
+
+
+def slice_metrics_dtype(metrics):
+    # One slice with two knee boxes, series['metrics']['gray_pixels'] is then a (slices, 2) array
+    return np.dtype([
+        ('slice_index', np.int32),
+        ('file_name', 'U64'),
+        ('bounding_boxes', np.int32, (2, 4)),
+        ('metrics', metrics_dtype(metrics), (2,)),
+    ])
+
+
+# A series with every metric
+SLICE_METRICS_DTYPE = slice_metrics_dtype(METRICS_DTYPE.names)
+
+
+def box_metrics(total_pixels, area, white_pixels, almost_white_pixels, gray_pixels, almost_black_pixels, black_pixels):
+    return {
+        'total_pixels': total_pixels,
+        'white_pixels': white_pixels,
+        'almost_white_pixels': almost_white_pixels,
+        'gray_pixels': gray_pixels,
+        'almost_black_pixels': almost_black_pixels,
+        'black_pixels': black_pixels,
+        'area': area,
+        'white_proportion': white_pixels / total_pixels,
+        'almost_white_proportion': almost_white_pixels / total_pixels,
+        'gray_proportion': gray_pixels / total_pixels,
+        'almost_black_proportion': almost_black_pixels / total_pixels,
+        'black_proportion': black_pixels / total_pixels
+    }
+
+
+def percentile_counts(bbox_image):
+    # Compute dynamic thresholds using percentiles
+    flattened = bbox_image.flatten()
+    white_threshold = np.percentile(flattened, WHITE_PERCENTILE)
+    black_threshold = np.percentile(flattened, BLACK_PERCENTILE)
+    almost_white_threshold = np.percentile(flattened, ALMOST_WHITE_PERCENTILE)
+    almost_black_threshold = np.percentile(flattened, ALMOST_BLACK_PERCENTILE)
+
+    white_pixels = np.sum(bbox_image >= white_threshold)
+    black_pixels = np.sum(bbox_image <= black_threshold)
+    almost_white_pixels = np.sum((bbox_image >= almost_white_threshold) & (bbox_image < white_threshold))
+    almost_black_pixels = np.sum((bbox_image > black_threshold) & (bbox_image <= almost_black_threshold))
+    gray_pixels = np.sum((bbox_image > almost_black_threshold) & (bbox_image < almost_white_threshold))
+
+    return white_pixels, almost_white_pixels, gray_pixels, almost_black_pixels, black_pixels
+
+
+class BoxHistogram:
+    """
+    Cumulative histogram of the integer pixels of one box, answers order statistics and threshold counts.
+
+    Parameters:
+    bbox_image (np.ndarray): Integer pixels, e.g. a box of an int16 HU slice.
+    """
+
+    def __init__(self, bbox_image):
+        self.dtype = bbox_image.dtype
+        self.low = int(bbox_image.min())
+        self.n = bbox_image.size
+
+        # int32 so the offsets of a full int16 range do not wrap
+        offsets = np.subtract(bbox_image, self.low, dtype=np.int32)
+        self.cumulative = np.cumsum(np.bincount(offsets.ravel()))
+
+    def value(self, k):
+        """ The k-th smallest pixel, counted from 0 """
+        return np.searchsorted(self.cumulative, k, side='right') + self.low
+
+    def count_at_most(self, value):
+        """ Number of pixels <= value, for an integral value """
+        offset = int(value) - self.low
+        if offset < 0:
+            return np.int64(0)
+        if offset >= len(self.cumulative):
+            return np.int64(self.n)
+        return self.cumulative[offset]
+
+    def percentile(self, q):
+        """ np.percentile(pixels, q) with the default linear method, the same operations on the same dtypes """
+        virtual_index = np.asanyarray((self.n - 1) * np.true_divide(q, 100))
+
+        if virtual_index >= self.n - 1:
+            previous_index = next_index = self.n - 1
+        else:
+            previous_index = int(np.floor(virtual_index))
+            next_index = previous_index + 1
+
+        previous = np.array([self.value(previous_index)], dtype=self.dtype)
+        following = np.array([self.value(next_index)], dtype=self.dtype)
+        gamma = np.asanyarray(virtual_index - np.floor(virtual_index), dtype=virtual_index.dtype)
+
+        # numpy's _lerp, from the lower end below the midpoint and from the upper end above it
+        diff = np.subtract(following, previous)
+        result = np.asanyarray(np.add(previous, diff * gamma))
+        np.subtract(following, diff * (1 - gamma), out=result, where=gamma >= 0.5,
+                    casting='unsafe', dtype=type(result.dtype))
+        return result[0]
+
+    def counts(self):
+        white_threshold = self.percentile(WHITE_PERCENTILE)
+        black_threshold = self.percentile(BLACK_PERCENTILE)
+        almost_white_threshold = self.percentile(ALMOST_WHITE_PERCENTILE)
+        almost_black_threshold = self.percentile(ALMOST_BLACK_PERCENTILE)
+
+        # Integer pixels: p >= t is p > ceil(t) - 1, p < t is p <= ceil(t) - 1 and p <= t is p <= floor(t)
+        below_white = self.count_at_most(np.ceil(white_threshold) - 1)
+        below_almost_white = self.count_at_most(np.ceil(almost_white_threshold) - 1)
+        up_to_black = self.count_at_most(np.floor(black_threshold))
+        up_to_almost_black = self.count_at_most(np.floor(almost_black_threshold))
+
+        white_pixels = self.n - below_white
+        black_pixels = up_to_black
+        almost_white_pixels = max(below_white - below_almost_white, 0)
+        almost_black_pixels = max(up_to_almost_black - up_to_black, 0)
+        gray_pixels = max(below_almost_white - up_to_almost_black, 0)
+
+        return tuple(np.int64(count) for count in
+                     (white_pixels, almost_white_pixels, gray_pixels, almost_black_pixels, black_pixels))
+
+
+class BatchHistogram:
+    """
+    BoxHistogram of many integer boxes at once, their histograms back to back in one cumulative histogram.
+
+    Every method takes and returns one value per box, computed with the same operations on the same dtypes as
+    the BoxHistogram of that box.
+
+    Parameters:
+    bbox_images (list of np.ndarray): Non empty boxes of one integer dtype of at most 16 bits.
+    low, high (np.ndarray | None): Smallest and largest pixel of each box, if already known.
+    """
+
+    def __init__(self, bbox_images, low=None, high=None):
+        self.dtype = bbox_images[0].dtype
+        self.n = np.array([bbox_image.size for bbox_image in bbox_images], dtype=np.int64)
+
+        if low is None or high is None:
+            low = [bbox_image.min() for bbox_image in bbox_images]
+            high = [bbox_image.max() for bbox_image in bbox_images]
+        self.low = np.asarray(low, dtype=np.int64)
+        self.bins = np.asarray(high, dtype=np.int64) - self.low + 1
+
+        # First bin of each box and the number of pixels of the boxes before it
+        self.base = np.cumsum(self.bins) - self.bins
+        self.before = np.cumsum(self.n) - self.n
+
+        # Every pixel's bin written straight into the intp array bincount counts, no other copy of the boxes is made
+        bins = np.empty(int(self.n.sum()), dtype=np.intp)
+        for bbox_image, start, shift in zip(bbox_images, self.before.tolist(), (self.low - self.base).tolist()):
+            np.subtract(bbox_image, shift, out=bins[start:start + bbox_image.size].reshape(bbox_image.shape),
+                        dtype=np.intp)
+
+        self.cumulative = np.cumsum(np.bincount(bins, minlength=int(self.bins.sum())))
+
+    def value(self, k):
+        """ The k-th smallest pixel of each box, counted from 0 """
+        return np.searchsorted(self.cumulative, k + self.before, side='right') - self.base + self.low
+
+    def count_at_most(self, value):
+        """ Number of pixels <= value in each box, for integral values """
+        offset = value.astype(np.int64) - self.low
+        counts = self.cumulative[self.base + np.clip(offset, 0, self.bins - 1)] - self.before
+        return np.where(offset < 0, 0, np.where(offset >= self.bins, self.n, counts))
+
+    def percentile(self, q):
+        """ np.percentile(pixels, q) of each box, see BoxHistogram.percentile """
+        virtual_index = (self.n - 1) * np.true_divide(q, 100)
+
+        at_end = virtual_index >= self.n - 1
+        previous_index = np.where(at_end, self.n - 1, np.floor(virtual_index).astype(np.int64))
+        next_index = np.where(at_end, self.n - 1, previous_index + 1)
+
+        previous = self.value(previous_index).astype(self.dtype)
+        following = self.value(next_index).astype(self.dtype)
+        gamma = virtual_index - np.floor(virtual_index)
+
+        diff = np.subtract(following, previous)
+        result = np.add(previous, diff * gamma)
+        np.subtract(following, diff * (1 - gamma), out=result, where=gamma >= 0.5,
+                    casting='unsafe', dtype=result.dtype)
+        return result
+
+    def counts(self):
+        """ The cumulative counts the metric stages split the pixels with, as a dict of per box arrays """
+        below_white = self.count_at_most(np.ceil(self.percentile(WHITE_PERCENTILE)) - 1)
+        below_almost_white = self.count_at_most(np.ceil(self.percentile(ALMOST_WHITE_PERCENTILE)) - 1)
+        up_to_almost_black = self.count_at_most(np.floor(self.percentile(ALMOST_BLACK_PERCENTILE)))
+        up_to_black = self.count_at_most(np.floor(self.percentile(BLACK_PERCENTILE)))
+
+        return {
+            'white_pixels': self.n - below_white,
+            'almost_white_pixels': np.maximum(below_white - below_almost_white, 0),
+            'gray_pixels': np.maximum(below_almost_white - up_to_almost_black, 0),
+            'almost_black_pixels': np.maximum(up_to_almost_black - up_to_black, 0),
+            'black_pixels': up_to_black,
+        }
+
+
+def histogram_counts(bbox_image):
+    """ percentile_counts of an integer box from one histogram instead of four partitions and five masks """
+    return BoxHistogram(bbox_image).counts()
+
+
+""" METRIC STAGES
+    Every metric of a box is computed from the metrics it depends on, only the ones a consumer asks for are run.
+    The percentile thresholds and the pixel counts below or up to them come from one histogram for integer
+    boxes and from np.percentile and masks for float ones. """
+
+def histogram_stage(results):
+    # CT pixels are integral unless the rescale was not, those boxes keep the percentile path
+    bbox_image = results['bbox_image']
+    if bbox_image.size and np.issubdtype(bbox_image.dtype, np.integer):
+        return BoxHistogram(bbox_image)
+    return None
+
+
+def percentile_stage(q):
+    def stage(results):
+        if results['histogram'] is not None:
+            return results['histogram'].percentile(q)
+        return np.percentile(results['bbox_image'], q)
+    return stage
+
+
+def count_below_stage(threshold):
+    # Pixels < threshold
+    def stage(results):
+        if results['histogram'] is not None:
+            return results['histogram'].count_at_most(np.ceil(results[threshold]) - 1)
+        return np.sum(results['bbox_image'] < results[threshold])
+    return stage
+
+
+def count_up_to_stage(threshold):
+    # Pixels <= threshold
+    def stage(results):
+        if results['histogram'] is not None:
+            return results['histogram'].count_at_most(np.floor(results[threshold]))
+        return np.sum(results['bbox_image'] <= results[threshold])
+    return stage
+
+
+def count_between_stage(upper, lower):
+    # A run of pixels between two cumulative counts, empty when the thresholds cross
+    def stage(results):
+        return np.int64(max(results[upper] - results[lower], 0))
+    return stage
+
+
+def box_area_stage(results):
+    _, _, w, h = results['box']
+    return w * h
+
+
+def white_stage(results):
+    return np.int64(results['bbox_image'].size - results['below_white'])
+
+
+def black_stage(results):
+    return np.int64(results['up_to_black'])
+
+
+def proportion_stage(count):
+    def stage(results):
+        return results[count] / results['total_pixels']
+    return stage
+
+
+# Metric name -> (stage, metrics it depends on), 'bbox_image' and 'box' are given
+METRIC_STAGES = {
+    'histogram': (histogram_stage, ['bbox_image']),
+    'white_threshold': (percentile_stage(WHITE_PERCENTILE), ['histogram']),
+    'almost_white_threshold': (percentile_stage(ALMOST_WHITE_PERCENTILE), ['histogram']),
+    'almost_black_threshold': (percentile_stage(ALMOST_BLACK_PERCENTILE), ['histogram']),
+    'black_threshold': (percentile_stage(BLACK_PERCENTILE), ['histogram']),
+    'below_white': (count_below_stage('white_threshold'), ['histogram', 'white_threshold']),
+    'below_almost_white': (count_below_stage('almost_white_threshold'), ['histogram', 'almost_white_threshold']),
+    'up_to_almost_black': (count_up_to_stage('almost_black_threshold'), ['histogram', 'almost_black_threshold']),
+    'up_to_black': (count_up_to_stage('black_threshold'), ['histogram', 'black_threshold']),
+    'total_pixels': (box_area_stage, ['box']),
+    'area': (box_area_stage, ['box']),
+    'white_pixels': (white_stage, ['below_white']),
+    'almost_white_pixels': (count_between_stage('below_white', 'below_almost_white'), ['below_white', 'below_almost_white']),
+    'gray_pixels': (count_between_stage('below_almost_white', 'up_to_almost_black'), ['below_almost_white', 'up_to_almost_black']),
+    'almost_black_pixels': (count_between_stage('up_to_almost_black', 'up_to_black'), ['up_to_almost_black', 'up_to_black']),
+    'black_pixels': (black_stage, ['up_to_black']),
+}
+
+for count_field, proportion_field in zip(COUNT_FIELDS, PROPORTION_FIELDS):
+    METRIC_STAGES[proportion_field] = (proportion_stage(count_field), [count_field, 'total_pixels'])
+
+# Every field of the calculate_metrics dict, for analysis and plotting
+ALL_METRICS = list(METRICS_DTYPE.names)
+
+# All find_recc_file and the incremental recommender read, the loader computes nothing else
+RECOMMENDER_METRICS = ['gray_pixels']
+
+
+def run_metrics(bbox_image, box, metrics=ALL_METRICS):
+    """
+    Run the metric stages needed for the requested metrics of one box.
+
+    Parameters:
+    bbox_image (np.ndarray): Pixels inside the box.
+    box (tuple): x, y, w, h of the box.
+    metrics (list of str): Names of the METRIC_STAGES outputs wanted.
+
+    Returns:
+    dict: The requested metrics, along with the intermediate ones computed on the way.
+    """
+    results = {'bbox_image': bbox_image, 'box': box}
+
+    def compute(name):
+        if name not in results:
+            stage, dependencies = METRIC_STAGES[name]
+            for dependency in dependencies:
+                compute(dependency)
+            results[name] = stage(results)
+
+    for name in metrics:
+        compute(name)
+
+    return results
+
+
+def calculate_metrics(image, bounding_boxes, metrics=ALL_METRICS):
+    """ Per box dicts of the requested metrics, all of them by default """
+    box_results = []
+    for box in bounding_boxes:
+        x, y, w, h = box
+        results = run_metrics(image[y:y+h, x:x+w], box, metrics)
+        box_results.append({name: results[name] for name in metrics})
+    return box_results
+
+
+# Pixels, and histogram bins, batch_metrics counts together. Both are intp arrays so a batch stays around 8 MB
+BATCH_PIXELS = 1 << 20
+
+
+def batch_box_metrics(bbox_images, boxes, metrics, low, high):
+    # The requested metrics of many boxes as (boxes,) arrays, the counts of all of them from one BatchHistogram
+    counts = BatchHistogram(bbox_images, low, high).counts()
+    counts['total_pixels'] = counts['area'] = np.array([w * h for _, _, w, h in boxes], dtype=np.int64)
+
+    for count_field, proportion_field in zip(COUNT_FIELDS, PROPORTION_FIELDS):
+        counts[proportion_field] = counts[count_field] / counts['total_pixels']
+
+    return {name: counts[name] for name in metrics}
+
+
+def batch_metrics(hu_volume, bounding_boxes, slice_indices=None, file_names=None, metrics=ALL_METRICS):
+    """
+    calculate_metrics for many slices at once, into one structured array instead of per slice lists of dicts.
+
+    The boxes of an integer volume are histogrammed together, BATCH_PIXELS at a time, and their percentiles and
+    counts looked up for all of them at once. Float volumes are measured box by box with run_metrics.
+
+    Parameters:
+    hu_volume (np.ndarray): (slices, rows, columns) Hounsfield units, e.g. Volume.hu.
+    bounding_boxes (np.ndarray): (S, 2, 4) x, y, w, h of the two knee boxes of each slice.
+    slice_indices (np.ndarray | None): (S,) slice of hu_volume each row of boxes belongs to, defaults to 0..S-1.
+    file_names (list of str | None): Name of each slice, kept for plots and printing.
+    metrics (list of str): METRICS_DTYPE fields to compute, the series only has these fields.
+
+    Returns:
+    np.ndarray: (S,) slice_metrics_dtype(metrics) array, the same values calculate_metrics gives.
+    """
+    bounding_boxes = np.asarray(bounding_boxes, dtype=np.int32).reshape(-1, 2, 4)
+    if slice_indices is None:
+        slice_indices = np.arange(len(bounding_boxes))
+
+    series = np.zeros(len(bounding_boxes), dtype=slice_metrics_dtype(metrics))
+    series['slice_index'] = slice_indices
+    series['bounding_boxes'] = bounding_boxes
+    if file_names is not None:
+        series['file_name'] = file_names
+
+    boxes = [tuple(box) for box in bounding_boxes.reshape(-1, 4).tolist()]
+    bbox_images = [hu_volume[series['slice_index'][b // 2], y:y+h, x:x+w] for b, (x, y, w, h) in enumerate(boxes)]
+    values = {name: np.zeros(len(boxes), dtype=METRICS_DTYPE[name]) for name in metrics}
+
+    batched = (np.issubdtype(hu_volume.dtype, np.integer) and hu_volume.dtype.itemsize <= 2
+               and all(bbox_image.size for bbox_image in bbox_images))
+
+    if batched:
+        low = np.array([bbox_image.min() for bbox_image in bbox_images], dtype=np.int64)
+        high = np.array([bbox_image.max() for bbox_image in bbox_images], dtype=np.int64)
+
+        # A box costs its pixels or its bins, whichever is more, a small box can span the whole int16 range
+        cost = np.cumsum(np.maximum([bbox_image.size for bbox_image in bbox_images], high - low + 1))
+
+        start = 0
+        while start < len(boxes):
+            # At least one box per batch, however large it is
+            done = cost[start - 1] if start else 0
+            stop = max(int(np.searchsorted(cost, done + BATCH_PIXELS, side='right')), start + 1)
+
+            batch = slice(start, stop)
+            for name, column in batch_box_metrics(bbox_images[batch], boxes[batch], metrics, low[batch], high[batch]).items():
+                values[name][batch] = column
+            start = stop
+
+    else:
+        for b, (bbox_image, box) in enumerate(zip(bbox_images, boxes)):
+            results = run_metrics(bbox_image, box, metrics)
+            for name in metrics:
+                values[name][b] = results[name]
+
+    for name, column in values.items():
+        series['metrics'][name] = column.reshape(-1, 2)
+
+    return series
+
+
+def series_metrics(series):
+    """ Names of the metrics a series holds, the loader only computes some of them """
+    return series.dtype['metrics'].base.names
+
+
+def require_metrics(series, metrics):
+    """ Raises ValueError if the series lacks any of the metrics, rather than reading a field that was never measured """
+    missing = [name for name in metrics if name not in series_metrics(series)]
+    if missing:
+        raise ValueError(f"The metric series has no {', '.join(missing)}, it only holds {', '.join(series_metrics(series))}")
+
+
+def select_metrics(series, metrics):
+    """ A copy of a series with only the given metrics, ValueError if it lacks any of them """
+    require_metrics(series, metrics)
+
+    selected = np.zeros(len(series), dtype=slice_metrics_dtype(metrics))
+    for field in ('slice_index', 'file_name', 'bounding_boxes'):
+        selected[field] = series[field]
+    for name in series_metrics(selected):
+        selected['metrics'][name] = series['metrics'][name]
+
+    return selected
+
+
+def metric_series(folder_metrics, metrics=None):
+    """
+    The per slice results of the ingest pipeline, dicts with file_name, slice_index and two boxes of metrics,
+    as a structured array. Structured arrays are returned as they are.
+
+    The array only has the given metrics, by default those every box has, so metrics that were not computed are
+    absent instead of 0, see series_metrics. KeyError if a box lacks one of the given metrics.
+    """
+    if isinstance(folder_metrics, np.ndarray):
+        return folder_metrics
+
+    if metrics is None:
+        metrics = set(METRICS_DTYPE.names)
+        for result in folder_metrics:
+            for box in result['metrics']:
+                metrics.intersection_update(box)
+
+    dtype = slice_metrics_dtype(metrics)
+    series = np.zeros(len(folder_metrics), dtype=dtype)
+
+    for row, result in zip(series, folder_metrics):
+        row['slice_index'] = slice_number(result) - 1
+        row['file_name'] = result['file_name']
+        if 'bounding_boxes' in result:
+            row['bounding_boxes'] = result['bounding_boxes']
+        row['metrics'] = [tuple(box[field] for field in dtype['metrics'].base.names) for box in result['metrics']]
+
+    return series
@@ -0,0 +1,66 @@
+import sys
+import time
+import numpy as np
+
+from functions import detect_knee_bounding_boxes_hu
+from metrics import box_metrics, percentile_counts, histogram_counts
+from series_index import index_folder
+from volume import Volume
+
+
+def study_boxes(folder_path):
+    # Every slice of the study decoded into one volume, with the knee boxes of the slices that have two
+    series_index = index_folder(folder_path)
+    volume = Volume.from_series_index(series_index)
+    boxes = []
+
+    for i in range(len(volume)):
+        volume.load_slice(i)
+        bounding_boxes, _, _ = detect_knee_bounding_boxes_hu(volume.hu_image(i))
+
+        if len(bounding_boxes) == 2:
+            boxes.extend((i, box) for box in bounding_boxes)
+
+    return volume, boxes
+
+
+def measure(counts, volume, boxes, repeats):
+    best = np.inf
+    results = None
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = []
+        for i, (x, y, w, h) in boxes:
+            results.append(box_metrics(w * h, w * h, *counts(volume.hu[i, y:y+h, x:x+w])))
+        best = min(best, time.perf_counter() - start)
+
+    return best, results
+
+
+def run_benchmark(folder_path, repeats=5):
+    """
+    Time the metrics of every knee box of a study with the percentile path and the histogram path.
+
+    Decoding and detection are done once up front and not timed, the best of a few repeats is reported.
+    Both paths must give exactly the same dicts, values and types.
+    """
+    volume, boxes = study_boxes(folder_path)
+    print(f"{len(boxes)} knee boxes in {len(volume)} slices")
+
+    timings = {}
+    outputs = {}
+    for name, counts in (('Percentiles', percentile_counts), ('Histogram', histogram_counts)):
+        timings[name], outputs[name] = measure(counts, volume, boxes, repeats)
+        print(f"{name}: {timings[name] * 1000:.1f} ms for the study, {timings[name] * 1e6 / len(boxes):.0f} us per box")
+
+    identical = all(
+        a.keys() == b.keys() and all(type(a[k]) is type(b[k]) and a[k] == b[k] for k in a)
+        for a, b in zip(outputs['Percentiles'], outputs['Histogram'])
+    )
+    print(f"Speedup {timings['Percentiles'] / timings['Histogram']:.1f}x, identical output: {identical}")
+
+
+if __name__ == "__main__":
+    folder_path = sys.argv[1] if len(sys.argv) == 2 else "../Data/ChimpIJ"
+    run_benchmark(folder_path)
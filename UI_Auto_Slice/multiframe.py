@@ -0,0 +1,227 @@
+import struct
+import pydicom
+
+from functools import lru_cache
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate
+from pydicom.tag import Tag
+
+
+# Multi-frame files whose header and frame table are kept for reading frames, per process
+OPEN_FILES = 4
+
+PIXEL_DATA = Tag(0x7FE0, 0x0010)
+ITEM = Tag(0xFFFE, 0xE000)
+SEQUENCE_DELIMITER = Tag(0xFFFE, 0xE0DD)
+
+# Image pixel module, copied onto every frame so pixel_array can decode it like a single frame slice
+PIXEL_TAGS = [
+    'Rows',
+    'Columns',
+    'SamplesPerPixel',
+    'PhotometricInterpretation',
+    'PlanarConfiguration',
+    'BitsAllocated',
+    'BitsStored',
+    'HighBit',
+    'PixelRepresentation',
+]
+
+# Tags read from the header of a multi-frame file on top of the single frame header tags
+MULTIFRAME_TAGS = [
+    'NumberOfFrames',
+    'SharedFunctionalGroupsSequence',
+    'PerFrameFunctionalGroupsSequence',
+]
+
+
+def number_of_frames(header):
+    return int(header.get('NumberOfFrames') or 1)
+
+
+def is_multiframe(header):
+    return number_of_frames(header) > 1
+
+
+def functional_group(header, frame, name):
+    # Per-frame groups override the shared ones, e.g. the rescale is often shared but the position never is
+    for sequence_name, index in (('PerFrameFunctionalGroupsSequence', frame), ('SharedFunctionalGroupsSequence', 0)):
+        sequence = header.get(sequence_name)
+
+        if sequence and index < len(sequence) and sequence[index].get(name):
+            return sequence[index].get(name)[0]
+
+    return None
+
+
+def frame_header(header, frame):
+    """
+    The attributes of a single frame CT slice for one frame of an Enhanced CT object.
+
+    Position, orientation, thickness and rescale are taken from the functional groups. InstanceNumber is the
+    frame number counted from 1, so frames order along the scan like the files of a single frame series.
+
+    Parameters:
+    header (pydicom.Dataset): Header of the multi-frame file, including its functional groups.
+    frame (int): Frame index counted from 0.
+
+    Returns:
+    pydicom.Dataset: Header of the frame.
+    """
+    frame_data = Dataset()
+    frame_data.SeriesInstanceUID = header.get('SeriesInstanceUID', '')
+    frame_data.InstanceNumber = frame + 1
+
+    for tag in PIXEL_TAGS:
+        if tag in header:
+            setattr(frame_data, tag, header.get(tag))
+
+    position = functional_group(header, frame, 'PlanePositionSequence')
+    if position is not None and 'ImagePositionPatient' in position:
+        frame_data.ImagePositionPatient = position.ImagePositionPatient
+
+    orientation = functional_group(header, frame, 'PlaneOrientationSequence')
+    if orientation is not None and 'ImageOrientationPatient' in orientation:
+        frame_data.ImageOrientationPatient = orientation.ImageOrientationPatient
+
+    measures = functional_group(header, frame, 'PixelMeasuresSequence')
+    if measures is not None and measures.get('SliceThickness') is not None:
+        frame_data.SliceThickness = measures.SliceThickness
+    elif header.get('SliceThickness') is not None:
+        frame_data.SliceThickness = header.SliceThickness
+
+    rescale = functional_group(header, frame, 'PixelValueTransformationSequence')
+    if rescale is not None and 'RescaleSlope' in rescale and 'RescaleIntercept' in rescale:
+        frame_data.RescaleSlope = rescale.RescaleSlope
+        frame_data.RescaleIntercept = rescale.RescaleIntercept
+
+    return frame_data
+
+
+def read_item_header(file, little_endian=True):
+    group, element, length = struct.unpack('<HHL' if little_endian else '>HHL', file.read(8))
+    return Tag(group, element), length
+
+
+class FrameReader:
+    """
+    Reads single frames of a multi-frame file without decoding, or even reading, the rest of its pixel data.
+
+    Only the header is parsed when the reader is created. Native pixel data is sliced at the frame offset, for
+    encapsulated (compressed) pixel data the fragment table is walked once and each frame is read from its own
+    fragments. Every frame comes back as a single frame dataset, so it decodes like any other CT slice.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        # Reading stops in front of the pixel data element, its header tells where the pixel values start
+        with open(file_path, 'rb') as file:
+            self.header = pydicom.dcmread(file, stop_before_pixels=True)
+            self.offset = self.find_pixel_data(file)
+
+        self.n_frames = number_of_frames(self.header)
+        self.encapsulated = self.header.file_meta.TransferSyntaxUID.is_compressed
+
+        if self.encapsulated:
+            self.frame_fragments = self.find_frame_fragments()
+        else:
+            rows, columns = int(self.header.Rows), int(self.header.Columns)
+            samples = int(self.header.get('SamplesPerPixel', 1))
+            self.frame_size = rows * columns * samples * int(self.header.BitsAllocated) // 8
+
+    def __len__(self):
+        return self.n_frames
+
+    def find_pixel_data(self, file):
+        tag, _ = read_item_header(file, self.header.is_little_endian)
+        if tag != PIXEL_DATA:
+            raise ValueError(f"{self.file_path} has no pixel data")
+
+        # Explicit VR OB/OW elements have a 4 byte length after the VR and two reserved bytes
+        if not self.header.is_implicit_VR:
+            file.seek(4, 1)
+
+        return file.tell()
+
+    def find_frame_fragments(self):
+        # (offset, length) of the fragments of every frame, grouped by the basic offset table when there is one
+        with open(self.file_path, 'rb') as file:
+            file.seek(self.offset)
+
+            _, table_length = read_item_header(file)
+            table = struct.unpack(f'<{table_length // 4}L', file.read(table_length))
+
+            first_fragment = file.tell()
+            fragments = []
+
+            while True:
+                tag, length = read_item_header(file)
+                if tag == SEQUENCE_DELIMITER:
+                    break
+                if tag != ITEM:
+                    raise ValueError(f"{self.file_path} has malformed encapsulated pixel data")
+
+                fragments.append((file.tell(), length))
+                file.seek(length, 1)
+
+        if len(table) == self.n_frames:
+            frame_starts = [first_fragment + offset + 8 for offset in table]
+            frame_fragments = [[] for _ in range(self.n_frames)]
+
+            frame = 0
+            for fragment in fragments:
+                while frame + 1 < self.n_frames and fragment[0] >= frame_starts[frame + 1]:
+                    frame += 1
+                frame_fragments[frame].append(fragment)
+
+            return frame_fragments
+
+        if len(fragments) == self.n_frames:
+            return [[fragment] for fragment in fragments]
+
+        raise ValueError(f"{self.file_path}: cannot locate {self.n_frames} frames in {len(fragments)} fragments")
+
+    def frame_bytes(self, frame):
+        if not 0 <= frame < self.n_frames:
+            raise IndexError(f"Frame {frame} out of range, {self.file_path} has {self.n_frames} frames")
+
+        # A new handle per read, frames are read from the ingest pipeline and the viewer at the same time
+        with open(self.file_path, 'rb') as file:
+            if not self.encapsulated:
+                file.seek(self.offset + frame * self.frame_size)
+                return file.read(self.frame_size)
+
+            data = b''
+            for offset, length in self.frame_fragments[frame]:
+                file.seek(offset)
+                data += file.read(length)
+            return data
+
+    def frame_dataset(self, frame):
+        """ One frame as a single frame dataset with its own position and rescale """
+        frame_data = frame_header(self.header, frame)
+        frame_data.file_meta = self.header.file_meta
+        frame_data.is_little_endian = self.header.is_little_endian
+        frame_data.is_implicit_VR = self.header.is_implicit_VR
+
+        if self.encapsulated:
+            frame_data.add_new(PIXEL_DATA, 'OB', encapsulate([self.frame_bytes(frame)]))
+            frame_data[PIXEL_DATA].is_undefined_length = True
+        else:
+            frame_data.add_new(PIXEL_DATA, 'OW' if int(self.header.BitsAllocated) > 8 else 'OB', self.frame_bytes(frame))
+
+        return frame_data
+
+
+@lru_cache(maxsize=OPEN_FILES)
+def open_frames(file_path):
+    return FrameReader(file_path)
+
+
+def read_dataset(file_path, frame=-1):
+    """ The dataset of one slice, a whole file for single frame files or one frame (counted from 0) of a multi-frame file """
+    if frame < 0:
+        return pydicom.dcmread(file_path)
+
+    return open_frames(file_path).frame_dataset(frame)
@@ -0,0 +1,270 @@
+import queue
+import threading
+import multiprocessing
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from functions import BoxTracker
+from metrics import ALL_METRICS
+from multiframe import read_dataset
+from series_index import slice_name
+from volume import SliceData, hu_to_int16
+
+
+# Items waiting between two stages, bounds the memory a running pipeline holds
+QUEUE_SIZE = 8
+
+# How long a blocked stage waits before checking whether the pipeline was stopped, in seconds
+POLL_SECONDS = 0.1
+
+# Marks the end of the stream
+DONE = object()
+
+
+def pool_context():
+    # Stage pools are started from pipeline threads while Tk and the loader hold locks of their own, a forked child
+    # could inherit one of them locked and hang, so workers come from a clean server process instead. Windows has
+    # no forkserver, spawn starts the same clean workers there
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def stage_pool(workers):
+    """ Process pool for the stages, starting one takes seconds so a load makes one and hands it to every process_slices call """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+
+
+class StageError:
+    # Carries an exception raised in a stage down to the consumer
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    fn (callable): Takes an item and returns the processed item, must be picklable by reference, a module level
+        function or an instance of a module level class, when workers > 1.
+    workers (int): With more than one worker the items are processed in a process pool, still in order.
+    pool (ProcessPoolExecutor | None): Pool to run in, see stage_pool, a new one is started for the run when None.
+    """
+
+    def __init__(self, fn, workers=1, pool=None):
+        self.fn = fn
+        self.workers = workers
+        self.pool = pool
+
+
+""" SLICE STAGES
+    Items are dicts describing one slice, each stage adds its results to the dict """
+
+def read_stage(item):
+    # Frames of a multi-frame file are read one at a time, the pipeline never holds more than its queues of them
+    item['dicom_data'] = read_dataset(item['file_path'], item['frame'])
+    return item
+
+
+def rescale_stage(item):
+    # Decoded and rescaled once, the later stages only read views of it
+    item['slice_data'] = SliceData.from_dataset(item.pop('dicom_data'))
+    return item
+
+
+def detect_stage(item):
+    item['bounding_boxes'], _, item['edge_points'] = item['slice_data'].detect()
+    return item
+
+
+class TrackStage:
+    # Detection seeded by the previous slice's boxes, keeps state so it always runs in a single worker
+    def __init__(self):
+        self.tracker = BoxTracker()
+
+    def __call__(self, item):
+        item['bounding_boxes'], _, item['edge_points'] = self.tracker.detect(item['slice_index'], item['slice_data'].hu)
+        return item
+
+
+class MetricsStage:
+    # Computes only the metrics its consumers asked for, see METRIC_STAGES
+    def __init__(self, metrics=ALL_METRICS):
+        self.metrics = metrics
+
+    def __call__(self, item):
+        item['metrics'] = None
+
+        if len(item['bounding_boxes']) == 2:
+            item['metrics'] = {
+                'file_name': item['file_name'],
+                'slice_index': item['slice_index'],
+                'bounding_boxes': item['bounding_boxes'],
+                'metrics': item['slice_data'].metrics(item['bounding_boxes'], self.metrics)
+            }
+
+        return item
+
+
+class SliceStage:
+    # Every stage of one slice in a single call, so a worker only sends back the int16 slice, its boxes and metrics
+    def __init__(self, metrics=ALL_METRICS):
+        self.metrics = MetricsStage(metrics)
+
+    def __call__(self, item):
+        item = self.metrics(detect_stage(rescale_stage(read_stage(item))))
+
+        # The volume stores int16 anyway, a float32 rescale is rounded here rather than sent back at twice the size
+        slice_data = item['slice_data']
+        if slice_data.hu.dtype != np.int16:
+            item['slice_data'] = SliceData(hu_to_int16(slice_data.hu), slice_data.header)
+
+        return item
+
+
+def slice_stages(workers=1, track=False, metrics=ALL_METRICS, pool=None):
+    # read -> rescale -> detect -> metrics, each in its own thread, or all of them in a worker for every slice
+    # when there are several processes, so none of the stages stays serial and no HU slice is pickled on the way in
+    if track:
+        return [Stage(read_stage), Stage(rescale_stage), Stage(TrackStage()), Stage(MetricsStage(metrics))]
+
+    if workers > 1:
+        return [Stage(SliceStage(metrics), workers, pool)]
+
+    return [Stage(read_stage), Stage(rescale_stage), Stage(detect_stage), Stage(MetricsStage(metrics))]
+
+
+def slice_items(series, indices):
+    for i in indices:
+        file_path, frame = series.file_paths[i], int(series.frames[i])
+        yield {'slice_index': i, 'file_path': file_path, 'frame': frame, 'file_name': slice_name(file_path, frame)}
+
+
+def process_slices(series, indices, workers=1, track=False, metrics=ALL_METRICS, pool=None):
+    """
+    Runs the slice stages over the given slices of a SeriesIndex or Volume, yielding the finished items in slice order.
+    pool is a stage_pool of workers processes kept across calls, without it every call with workers > 1 starts its own.
+    """
+    return run_pipeline(slice_items(series, indices), slice_stages(workers, track, metrics, pool))
+
+
+def read_slices(series, indices):
+    """ Only the read and rescale stages, for detectors that take the whole volume at once, see volume_detection """
+    return run_pipeline(slice_items(series, indices), [Stage(read_stage), Stage(rescale_stage)])
+
+
+""" PIPELINE RUNNER """
+
+def put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+
+
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
+
+    return DONE
+
+
+def feed(source, q_out, stop):
+    try:
+        for item in source:
+            if stop.is_set():
+                return
+            put(q_out, item, stop)
+
+        put(q_out, DONE, stop)
+
+    except Exception as e:
+        put(q_out, StageError(e), stop)
+
+
+def run_stage(stage, q_in, q_out, stop, queue_size):
+    executor = None
+    if stage.workers > 1:
+        executor = stage.pool if stage.pool is not None else stage_pool(stage.workers)
+    pending = deque()
+
+    try:
+        while True:
+            item = get(q_in, stop)
+
+            if item is DONE or isinstance(item, StageError):
+                break
+
+            if executor is None:
+                put(q_out, stage.fn(item), stop)
+                continue
+
+            # Submit ahead of the consumer but keep the number of items in flight bounded
+            pending.append(executor.submit(stage.fn, item))
+
+            if len(pending) >= stage.workers + queue_size:
+                put(q_out, pending.popleft().result(), stop)
+
+        while pending and not stop.is_set():
+            put(q_out, pending.popleft().result(), stop)
+
+        put(q_out, item, stop)
+
+    except Exception as e:
+        put(q_out, StageError(e), stop)
+
+    finally:
+        # A shared pool outlives the run, only the items this run submitted are dropped
+        for future in pending:
+            future.cancel()
+
+        if executor is not None and executor is not stage.pool:
+            executor.shutdown(cancel_futures=True)
+
+
+def run_pipeline(source, stages, queue_size=QUEUE_SIZE):
+    """
+    Stream items through stages that run concurrently, each in its own thread.
+
+    Stages are connected by bounded queues so a slow stage holds back the ones before it instead of letting
+    items pile up. Items come out in the order they went in. Closing the generator early stops every stage.
+
+    Parameters:
+    source (iterable): Items to process.
+    stages (list of Stage): Stages in order.
+    queue_size (int): Capacity of each queue between two stages.
+
+    Returns:
+    generator: The items as they leave the last stage.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+
+    threads = [threading.Thread(target=feed, args=(source, queues[0], stop), daemon=True)]
+    for stage, q_in, q_out in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=run_stage, args=(stage, q_in, q_out, stop, queue_size), daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get(queues[-1], stop)
+
+            if item is DONE:
+                return
+
+            if isinstance(item, StageError):
+                raise item.error
+
+            yield item
+
+    finally:
+        stop.set()
@@ -0,0 +1,321 @@
+import numpy as np
+
+from typing import List
+
+from metrics import require_metrics
+from series_index import slice_number
+
+
+""" PARAMETERS
+    Defaults of the recommender, every function below takes them as keyword arguments """
+
+# A run of at least this many slices without two knee boxes separates the regions the plateau is searched between
+GAP_SLICES = 100
+
+# Values of a box that can be part of a plateau
+INTENSITY_RANGE = (7000, 13000)
+
+# Mean height a plateau must have
+HEIGHT_RANGE = (9000, 12000)
+
+# Steepest slope of a plateau, in gray pixels per slice
+MAX_SLOPE = 250
+
+# Plateaus are runs longer than this many slices
+MIN_LENGTH = 5
+
+# Number of ranked candidate slices, the recommended one included
+CANDIDATES = 5
+
+# The metric the plateaus are found in
+METRIC = 'gray_pixels'
+
+
+""" PLATEAUS """
+
+def find_segment_runs(metrics_values, start_index, end_index, intensity_range=INTENSITY_RANGE, min_length=MIN_LENGTH):
+    """ Runs of values inside intensity_range longer than min_length, as (starts, stops) index arrays """
+    values = np.asarray(metrics_values)[start_index:end_index]
+    in_range = (intensity_range[0] <= values) & (values <= intensity_range[1])
+
+    # Run length encoding of the mask, +1 where a run starts and -1 one past where it ends
+    changes = np.diff(np.concatenate(([0], in_range.astype(np.int8), [0])))
+    starts = np.flatnonzero(changes == 1)
+    stops = np.flatnonzero(changes == -1)
+
+    # Only runs longer than min_length are kept
+    keep = stops - starts > min_length
+    return starts[keep] + start_index, stops[keep] + start_index
+
+
+def fit_segments(metrics_values, starts, stops):
+    """ Least squares line of every run at once, returns the slopes and mean heights of the lines """
+    values = np.asarray(metrics_values)
+    dtype = np.int64 if np.issubdtype(values.dtype, np.integer) else np.float64
+
+    # Prefix sums of y and x * y, the sums of any run are then one difference each
+    x = np.arange(len(values), dtype=dtype)
+    sum_y = np.concatenate(([0], np.cumsum(values, dtype=dtype)))
+    sum_xy = np.concatenate(([0], np.cumsum(x * values, dtype=dtype)))
+
+    n = stops - starts
+    run_y = sum_y[stops] - sum_y[starts]
+    run_xy = sum_xy[stops] - sum_xy[starts]
+
+    # x are consecutive integers, centred on the middle of the run they sum to n (n^2 - 1) / 12 when squared
+    centred_xy = 2 * run_xy - (starts + stops - 1) * run_y
+    slopes = 6 * centred_xy / (n * (n * n - 1))
+
+    # A least squares line passes through the mean of the run, so the line's mean height is the run's mean
+    means = run_y / n
+    return slopes, means
+
+
+def find_plateaus(metrics_values, start_index, end_index, intensity_range=INTENSITY_RANGE,
+                  height_range=HEIGHT_RANGE, max_slope=MAX_SLOPE, min_length=MIN_LENGTH):
+    """ Flat runs at plateau height, returns (starts, stops, slopes, means) of the accepted runs """
+    starts, stops = find_segment_runs(metrics_values, start_index, end_index, intensity_range, min_length)
+    slopes, means = fit_segments(metrics_values, starts, stops)
+
+    accepted = (np.abs(slopes) < max_slope) & (height_range[0] <= means) & (means <= height_range[1])
+    return starts[accepted], stops[accepted], slopes[accepted], means[accepted]
+
+
+def find_gaps(slice_indices, gap_slices=GAP_SLICES, first_slice=0) -> List:
+    """
+    Positions of the slices that follow a run of at least gap_slices slices without two boxes.
+
+    first_slice is the first slice that was searched, the start of the knee range of a pruned scan. The run
+    before the first slice with two boxes is counted from there, not from the start of the scan.
+    """
+    slice_indices = np.asarray(slice_indices, dtype=int)
+
+    # Counted from the slice before the first searched one, as if it had two boxes
+    prev_indices = np.concatenate(([first_slice - 1], slice_indices[:-1]))
+    return np.flatnonzero(prev_indices + gap_slices <= slice_indices).tolist()
+
+
+def series_plateaus(series, gap_slices=GAP_SLICES, intensity_range=INTENSITY_RANGE, height_range=HEIGHT_RANGE,
+                    max_slope=MAX_SLOPE, min_length=MIN_LENGTH, metric=METRIC, first_slice=0):
+    """
+    Plateaus of both boxes between the first two gaps of a metric series.
+
+    Returns:
+    list or None: Per box the (starts, stops, slopes, means) of find_plateaus, positions in the series. None when
+    the series has fewer than two gaps. ValueError if the series does not hold the metric.
+    """
+    require_metrics(series, [metric])
+
+    gaps = find_gaps(series['slice_index'], gap_slices, first_slice)
+    if len(gaps) < 2:
+        return None
+
+    values = series['metrics'][metric]
+    return [find_plateaus(values[:, box], gaps[0], gaps[1], intensity_range, height_range, max_slope, min_length)
+            for box in range(2)]
+
+
+def plateau_median(plateaus) -> int:
+    """ Position halfway between the first and last slice of all plateaus, stops are one past the last slice """
+    min_index = min(starts.min() for starts, _, _, _ in plateaus)
+    max_index = max(stops.max() for _, stops, _, _ in plateaus) - 1
+    return int(np.median([min_index, max_index]))
+
+
+""" RANKING """
+
+def rank_candidates(plateaus, median_index, n_candidates=CANDIDATES, height_range=HEIGHT_RANGE,
+                    max_slope=MAX_SLOPE) -> List:
+    """
+    The recommended position followed by the positions around it most likely to be the right slice instead.
+
+    Every position between the first and last plateau slice is scored by the plateaus of both boxes covering it:
+    how flat they are, how close their mean is to the middle of height_range and whether both boxes agree.
+    The score falls off with the distance to the recommended position, which is always ranked first. A
+    recommended position between plateaus, covered by neither box, gets the score of the nearest plateau slice.
+
+    Parameters:
+    plateaus (list): Per box, the (starts, stops, slopes, means) arrays of find_plateaus, none of them empty.
+    median_index (int): Recommended position.
+    n_candidates (int): Number of candidates returned at most.
+
+    Returns:
+    list of (int, float): (position, confidence) pairs, best first, confidences in [0, 1].
+    """
+    min_index = min(starts.min() for starts, _, _, _ in plateaus)
+    max_index = max(stops.max() for _, stops, _, _ in plateaus) - 1
+    positions = np.arange(min_index, max_index + 1)
+
+    height_middle = (height_range[0] + height_range[1]) / 2
+    height_half_range = (height_range[1] - height_range[0]) / 2
+
+    covered = np.zeros((len(plateaus), len(positions)))
+    flatness = np.zeros((len(plateaus), len(positions)))
+    height = np.zeros((len(plateaus), len(positions)))
+
+    for box, (starts, stops, slopes, means) in enumerate(plateaus):
+        for start, stop, slope, mean in zip(starts - min_index, stops - min_index, slopes, means):
+            covered[box, start:stop] = 1
+            flatness[box, start:stop] = 1 - abs(slope) / max_slope
+            height[box, start:stop] = 1 - abs(mean - height_middle) / height_half_range
+
+    quality = (flatness.mean(axis=0) + height.mean(axis=0) + covered.mean(axis=0)) / 3
+    centrality = 1 - np.abs(positions - median_index) / ((max_index - min_index) / 2 + 1)
+    scores = quality * centrality
+
+    # Stable, so equal scores keep the earlier position
+    ranked = [median_index] + [p for p in positions[np.argsort(-scores, kind='stable')].tolist()
+                               if p != median_index and scores[p - min_index] > 0]
+
+    median_score = scores[median_index - min_index]
+    if not covered[:, median_index - min_index].any():
+        # The nearest plateau slice, the earlier one on ties
+        on_plateau = np.flatnonzero(covered.any(axis=0))
+        median_score = scores[on_plateau[np.argmin(np.abs(on_plateau + min_index - median_index))]]
+
+    return [(p, float(median_score if p == median_index else scores[p - min_index])) for p in ranked[:n_candidates]]
+
+
+""" RECOMMENDER """
+
+def recommend(series, gap_slices=GAP_SLICES, intensity_range=INTENSITY_RANGE, height_range=HEIGHT_RANGE,
+              max_slope=MAX_SLOPE, min_length=MIN_LENGTH, n_candidates=CANDIDATES, first_slice=0) -> List:
+    """
+    Ranked candidate slices of a study from its metric series alone, no pixels are read.
+
+    The plateaus of both boxes are searched between the first two gaps, the recommended slice is halfway
+    between the first and last plateau slice and the others are ranked around it, see rank_candidates.
+
+    Parameters:
+    series (np.ndarray): SLICE_METRICS_DTYPE array in slice order, only slice_index and the metric are read, it must hold METRIC.
+    first_slice (int): First slice that was searched, see find_gaps.
+
+    Returns:
+    list of (int, float): (slice index, confidence) pairs, best first. Empty when the series has fewer than two
+    gaps or no plateau in either box.
+    """
+    plateaus = series_plateaus(series, gap_slices, intensity_range, height_range, max_slope, min_length,
+                               first_slice=first_slice)
+
+    if plateaus is None or any(len(starts) == 0 for starts, _, _, _ in plateaus):
+        return []
+
+    candidates = rank_candidates(plateaus, plateau_median(plateaus), n_candidates, height_range, max_slope)
+    return [(int(series['slice_index'][p]), confidence) for p, confidence in candidates]
+
+
+""" STREAMING """
+
+class SegmentStats:
+    # Running least squares sums of one run of in-range values, enough for its slope and mean in O(1)
+    def __init__(self):
+        self.n = 0
+        self.first = self.last = None
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, x, y):
+        if self.n == 0:
+            self.first = x
+        self.last = x
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    def slope(self):
+        return (self.n * self.sxy - self.sx * self.sy) / (self.n * self.sxx - self.sx * self.sx)
+
+    def mean(self):
+        return self.sy / self.n
+
+
+class IncrementalRecommender:
+    """
+    recommend for metrics that arrive one slice at a time, in slice order.
+
+    Gaps, the in-range runs of both boxes and their regression sums are updated with O(1) work per slice. The
+    recommendation only depends on the slices between the first two gaps, so it is emitted as soon as the
+    second gap is seen and is the same as recommend gives for the whole study, ranked candidates included.
+    """
+
+    def __init__(self, gap_slices=GAP_SLICES, intensity_range=INTENSITY_RANGE, height_range=HEIGHT_RANGE,
+                 max_slope=MAX_SLOPE, min_length=MIN_LENGTH, n_candidates=CANDIDATES, metric=METRIC, first_slice=0):
+        self.gap_slices = gap_slices
+        self.intensity_range = intensity_range
+        self.height_range = height_range
+        self.max_slope = max_slope
+        self.min_length = min_length
+        self.n_candidates = n_candidates
+        self.metric = metric
+
+        self.position = 0
+        # Slice numbers count from 1, so this is the number of the slice before first_slice, see find_gaps
+        self.prev_file_number = first_slice
+        self.gaps = []
+        self.slice_numbers = []
+
+        self.runs = [SegmentStats(), SegmentStats()]
+        self.accepted = [[], []]
+
+        self.recommendation = None
+        self.confidence = None
+        self.candidates = []
+
+    def add(self, result):
+        """ Consume the metrics result of the next slice with two boxes, returns (index, confidence) once known """
+        if self.recommendation is not None:
+            return self.recommendation, self.confidence
+
+        file_number = slice_number(result)
+        self.slice_numbers.append(file_number)
+
+        if self.prev_file_number + self.gap_slices <= file_number:
+            self.gaps.append(self.position)
+        self.prev_file_number = file_number
+
+        if len(self.gaps) == 2:
+            for box in range(2):
+                self.close_run(box)
+            self.recommend()
+
+        elif len(self.gaps) == 1:
+            for box in range(2):
+                value = result['metrics'][box][self.metric]
+
+                if self.intensity_range[0] <= value <= self.intensity_range[1]:
+                    self.runs[box].add(self.position, value)
+                else:
+                    self.close_run(box)
+
+        self.position += 1
+
+        if self.recommendation is None:
+            return None
+        return self.recommendation, self.confidence
+
+    def close_run(self, box):
+        run = self.runs[box]
+
+        # find_segment_runs keeps runs longer than min_length
+        if run.n > self.min_length:
+            slope = run.slope()
+            if abs(slope) < self.max_slope and self.height_range[0] <= run.mean() <= self.height_range[1]:
+                self.accepted[box].append((run.first, run.last, slope, run.mean()))
+
+        self.runs[box] = SegmentStats()
+
+    def recommend(self):
+        if not self.accepted[0] or not self.accepted[1]:
+            self.recommendation = -1  # Both gaps seen but no plateau, nothing later can change that
+            self.confidence = 0.0
+            return
+
+        # The same ranking recommend makes, from the accepted runs in find_plateaus' layout
+        plateaus = [tuple(np.array(column) for column in zip(*segments)) for segments in self.accepted]
+        plateaus = [(firsts, lasts + 1, slopes, means) for firsts, lasts, slopes, means in plateaus]
+
+        self.candidates = [(self.slice_numbers[p] - 1, confidence)
+                           for p, confidence in rank_candidates(plateaus, plateau_median(plateaus), self.n_candidates,
+                                                                self.height_range, self.max_slope)]
+        self.recommendation, self.confidence = self.candidates[0]
@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import pydicom
+
+from multiframe import MULTIFRAME_TAGS, is_multiframe, number_of_frames, frame_header
+
+
+# Only these tags are parsed in the header pre-pass, the pixel data is never read
+HEADER_TAGS = [
+    'SeriesInstanceUID',
+    'SeriesNumber',
+    'InstanceNumber',
+    'ImagePositionPatient',
+    'ImageOrientationPatient',
+    'SliceLocation',
+    'SliceThickness',
+    'Rows',
+    'Columns',
+] + MULTIFRAME_TAGS
+
+# A step between neighbouring slices this many times the typical spacing is reported as a gap
+GAP_TOLERANCE = 1.5
+
+
+class SeriesIndex:
+    """
+    Slices of one series ordered along the scan axis.
+
+    file_paths (list of str): Slice files in scan order, a multi-frame file is listed once per frame.
+    frames (np.ndarray): Frame of each slice within its file counted from 0, -1 for single frame files.
+    positions (np.ndarray): Position of each slice along the slice normal in mm, NaN if unknown.
+    instance_numbers (np.ndarray): InstanceNumber of each slice, -1 if missing.
+    spacing (float | None): Typical distance between neighbouring slices in mm.
+    gaps (list of int): Indices of the slices that follow a missing run of slices, the loader warns about them.
+    """
+
+    def __init__(self, series_uid, file_paths, positions, instance_numbers, slice_thickness=None, shape=None, frames=None):
+        self.series_uid = series_uid
+        self.file_paths = file_paths
+        self.frames = np.asarray(frames, dtype=int) if frames is not None else np.full(len(file_paths), -1)
+        self.positions = positions
+        self.instance_numbers = instance_numbers
+        self.slice_thickness = slice_thickness
+        self.shape = shape
+
+        self.spacing, self.gaps = find_spacing_and_gaps(positions)
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+def slice_name(file_path, frame=-1):
+    name = os.path.basename(file_path)
+    return name if frame < 0 else f"{name} frame {frame + 1}"
+
+
+def read_header(file_path):
+    return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+
+def slice_position(header):
+    # Project the slice origin onto the slice normal, this is orientation independent unlike SliceLocation
+    if 'ImagePositionPatient' in header and 'ImageOrientationPatient' in header:
+        orientation = np.array(header.ImageOrientationPatient, dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        return float(np.dot(normal, np.array(header.ImagePositionPatient, dtype=float)))
+
+    if 'SliceLocation' in header:
+        return float(header.SliceLocation)
+
+    return np.nan
+
+
+def file_number(file_path):
+    # Number at the end of the IMG-xxxx-NNNNN.dcm file names, used only when the headers have no ordering
+    try:
+        return int(os.path.basename(file_path).split('-')[-1].split('.')[0])
+    except ValueError:
+        return -1
+
+
+def find_spacing_and_gaps(positions):
+    if len(positions) < 2 or np.isnan(positions).any():
+        return None, []
+
+    steps = np.abs(np.diff(positions))
+    spacing = float(np.median(steps))
+
+    if spacing == 0:
+        return None, []
+
+    gaps = (np.nonzero(steps > spacing * GAP_TOLERANCE)[0] + 1).tolist()
+    return spacing, gaps
+
+
+def order_slices(file_paths, positions, instance_numbers, frames):
+    if not np.isnan(positions).any():
+        order = np.argsort(positions, kind='stable')
+
+        # Keep the acquisition direction so the first slice is the one the scanner numbered first
+        if instance_numbers[order[0]] > instance_numbers[order[-1]]:
+            order = order[::-1]
+
+    elif (instance_numbers >= 0).all():
+        order = np.argsort(instance_numbers, kind='stable')
+
+    else:
+        order = sorted(range(len(file_paths)), key=lambda i: (file_number(file_paths[i]), file_paths[i], frames[i]))
+
+    return np.asarray(order, dtype=int)
+
+
+def list_dicom_files(folder_path, recursive=False):
+    if not recursive:
+        return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.dcm'))
+
+    dicom_files = []
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            if file.endswith('.dcm'):
+                dicom_files.append(os.path.join(root, file))
+
+    return sorted(dicom_files)
+
+
+def scan_series(folder_path, recursive=False, check=None):
+    """
+    Read the headers of every .dcm file in a folder and index them by series.
+
+    Every frame of an Enhanced CT multi-frame file is indexed as its own slice, positioned from its functional groups.
+
+    Parameters:
+    folder_path (str): Folder containing the .dcm files.
+    recursive (bool): Also scan sub folders.
+    check (callable | None): Called before each header is read, may raise to stop the scan, e.g. on cancel.
+
+    Returns:
+    list of SeriesIndex: One index per series, the series with the most slices first.
+    """
+    series = {}
+
+    for file_path in list_dicom_files(folder_path, recursive):
+        if check is not None:
+            check()
+
+        header = read_header(file_path)
+
+        if 'Rows' not in header:
+            continue  # Not an image, e.g. a structured report
+
+        series_uid = header.get('SeriesInstanceUID', '')
+        entry = series.setdefault(series_uid, {'file_paths': [], 'frames': [], 'positions': [], 'instance_numbers': [], 'thickness': None, 'shape': None})
+
+        if is_multiframe(header):
+            slices = [(frame, frame_header(header, frame)) for frame in range(number_of_frames(header))]
+        else:
+            slices = [(-1, header)]
+
+        for frame, slice_header in slices:
+            entry['file_paths'].append(file_path)
+            entry['frames'].append(frame)
+            entry['positions'].append(slice_position(slice_header))
+            entry['instance_numbers'].append(int(slice_header.InstanceNumber) if slice_header.get('InstanceNumber') is not None else -1)
+
+            if entry['thickness'] is None and slice_header.get('SliceThickness') is not None:
+                entry['thickness'] = float(slice_header.SliceThickness)
+
+        if entry['shape'] is None:
+            entry['shape'] = (int(header.Rows), int(header.Columns))
+
+    indices = []
+    for series_uid, entry in series.items():
+        positions = np.array(entry['positions'], dtype=float)
+        instance_numbers = np.array(entry['instance_numbers'], dtype=int)
+        frames = np.array(entry['frames'], dtype=int)
+        order = order_slices(entry['file_paths'], positions, instance_numbers, frames)
+
+        indices.append(SeriesIndex(
+            series_uid,
+            [entry['file_paths'][i] for i in order],
+            positions[order],
+            instance_numbers[order],
+            entry['thickness'],
+            entry['shape'],
+            frames[order],
+        ))
+
+    indices.sort(key=len, reverse=True)
+    return indices
+
+
+def index_folder(folder_path, recursive=False, check=None):
+    """ The series to process in a folder, i.e. the one with the most slices, check as in scan_series """
+    indices = scan_series(folder_path, recursive, check)
+
+    if not indices:
+        raise ValueError(f"No DICOM images found in {folder_path}")
+
+    return indices[0]
+
+
+def slice_number(result):
+    # Position of a processed slice in its series counted from 1, like the IMG-xxxx-NNNNN file numbers
+    if isinstance(result, np.void):
+        return int(result['slice_index']) + 1
+
+    if 'slice_index' in result:
+        return result['slice_index'] + 1
+
+    return int(result['file_name'].split(".")[0][-3:])
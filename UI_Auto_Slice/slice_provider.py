@@ -0,0 +1,103 @@
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import window_image
+
+
+# Number of windowed display frames kept in memory
+SLICE_CACHE_SIZE = 32
+
+# Number of slices rendered ahead of the current one in the scroll direction
+PREFETCH_SLICES = 4
+
+
+class SliceProvider:
+    """
+    Display frames of a Volume rendered on demand.
+
+    Slices the loader has not filled in yet are decoded from their file, every frame is windowed only when
+    first asked for and the most recently used frames are kept in a bounded LRU. After each request the next
+    slices in the scroll direction are rendered on a background thread so scrolling does not wait on them.
+    Pinned frames, such as the candidate slices, are never evicted.
+    """
+
+    def __init__(self, volume, cache_size=SLICE_CACHE_SIZE, prefetch=PREFETCH_SLICES):
+        self.volume = volume
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+
+        self.frames = OrderedDict()
+        self.pending = set()
+        self.pinned = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.volume)
+
+    def get(self, index, direction=0):
+        """ The display frame of a slice, direction is +1/-1 for the scroll direction or 0 to prefetch both ways """
+        frame = self.cached(index)
+
+        if frame is None:
+            frame = self.render(index)
+
+        if direction >= 0:
+            self.prefetch_range(range(index + 1, index + 1 + self.prefetch))
+        if direction <= 0:
+            self.prefetch_range(range(index - 1, index - 1 - self.prefetch, -1))
+
+        return frame
+
+    def prefetch_range(self, indices):
+        for index in indices:
+            if not 0 <= index < len(self.volume):
+                break
+
+            with self.lock:
+                if index in self.frames or index in self.pending:
+                    continue
+                self.pending.add(index)
+
+            self.executor.submit(self.render, index)
+
+    def pin(self, indices):
+        """ Keeps these slices in memory for the life of the viewer, rendering them in the background now """
+        indices = [index for index in indices if 0 <= index < len(self.volume)]
+        with self.lock:
+            self.pinned.update(indices)
+        self.prefetch_range(indices)
+
+    def cached(self, index):
+        with self.lock:
+            frame = self.frames.get(index)
+            if frame is not None:
+                self.frames.move_to_end(index)
+            return frame
+
+    def render(self, index):
+        try:
+            if not self.volume.is_loaded(index):
+                self.volume.load_slice(index)
+
+            frame = window_image(self.volume.hu[index])
+
+            with self.lock:
+                self.frames[index] = frame
+                self.frames.move_to_end(index)
+
+                # Oldest unpinned frames first, the pinned ones do not count against the cache size
+                unpinned = [i for i in self.frames if i not in self.pinned]
+                for i in unpinned[:max(len(unpinned) - self.cache_size, 0)]:
+                    del self.frames[i]
+
+            return frame
+
+        finally:
+            with self.lock:
+                self.pending.discard(index)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
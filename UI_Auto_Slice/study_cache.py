@@ -0,0 +1,48 @@
+import pickle
+
+
+# Bump whenever the cached tuple or any object pickled in it changes, caches of another version are rejected
+CACHE_VERSION = 1
+
+
+class CacheVersionError(ValueError):
+    """ The cache file was written by another version of the viewer, the folder has to be processed again """
+
+
+def cache_path(folder_path):
+    return f"{folder_path}_cache.pkl"
+
+
+def write_cache(path, volume, recc_file_no, detections, metrics, first_slice):
+    """
+    Pickle a processed study for the viewer and tune_recommender to load.
+
+    Parameters:
+    path (str): Cache file, see cache_path.
+    volume (Volume): HU pixels and headers of the series.
+    recc_file_no (int): Recommended slice index, -1 if none was found.
+    detections (DetectionIndex): Boxes and edge points of the processed slices.
+    metrics (np.ndarray): Metric series of the processed slices, see slice_metrics_dtype.
+    first_slice (int): First slice of the knee range the recommendation was searched in.
+    """
+    with open(path, 'wb') as f:
+        pickle.dump((CACHE_VERSION, volume, recc_file_no, detections, metrics, first_slice), f)
+
+
+def read_cache(path):
+    """
+    The (volume, recc_file_no, detections, metrics, first_slice) of a cache file written by write_cache.
+
+    Raises CacheVersionError for a cache of another version, including the unversioned ones of the first
+    releases, or a file that is not a cache at all.
+    """
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        raise CacheVersionError(f"{path} is not a readable cache: {e}") from e
+
+    if not isinstance(cached, tuple) or len(cached) != 6 or cached[0] != CACHE_VERSION:
+        raise CacheVersionError(f"{path} is not a version {CACHE_VERSION} cache")
+
+    return cached[1:]
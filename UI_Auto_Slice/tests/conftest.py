@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live flat in UI_Auto_Slice and import each other by name, like the application runs them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
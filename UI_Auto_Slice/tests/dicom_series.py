@@ -0,0 +1,86 @@
+import os
+import numpy as np
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+
+# Stored as unsigned values from air up, like most scanners write CT
+RESCALE_INTERCEPT = -1024
+
+SLICE_SPACING_MM = 2.0
+
+AXIAL = [1, 0, 0, 0, 1, 0]
+
+
+def write_slice(path, hu_image, series_uid, position=None, instance_number=None, slice_location=None,
+                thickness=SLICE_SPACING_MM, orientation=AXIAL):
+    """ One single frame CT file, the optional tags are left out when None """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SeriesInstanceUID = series_uid
+    ds.Rows, ds.Columns = hu_image.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+    ds.PixelRepresentation = 0
+    ds.RescaleSlope = 1
+    ds.RescaleIntercept = RESCALE_INTERCEPT
+
+    if position is not None:
+        ds.ImagePositionPatient = [0, 0, position]
+        ds.ImageOrientationPatient = orientation
+    if instance_number is not None:
+        ds.InstanceNumber = instance_number
+    if slice_location is not None:
+        ds.SliceLocation = slice_location
+    if thickness is not None:
+        ds.SliceThickness = thickness
+
+    stored = np.clip(np.rint(hu_image) - RESCALE_INTERCEPT, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    ds.PixelData = stored.tobytes()
+    ds['PixelData'].VR = 'OW'
+
+    ds.save_as(path, write_like_original=False)
+    return path
+
+
+def write_series(folder, hu_slices, positions='default', instance_numbers='default', file_names=None,
+                 series_uid=None, **tags):
+    """
+    A folder of single frame files, slice i at z = -i * SLICE_SPACING_MM with InstanceNumber i + 1 by default.
+
+    Pass positions or instance_numbers as None to leave the tag out of every file, file_names default to the
+    IMG-0001-NNNNN.dcm names of the scanner exports. Returns the file paths in slice order.
+    """
+    os.makedirs(folder, exist_ok=True)
+    n_slices = len(hu_slices)
+    series_uid = series_uid or generate_uid()
+
+    if positions == 'default':
+        positions = [-i * SLICE_SPACING_MM for i in range(n_slices)]
+    if instance_numbers == 'default':
+        instance_numbers = list(range(1, n_slices + 1))
+    if file_names is None:
+        file_names = [f'IMG-0001-{i + 1:05d}.dcm' for i in range(n_slices)]
+
+    paths = []
+    for i, hu_image in enumerate(hu_slices):
+        paths.append(write_slice(os.path.join(folder, file_names[i]), hu_image, series_uid,
+                                 None if positions is None else positions[i],
+                                 None if instance_numbers is None else instance_numbers[i], **tags))
+    return paths
+
+
+def constant_slices(n_slices, shape=(8, 8)):
+    # Slice i is filled with the HU value i, so a decoded slice tells which file it came from
+    return [np.full(shape, i, dtype=np.int16) for i in range(n_slices)]
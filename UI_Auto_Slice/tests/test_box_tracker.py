@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import functions
+
+from functions import BoxTracker, TRACK_MARGIN, detect_knee_bounding_boxes_hu
+from test_pyramid_detection import AIR_HU, knee_phantom, points_in_boxes
+
+
+def drifting_stack(n_slices, seed=0, step=1):
+    # The same knees moving step pixels to the right per slice, like neighbouring slices of a slightly tilted leg
+    base = knee_phantom(seed)
+    return [np.roll(base, i * step, axis=1) for i in range(n_slices)]
+
+
+@pytest.fixture
+def full_detections(monkeypatch):
+    # Slices the tracker ran a full frame detection on, in order
+    detected = []
+
+    def detect(hu_image, *args, **kwargs):
+        detected.append(hu_image)
+        return detect_knee_bounding_boxes_hu(hu_image, *args, **kwargs)
+
+    monkeypatch.setattr(functions, 'detect_knee_bounding_boxes_hu', detect)
+    return detected
+
+
+def assert_tracked_like_untracked(tracker, index, hu_image):
+    bounding_boxes, _, edge_points = tracker.detect(index, hu_image)
+    expected_boxes, _, expected_edge_points = detect_knee_bounding_boxes_hu(hu_image)
+
+    assert bounding_boxes == expected_boxes
+    # Tracked slices only trace around the knee, the points inside the boxes are the full frame ones
+    assert points_in_boxes(edge_points) == points_in_boxes(expected_edge_points)
+    for box in range(len(bounding_boxes)):
+        np.testing.assert_array_equal(edge_points.box(box), expected_edge_points.box(box))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_tracked_boxes_match_untracked(seed, full_detections):
+    tracker = BoxTracker()
+    stack = drifting_stack(12, seed)
+
+    for i, hu_image in enumerate(stack):
+        assert_tracked_like_untracked(tracker, i, hu_image)
+
+    # Only the first slice needed a full frame detection
+    assert len(full_detections) == 1 and full_detections[0] is stack[0]
+
+
+def test_refresh_runs_a_full_detection(full_detections):
+    tracker = BoxTracker(refresh=4)
+    stack = drifting_stack(10)
+
+    for i, hu_image in enumerate(stack):
+        assert_tracked_like_untracked(tracker, i, hu_image)
+
+    assert [any(d is s for d in full_detections) for s in stack] == [i % 5 == 0 for i in range(10)]
+
+
+def test_missed_knee_is_detected_again(full_detections):
+    tracker = BoxTracker()
+    stack = drifting_stack(8)
+    # One knee is missing from slice 3, e.g. the slice is past the end of one bone
+    stack[3] = stack[3].copy()
+    stack[3][:, 256:] = AIR_HU
+
+    for i, hu_image in enumerate(stack):
+        assert_tracked_like_untracked(tracker, i, hu_image)
+
+    # The tracked search of slice 3 found a single box, slice 4 has no two boxes to track from
+    assert [any(d is s for d in full_detections) for s in stack] == [i in (0, 3, 4) for i in range(8)]
+
+
+def test_jump_past_the_search_window_is_detected_again(full_detections):
+    tracker = BoxTracker()
+    stack = drifting_stack(4) + [np.roll(hu_image, 3 * TRACK_MARGIN, axis=1) for hu_image in drifting_stack(8)[4:]]
+
+    for i, hu_image in enumerate(stack):
+        assert_tracked_like_untracked(tracker, i, hu_image)
+
+    assert [any(d is s for d in full_detections) for s in stack] == [i in (0, 4) for i in range(8)]
+
+
+def test_skipped_slices_are_detected_again(full_detections):
+    tracker = BoxTracker()
+    stack = drifting_stack(8)
+
+    # The coarse pass visits every fourth slice, the previous boxes are not from a neighbour
+    for i in (0, 1, 4, 5):
+        assert_tracked_like_untracked(tracker, i, stack[i])
+
+    assert [any(d is stack[i] for d in full_detections) for i in (0, 1, 4, 5)] == [True, False, True, False]
@@ -0,0 +1,27 @@
+from detection_index import DetectionIndex
+
+
+TWO_BOXES = [(10, 10, 80, 80), (120, 10, 80, 80)]
+
+
+def index_with_valid(n_slices, valid):
+    detections = DetectionIndex(n_slices)
+    for i in range(n_slices):
+        detections.set(i, TWO_BOXES if i in valid else TWO_BOXES[:1], [])
+    return detections
+
+
+def test_nearest_valid_prefers_the_earlier_slice_on_ties():
+    assert index_with_valid(10, {3, 7}).nearest_valid(5) == 3
+
+
+def test_nearest_valid_does_not_move_further_than_max_distance():
+    detections = index_with_valid(40, {30})
+
+    assert detections.nearest_valid(5) == 30
+    assert detections.nearest_valid(5, max_distance=3) is None
+    assert detections.nearest_valid(27, max_distance=3) == 30
+
+
+def test_nearest_valid_without_valid_slices():
+    assert index_with_valid(10, set()).nearest_valid(5) is None
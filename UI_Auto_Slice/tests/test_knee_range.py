@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from dicom_series import write_series
+from knee_range import KNEE_HALF_RANGE_MM, SAFETY_MARGIN_MM, find_knee_range
+from series_index import index_folder
+
+
+SIZE = 64
+BONE = 1000
+SOFT_TISSUE = 40
+
+
+def leg_slices(n_slices, knee_slice):
+    """
+    Slices whose bone cross section is widest at knee_slice and narrows either side of it.
+
+    The first and last few slices are all bone, like the hip and foot ends of a full leg scan are wider than the knee.
+    """
+    slices = []
+    for i in range(n_slices):
+        hu_image = np.full((SIZE, SIZE), SOFT_TISSUE, dtype=np.int16)
+        rows = SIZE if i < 3 or i >= n_slices - 3 else max(SIZE // 2 - 8 * abs(i - knee_slice), 8)
+        hu_image[:rows] = BONE
+        slices.append(hu_image)
+    return slices
+
+
+def expected_range(spacing, knee_slice, n_slices, margin_mm=SAFETY_MARGIN_MM):
+    half_range = (KNEE_HALF_RANGE_MM + margin_mm) / spacing
+    return range(max(int(np.ceil(knee_slice - half_range)), 0), min(int(knee_slice + half_range) + 1, n_slices))
+
+
+@pytest.mark.parametrize('knee_slice', [30, 41])
+def test_full_leg_scan_is_pruned_to_the_knee(tmp_path, knee_slice):
+    spacing = 10
+    write_series(str(tmp_path), leg_slices(70, knee_slice), positions=[-i * spacing for i in range(70)])
+
+    slice_range = find_knee_range(index_folder(str(tmp_path)))
+
+    assert slice_range == expected_range(spacing, knee_slice, 70)
+
+
+def test_margin_widens_the_range(tmp_path):
+    write_series(str(tmp_path), leg_slices(70, 35), positions=[-i * 10 for i in range(70)])
+    series_index = index_folder(str(tmp_path))
+
+    assert find_knee_range(series_index, margin_mm=0) == expected_range(10, 35, 70, margin_mm=0)
+    assert find_knee_range(series_index, margin_mm=60) == expected_range(10, 35, 70, margin_mm=60)
+
+
+def test_slice_thickness_measures_scans_without_positions(tmp_path):
+    write_series(str(tmp_path), leg_slices(70, 35), positions=None, thickness=10)
+
+    assert find_knee_range(index_folder(str(tmp_path))) == expected_range(10, 35, 70)
+
+
+def test_knee_only_scan_is_kept_whole(tmp_path):
+    # 60 slices 2 mm apart, well short of a full leg
+    write_series(str(tmp_path), leg_slices(60, 20))
+
+    assert find_knee_range(index_folder(str(tmp_path))) == range(60)
+
+
+def test_scan_of_unknown_length_is_kept_whole(tmp_path):
+    write_series(str(tmp_path), leg_slices(70, 35), positions=None, thickness=None)
+
+    assert find_knee_range(index_folder(str(tmp_path))) == range(70)
+
+
+def test_check_stops_the_profile(tmp_path):
+    write_series(str(tmp_path), leg_slices(70, 35), positions=[-i * 10 for i in range(70)])
+    series_index = index_folder(str(tmp_path))
+    checked = []
+
+    def check():
+        checked.append(True)
+        if len(checked) == 3:
+            raise InterruptedError
+
+    with pytest.raises(InterruptedError):
+        find_knee_range(series_index, check=check)
+    assert len(checked) == 3
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+import metrics
+
+from metrics import (ALL_METRICS, BatchHistogram, BoxHistogram, RECOMMENDER_METRICS, batch_metrics, box_metrics,
+                     calculate_metrics, histogram_counts, percentile_counts)
+
+
+PERCENTILES = [0, 1, 5, 37.5, 50, 95, 99, 100]
+
+# (dtype, lowest, highest pixel) of the boxes, CT values and raw stored values, narrow and across the whole range
+PIXEL_RANGES = [
+    (np.int16, -1024, 3071),
+    (np.int16, -3, 3),
+    (np.int16, np.iinfo(np.int16).min, np.iinfo(np.int16).max),
+    (np.uint16, 0, 4095),
+    (np.uint16, 0, np.iinfo(np.uint16).max),
+]
+
+
+def random_box(rng, dtype, low, high, shape=None):
+    shape = shape or tuple(rng.integers(1, 60, 2))
+    return rng.integers(low, high, shape, endpoint=True).astype(dtype)
+
+
+def baseline_metrics(image, bounding_boxes):
+    # The dicts calculate_metrics returned before the histogram, np.percentile thresholds and masks
+    metrics = []
+    for x, y, w, h in bounding_boxes:
+        metrics.append(box_metrics(w * h, w * h, *percentile_counts(image[y:y+h, x:x+w])))
+    return metrics
+
+
+def assert_identical(actual, expected):
+    # Same keys, values and types, so plots and pickles of either are interchangeable
+    assert len(actual) == len(expected)
+    for a, b in zip(actual, expected):
+        assert a.keys() == b.keys()
+        for name in a:
+            assert type(a[name]) is type(b[name]), name
+            assert a[name] == b[name], name
+
+
+@pytest.mark.parametrize('dtype, low, high', PIXEL_RANGES)
+@pytest.mark.parametrize('seed', range(20))
+def test_box_histogram_percentiles_match_numpy(seed, dtype, low, high):
+    bbox_image = random_box(np.random.default_rng(seed), dtype, low, high)
+    histogram = BoxHistogram(bbox_image)
+
+    for q in PERCENTILES:
+        expected = np.percentile(bbox_image, q)
+        assert type(histogram.percentile(q)) is type(expected)
+        assert histogram.percentile(q) == expected
+
+
+@pytest.mark.parametrize('dtype, low, high', PIXEL_RANGES)
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_histogram_percentiles_match_numpy(seed, dtype, low, high):
+    rng = np.random.default_rng(seed)
+    bbox_images = [random_box(rng, dtype, low, high) for _ in range(10)]
+    histogram = BatchHistogram(bbox_images)
+
+    for q in PERCENTILES:
+        expected = [np.percentile(bbox_image, q) for bbox_image in bbox_images]
+        assert histogram.percentile(q).tolist() == expected
+
+
+@pytest.mark.parametrize('dtype, low, high', PIXEL_RANGES)
+@pytest.mark.parametrize('seed', range(20))
+def test_histogram_counts_match_percentile_counts(seed, dtype, low, high):
+    bbox_image = random_box(np.random.default_rng(seed), dtype, low, high)
+
+    assert histogram_counts(bbox_image) == percentile_counts(bbox_image)
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (1, 7), (2, 2), (5, 1)])
+def test_tiny_and_constant_boxes(shape):
+    rng = np.random.default_rng(0)
+
+    for bbox_image in (random_box(rng, np.int16, -1024, 3071, shape), np.full(shape, 42, dtype=np.int16)):
+        assert histogram_counts(bbox_image) == percentile_counts(bbox_image)
+
+
+@pytest.mark.parametrize('dtype, low, high', PIXEL_RANGES + [(np.float32, -1024, 3071), (np.float64, -1024, 3071)])
+@pytest.mark.parametrize('seed', range(5))
+def test_calculate_metrics_matches_baseline(seed, dtype, low, high):
+    rng = np.random.default_rng(seed)
+    image = random_box(rng, dtype, low, high, (128, 160))
+    if np.issubdtype(dtype, np.floating):
+        # Non integral HU, these boxes take the percentile path
+        image += rng.random(image.shape).astype(dtype)
+
+    bounding_boxes = [(5, 10, 60, 40), (80, 30, 71, 90)]
+
+    assert_identical(calculate_metrics(image, bounding_boxes), baseline_metrics(image, bounding_boxes))
+
+
+def test_requested_metrics_are_the_full_ones():
+    rng = np.random.default_rng(0)
+    image = random_box(rng, np.int16, -1024, 3071, (128, 160))
+    bounding_boxes = [(5, 10, 60, 40), (80, 30, 71, 90)]
+
+    full = calculate_metrics(image, bounding_boxes, ALL_METRICS)
+    subset = calculate_metrics(image, bounding_boxes, RECOMMENDER_METRICS)
+
+    assert_identical(subset, [{name: box[name] for name in RECOMMENDER_METRICS} for box in full])
+
+
+def random_boxes(rng, n_slices, rows, columns):
+    # Two boxes per slice of any size, some of them running past the edge of the slice
+    x, y = rng.integers(0, columns, (n_slices, 2)), rng.integers(0, rows, (n_slices, 2))
+    w, h = rng.integers(1, columns // 2, (n_slices, 2)), rng.integers(1, rows // 2, (n_slices, 2))
+    return np.stack([x, y, w, h], axis=-1)
+
+
+@pytest.mark.parametrize('batch_pixels', [1, 5000, 1 << 22])
+@pytest.mark.parametrize('dtype, low, high', PIXEL_RANGES + [(np.float32, -1024, 3071)])
+@pytest.mark.parametrize('seed', range(3))
+def test_batch_metrics_match_calculate_metrics(seed, dtype, low, high, batch_pixels, monkeypatch):
+    monkeypatch.setattr(metrics, 'BATCH_PIXELS', batch_pixels)
+    rng = np.random.default_rng(seed)
+    hu_volume = random_box(rng, dtype, low, high, (12, 96, 128))
+    if np.issubdtype(dtype, np.floating):
+        hu_volume += rng.random(hu_volume.shape).astype(dtype)
+
+    slice_indices = rng.choice(12, 8, replace=False)
+    bounding_boxes = random_boxes(rng, 8, 96, 128)
+    file_names = [f'IMG-0001-{i + 1:05d}.dcm' for i in slice_indices]
+
+    series = batch_metrics(hu_volume, bounding_boxes, slice_indices, file_names)
+
+    assert series['slice_index'].tolist() == slice_indices.tolist()
+    assert series['file_name'].tolist() == file_names
+    np.testing.assert_array_equal(series['bounding_boxes'], bounding_boxes)
+    for row, i in enumerate(slice_indices):
+        expected = calculate_metrics(hu_volume[i], bounding_boxes[row].tolist())
+        for box in range(2):
+            for name in ALL_METRICS:
+                assert series['metrics'][name][row, box] == expected[box][name], name
+
+
+def test_batch_metrics_of_requested_metrics():
+    rng = np.random.default_rng(0)
+    hu_volume = random_box(rng, np.int16, -1024, 3071, (4, 64, 64))
+    bounding_boxes = random_boxes(rng, 4, 64, 64)
+
+    series = batch_metrics(hu_volume, bounding_boxes, metrics=RECOMMENDER_METRICS)
+    full = batch_metrics(hu_volume, bounding_boxes)
+
+    assert series['metrics'].dtype.names == tuple(RECOMMENDER_METRICS)
+    np.testing.assert_array_equal(series['metrics']['gray_pixels'], full['metrics']['gray_pixels'])
+
+
+def test_batch_metrics_without_slices():
+    series = batch_metrics(np.zeros((3, 8, 8), dtype=np.int16), np.zeros((0, 2, 4)))
+
+    assert len(series) == 0
@@ -0,0 +1,131 @@
+import numpy as np
+import pydicom
+import pytest
+
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.pixel_data_handlers.rle_handler import rle_encode_frame
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless, generate_uid
+
+from multiframe import FrameReader, read_dataset
+from series_index import index_folder
+
+
+ENHANCED_CT_STORAGE = '1.2.840.10008.5.1.4.1.1.2.1'
+
+N_FRAMES = 5
+ROWS, COLUMNS = 24, 32
+SLICE_SPACING_MM = 2.5
+RESCALE_INTERCEPT = -1024
+
+
+def sequence_item(**attributes):
+    item = Dataset()
+    for name, value in attributes.items():
+        setattr(item, name, value)
+    return item
+
+
+def enhanced_ct(path, frames, transfer_syntax, has_bot=True, fragments_per_frame=1):
+    """ An Enhanced CT file of the int16 frames, positioned downwards along z with a shared rescale """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = ENHANCED_CT_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = transfer_syntax
+
+    ds = FileDataset(str(path), {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = transfer_syntax == ImplicitVRLittleEndian
+    ds.SOPClassUID = ENHANCED_CT_STORAGE
+    ds.SeriesInstanceUID = generate_uid()
+    ds.NumberOfFrames = len(frames)
+    ds.Rows, ds.Columns = ROWS, COLUMNS
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+    ds.PixelRepresentation = 1
+
+    ds.SharedFunctionalGroupsSequence = [sequence_item(
+        PlaneOrientationSequence=[sequence_item(ImageOrientationPatient=[1, 0, 0, 0, 1, 0])],
+        PixelMeasuresSequence=[sequence_item(SliceThickness=SLICE_SPACING_MM, PixelSpacing=[0.5, 0.5])],
+        PixelValueTransformationSequence=[sequence_item(RescaleSlope=1, RescaleIntercept=RESCALE_INTERCEPT)],
+    )]
+    ds.PerFrameFunctionalGroupsSequence = [
+        sequence_item(PlanePositionSequence=[sequence_item(ImagePositionPatient=[0, 0, -i * SLICE_SPACING_MM])])
+        for i in range(len(frames))
+    ]
+
+    if transfer_syntax == RLELossless:
+        encoded = [rle_encode_frame(frame) for frame in frames]
+        ds.PixelData = encapsulate(encoded, fragments_per_frame=fragments_per_frame, has_bot=has_bot)
+        ds['PixelData'].VR = 'OB'
+        ds['PixelData'].is_undefined_length = True
+    else:
+        ds.PixelData = np.ascontiguousarray(frames).tobytes()
+        ds['PixelData'].VR = 'OW'
+
+    ds.save_as(str(path), write_like_original=False)
+    return path
+
+
+def random_frames(seed):
+    return np.random.default_rng(seed).integers(-1024, 3072, (N_FRAMES, ROWS, COLUMNS)).astype(np.int16)
+
+
+ENCODINGS = {
+    'explicit': dict(transfer_syntax=ExplicitVRLittleEndian),
+    'implicit': dict(transfer_syntax=ImplicitVRLittleEndian),
+    'rle': dict(transfer_syntax=RLELossless),
+    'rle without offset table': dict(transfer_syntax=RLELossless, has_bot=False),
+    'rle in fragments': dict(transfer_syntax=RLELossless, fragments_per_frame=2),
+}
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_frames_decode_like_the_whole_file(tmp_path, encoding):
+    frames = random_frames(0)
+    path = enhanced_ct(tmp_path / 'enhanced.dcm', frames, **ENCODINGS[encoding])
+
+    reader = FrameReader(str(path))
+    assert len(reader) == N_FRAMES
+    assert reader.encapsulated == (ENCODINGS[encoding]['transfer_syntax'] == RLELossless)
+
+    # Read in reverse, no frame depends on the ones before it having been read
+    for i in reversed(range(N_FRAMES)):
+        np.testing.assert_array_equal(reader.frame_dataset(i).pixel_array, frames[i])
+
+    # pydicom's own decode of the whole file only handles one fragment per frame
+    if ENCODINGS[encoding].get('fragments_per_frame', 1) == 1:
+        np.testing.assert_array_equal(pydicom.dcmread(str(path)).pixel_array, frames)
+
+
+@pytest.mark.parametrize('encoding', ['explicit', 'rle'])
+def test_frame_dataset_is_a_single_frame_slice(tmp_path, encoding):
+    path = enhanced_ct(tmp_path / 'enhanced.dcm', random_frames(1), **ENCODINGS[encoding])
+
+    frame_data = read_dataset(str(path), 3)
+
+    assert frame_data.InstanceNumber == 4
+    assert [float(v) for v in frame_data.ImagePositionPatient] == [0, 0, -3 * SLICE_SPACING_MM]
+    assert float(frame_data.SliceThickness) == SLICE_SPACING_MM
+    assert (float(frame_data.RescaleSlope), float(frame_data.RescaleIntercept)) == (1, RESCALE_INTERCEPT)
+    assert frame_data.pixel_array.shape == (ROWS, COLUMNS)
+
+
+def test_frame_out_of_range(tmp_path):
+    reader = FrameReader(str(enhanced_ct(tmp_path / 'enhanced.dcm', random_frames(2), ExplicitVRLittleEndian)))
+
+    with pytest.raises(IndexError):
+        reader.frame_bytes(N_FRAMES)
+
+
+def test_frames_are_indexed_as_slices(tmp_path):
+    frames = random_frames(3)
+    enhanced_ct(tmp_path / 'enhanced.dcm', frames, RLELossless)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert len(series_index) == N_FRAMES
+    assert series_index.spacing == SLICE_SPACING_MM and series_index.gaps == []
+    for file_path, frame in zip(series_index.file_paths, series_index.frames):
+        np.testing.assert_array_equal(read_dataset(file_path, frame).pixel_array, frames[frame])
@@ -0,0 +1,160 @@
+import os
+import time
+import threading
+
+import numpy as np
+import pytest
+
+from dicom_series import write_series
+from pipeline import Stage, process_slices, run_pipeline, stage_pool
+from series_index import index_folder
+from test_pyramid_detection import knee_phantom
+
+
+# Stage functions are module level so the pool workers can unpickle them
+
+def shuffled_sleep(x):
+    # Later items often finish first, the pipeline must still hand them out in order
+    time.sleep((x * 7919 % 13) / 1000)
+    return x
+
+
+def double(x):
+    return 2 * x
+
+
+def fail_on_five(x):
+    if x == 5:
+        raise ValueError(f"stage failed on {x}")
+    return x
+
+
+def worker_pid(x):
+    return os.getpid()
+
+
+def failing_source(n):
+    yield from range(n)
+    raise KeyError("source failed")
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = stage_pool(2)
+    yield pool
+    pool.shutdown()
+
+
+def pipeline_threads():
+    # The feeder and stage threads are the daemon threads running pipeline functions
+    return [thread for thread in threading.enumerate()
+            if thread.daemon and getattr(thread, '_target', None) is not None
+            and thread._target.__module__ == 'pipeline']
+
+
+def wait_for_pipeline_threads(timeout=5):
+    deadline = time.monotonic() + timeout
+    while pipeline_threads() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return pipeline_threads()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_items_come_out_in_order(pool, workers):
+    stages = [Stage(shuffled_sleep, workers, pool if workers > 1 else None), Stage(double)]
+
+    assert list(run_pipeline(range(100), stages, queue_size=4)) == [2 * x for x in range(100)]
+
+
+@pytest.mark.parametrize('stages', ['threaded', 'pool'])
+def test_stage_error_is_raised_in_the_caller(pool, stages):
+    workers = 2 if stages == 'pool' else 1
+    items = []
+
+    with pytest.raises(ValueError, match="stage failed on 5"):
+        for item in run_pipeline(range(20), [Stage(fail_on_five, workers, pool if workers > 1 else None), Stage(double)]):
+            items.append(item)
+
+    # Every item before the failing one was delivered, none after it
+    assert items == [0, 2, 4, 6, 8]
+    assert not wait_for_pipeline_threads()
+
+
+def test_source_error_is_raised_in_the_caller():
+    items = []
+
+    with pytest.raises(KeyError, match="source failed"):
+        for item in run_pipeline(failing_source(6), [Stage(double)]):
+            items.append(item)
+
+    assert items == [0, 2, 4, 6, 8, 10]
+
+
+def test_pool_error_is_raised_in_the_caller():
+    # A pool that was shut down refuses new work, the submit error comes out of the generator
+    dead_pool = stage_pool(2)
+    dead_pool.shutdown()
+
+    with pytest.raises(RuntimeError):
+        list(run_pipeline(range(10), [Stage(double, 2, dead_pool)]))
+
+
+def test_close_stops_the_pipeline_early():
+    consumed = []
+
+    def endless():
+        i = 0
+        while True:
+            consumed.append(i)
+            yield i
+            i += 1
+
+    items = run_pipeline(endless(), [Stage(double), Stage(shuffled_sleep)], queue_size=2)
+    assert [next(items) for _ in range(3)] == [0, 2, 4]
+    items.close()
+
+    assert not wait_for_pipeline_threads()
+    # The bounded queues stopped the source shortly after the last item was taken
+    n_consumed = len(consumed)
+    time.sleep(0.2)
+    assert len(consumed) == n_consumed < 20
+
+
+def test_shared_pool_is_reused_and_left_running(pool):
+    pids = set()
+    for _ in range(3):
+        pids.update(run_pipeline(range(20), [Stage(worker_pid, 2, pool)]))
+
+    # Every run used the same two workers, none started or shut down a pool of its own
+    assert len(pids) <= 2 and os.getpid() not in pids
+    assert pool.submit(double, 21).result() == 42
+
+
+@pytest.fixture(scope='module')
+def phantom_series(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('phantom')
+    write_series(str(folder), [knee_phantom(seed) for seed in range(6)])
+    return index_folder(str(folder))
+
+
+def slice_results(items):
+    return [(item['slice_index'], item['file_name'], item['bounding_boxes'], item['metrics'],
+             item['slice_data'].hu, item['edge_points']) for item in items]
+
+
+def test_pool_matches_the_threaded_stages(pool, phantom_series):
+    indices = range(len(phantom_series))
+
+    threaded = slice_results(process_slices(phantom_series, indices))
+    pooled = slice_results(process_slices(phantom_series, indices, workers=2, pool=pool))
+    own_pool = slice_results(process_slices(phantom_series, indices, workers=2))
+
+    assert [r[0] for r in threaded] == list(indices)
+    assert all(len(r[2]) == 2 and r[3] is not None for r in threaded)
+
+    for results in (pooled, own_pool):
+        assert len(results) == len(threaded)
+        for actual, expected in zip(results, threaded):
+            assert actual[:4] == expected[:4]
+            np.testing.assert_array_equal(actual[4], expected[4])
+            np.testing.assert_array_equal(actual[5].points, expected[5].points)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from functions import detect_knee_bounding_boxes_hu, detect_knee_bounding_boxes_pyramid
+
+
+# The pyramid refines every box at full resolution, so boxes and the edge points inside them must match exactly
+BOX_TOLERANCE_PX = 0
+EDGE_POINT_TOLERANCE = 0
+
+AIR_HU = -1000
+SOFT_TISSUE_HU = 40
+CORTICAL_HU = 1200
+CANCELLOUS_HU = 300
+
+
+def ellipse(shape, centre, axes, angle=0.0):
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    dx, dy = xx - centre[0], yy - centre[1]
+    c, s = np.cos(angle), np.sin(angle)
+    return ((dx * c + dy * s) / axes[0]) ** 2 + ((dy * c - dx * s) / axes[1]) ** 2 <= 1
+
+
+def knee_phantom(seed, size=512, dtype=np.int16):
+    """ Axial slice through both knees, two legs of soft tissue each around a tibial plateau of random size and tilt """
+    rng = np.random.default_rng(seed)
+    shape = (size, size)
+    hu_image = np.full(shape, AIR_HU, dtype=np.float64)
+
+    for cx in (size * 0.3, size * 0.7):
+        centre = (cx + rng.uniform(-10, 10), size / 2 + rng.uniform(-20, 20))
+        hu_image[ellipse(shape, centre, (size * 0.18, size * 0.14))] = SOFT_TISSUE_HU
+
+        axes = (size * rng.uniform(0.11, 0.16), size * rng.uniform(0.08, 0.1))
+        angle = rng.uniform(-0.3, 0.3)
+        hu_image[ellipse(shape, centre, axes, angle)] = CORTICAL_HU
+        inner = ellipse(shape, centre, (axes[0] * 0.8, axes[1] * 0.8), angle)
+        hu_image[inner] = CANCELLOUS_HU + rng.integers(0, 200, inner.sum())
+
+    # A small bone fragment away from the knees, the pyramid must not report or lose it differently
+    hu_image[ellipse(shape, (size * 0.5, size * 0.15), (6, 4))] = CORTICAL_HU
+
+    hu_image += rng.integers(-20, 20, shape)
+    return hu_image.astype(dtype)
+
+
+def points_in_boxes(edge_points):
+    # The pyramid only traces around the knee, edge points elsewhere are not compared
+    return set(map(tuple, edge_points.box_points.tolist()))
+
+
+def box_distance(a, b):
+    return max(abs(p - q) for p, q in zip(a, b))
+
+
+@pytest.mark.parametrize('scale', [2, 4])
+@pytest.mark.parametrize('dtype', [np.int16, np.float64])
+@pytest.mark.parametrize('seed', range(6))
+def test_pyramid_matches_full_resolution(seed, dtype, scale):
+    hu_image = knee_phantom(seed, dtype=dtype)
+
+    full_boxes, _, full_points = detect_knee_bounding_boxes_hu(hu_image, scale=1)
+    pyramid_boxes, _, pyramid_points = detect_knee_bounding_boxes_pyramid(hu_image, scale)
+
+    assert len(full_boxes) == 2
+    assert len(pyramid_boxes) == len(full_boxes)
+    assert all(box_distance(a, b) <= BOX_TOLERANCE_PX for a, b in zip(pyramid_boxes, full_boxes))
+    assert len(points_in_boxes(pyramid_points) ^ points_in_boxes(full_points)) <= EDGE_POINT_TOLERANCE
+
+
+def test_phantom_without_knees_finds_nothing_either_way():
+    hu_image = np.full((512, 512), SOFT_TISSUE_HU, dtype=np.int16)
+
+    assert detect_knee_bounding_boxes_hu(hu_image, scale=1)[0] == []
+    assert detect_knee_bounding_boxes_pyramid(hu_image, 2)[0] == []
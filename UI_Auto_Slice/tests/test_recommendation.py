@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+
+from find_reccomended_image import coarse_to_fine_metrics
+from metrics import metric_series
+from recommendation import (GAP_SLICES, HEIGHT_RANGE, IncrementalRecommender, find_gaps, find_segment_runs, fit_segments,
+                            plateau_median, rank_candidates, recommend)
+
+
+def study_results(seed, first_slice=0):
+    """
+    Metrics results of a synthetic study, keyed by slice index, None for the slices without two knee boxes.
+
+    Some thigh slices, a gap, the knee with a few plateaus per box among noise, a second gap and some shin slices.
+    """
+    rng = np.random.default_rng(seed)
+    thigh_stop = first_slice + int(rng.integers(0, 60))
+    knee_start = thigh_stop + GAP_SLICES + int(rng.integers(0, 40))
+    knee_stop = knee_start + int(rng.integers(120, 200))
+    shin_start = knee_stop + GAP_SLICES + int(rng.integers(0, 40))
+    n_slices = shin_start + 60
+
+    valid = np.zeros(n_slices, dtype=bool)
+    valid[first_slice:thigh_stop] = True
+    valid[knee_start:knee_stop] = rng.random(knee_stop - knee_start) > 0.03
+    valid[shin_start:] = True
+
+    gray_pixels = rng.integers(2000, 16000, (n_slices, 2))
+    for box in range(2):
+        for _ in range(rng.integers(1, 4)):
+            start = int(rng.integers(knee_start, knee_stop - 30))
+            length = int(rng.integers(4, 40))
+            ramp = rng.uniform(-200, 200) * np.arange(length)
+            gray_pixels[start:start + length, box] = rng.uniform(9000, 12000) + ramp + rng.normal(0, 100, length)
+
+    results = {}
+    for i in range(first_slice, n_slices):
+        results[i] = None
+        if valid[i]:
+            results[i] = {
+                'file_name': f'IMG-0001-{i + 1:05d}.dcm',
+                'slice_index': i,
+                'bounding_boxes': [(10, 10, 80, 80), (120, 10, 80, 80)],
+                'metrics': [{'gray_pixels': int(gray_pixels[i, box])} for box in range(2)],
+            }
+
+    return results
+
+
+def valid_results(results):
+    return [results[i] for i in sorted(results) if results[i]]
+
+
+def random_runs(rng, n_values):
+    # Disjoint runs of at least two values, the shortest a line can be fitted to
+    bounds = np.sort(rng.choice(np.arange(n_values + 1), 2 * rng.integers(1, 10), replace=False))
+    starts, stops = bounds[::2], bounds[1::2]
+    keep = stops - starts >= 2
+    return starts[keep], stops[keep]
+
+
+@pytest.mark.parametrize('dtype', [np.int64, np.float64])
+@pytest.mark.parametrize('seed', range(20))
+def test_fit_segments_matches_least_squares(seed, dtype):
+    rng = np.random.default_rng(seed)
+    values = (rng.normal(10000, 2000, 400) + rng.normal(0, 100) * np.arange(400)).astype(dtype)
+    starts, stops = random_runs(rng, len(values))
+
+    slopes, means = fit_segments(values, starts, stops)
+
+    for start, stop, slope, mean in zip(starts, stops, slopes, means):
+        x = np.arange(start, stop)
+        fitted_slope, intercept = np.polyfit(x, values[start:stop].astype(float), 1)
+        assert slope == pytest.approx(fitted_slope, rel=1e-9, abs=1e-9)
+        # The mean height of the fitted line over the run
+        assert mean == pytest.approx(np.mean(fitted_slope * x + intercept), rel=1e-9)
+
+
+def test_fit_segments_of_the_plateau_runs():
+    rng = np.random.default_rng(0)
+    values = np.concatenate([rng.integers(0, 5000, 30), 10000 + 40 * np.arange(20), rng.integers(0, 5000, 30)])
+
+    starts, stops = find_segment_runs(values, 0, len(values))
+    slopes, means = fit_segments(values, starts, stops)
+
+    assert (starts.tolist(), stops.tolist()) == ([30], [50])
+    assert slopes == pytest.approx([40])
+    assert means == pytest.approx([10000 + 40 * 9.5])
+
+
+def test_median_between_plateaus_has_the_nearest_plateau_confidence():
+    # Flat plateaus in the middle of the height range, both boxes agreeing, with nothing between them
+    height = (HEIGHT_RANGE[0] + HEIGHT_RANGE[1]) / 2
+    plateaus = [(np.array([10, 40]), np.array([20, 50]), np.zeros(2), np.full(2, height)) for _ in range(2)]
+    median_index = plateau_median(plateaus)
+
+    candidates = rank_candidates(plateaus, median_index, n_candidates=100)
+    confidences = dict(candidates)
+
+    assert median_index == 29 and candidates[0][0] == median_index
+    # Slice 19 ends the first plateau, one slice nearer the median than the start of the second
+    assert confidences[median_index] == confidences[19] > 0
+    assert all(0 <= confidence <= 1 for confidence in confidences.values())
+
+
+def test_median_on_a_plateau_keeps_its_own_confidence():
+    height = (HEIGHT_RANGE[0] + HEIGHT_RANGE[1]) / 2
+    plateaus = [(np.array([10]), np.array([50]), np.zeros(1), np.full(1, height)) for _ in range(2)]
+
+    candidates = rank_candidates(plateaus, plateau_median(plateaus))
+
+    # Every slice is on a flat plateau of both boxes at the middle height, only the median is fully central
+    assert candidates[0] == (29, pytest.approx(1.0))
+    assert all(confidence < candidates[0][1] for _, confidence in candidates[1:])
+
+
+@pytest.mark.parametrize('first_slice', [0, 250])
+@pytest.mark.parametrize('seed', range(30))
+def test_incremental_recommender_matches_recommend(seed, first_slice):
+    folder_metrics = valid_results(study_results(seed, first_slice=first_slice))
+    candidates = recommend(metric_series(folder_metrics), first_slice=first_slice)
+
+    recommender = IncrementalRecommender(first_slice=first_slice)
+    for result in folder_metrics:
+        recommender.add(result)
+
+    if not candidates:
+        # Both gaps seen without a plateau in either box
+        assert recommender.recommendation == -1
+        return
+
+    assert recommender.recommendation == candidates[0][0]
+    assert [index for index, _ in recommender.candidates] == [index for index, _ in candidates]
+    assert [confidence for _, confidence in recommender.candidates] == pytest.approx(
+        [confidence for _, confidence in candidates])
+
+
+def test_incremental_recommender_answers_at_the_second_gap():
+    folder_metrics = valid_results(study_results(0))
+    slice_indices = [result['slice_index'] for result in folder_metrics]
+    shin_start = slice_indices[find_gaps(slice_indices)[1]]
+
+    recommender = IncrementalRecommender()
+    for result in folder_metrics:
+        answer = recommender.add(result)
+        assert (answer is not None) == (result['slice_index'] >= shin_start)
+
+
+@pytest.mark.parametrize('first_slice', [0, 250])
+@pytest.mark.parametrize('seed', range(30))
+def test_coarse_to_fine_matches_the_exhaustive_scan(seed, first_slice):
+    results = study_results(seed, first_slice=first_slice)
+    processed = []
+
+    def process_metrics(indices):
+        processed.extend(indices)
+        return {i: results[i] for i in indices}
+
+    slice_range = range(first_slice, max(results) + 1)
+    coarse = coarse_to_fine_metrics(slice_range, process_metrics)
+
+    assert len(set(processed)) == len(processed)
+    assert len(processed) < len(slice_range)
+    assert (recommend(metric_series(coarse), first_slice=first_slice)
+            == recommend(metric_series(valid_results(results)), first_slice=first_slice))
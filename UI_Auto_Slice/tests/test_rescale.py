@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from volume import HU_MAX, HU_MIN, hu_to_int16, rescale_to_hu
+
+
+# (pixel dtype, lowest, highest pixel, slope, intercept, HU dtype, whether the pixel array itself is rescaled)
+RESCALES = [
+    # Signed CT, already in HU or with an offset, rescaled in place
+    (np.int16, -1024, 3071, 1, 0, np.int16, True),
+    (np.int16, 0, 4095, 1, -1024, np.int16, True),
+    (np.int16, -1000, 1000, 2, 24, np.int16, True),
+    # Unsigned CT below 2 ** 15, rescaled through an int16 view of the same memory
+    (np.uint16, 0, 4095, 1, -1024, np.int16, True),
+    (np.uint16, 0, HU_MAX, 1, -1024, np.int16, True),
+    (np.uint16, 0, 4095, 1, 0, np.int16, True),
+    # Narrower arrays are widened into a new int16 array
+    (np.uint8, 0, 255, 1, -1024, np.int16, False),
+    (np.int8, -128, 127, 4, 100, np.int16, False),
+    # Results past the int16 range, the view or the in place rescale would overflow
+    (np.uint16, 0, HU_MAX + 1, 1, -1024, np.float32, False),
+    (np.uint16, 0, np.iinfo(np.uint16).max, 1, -32768, np.float32, False),
+    (np.int16, 0, HU_MAX, 1, 1, np.float32, False),
+    (np.int16, HU_MIN, 0, 1, -1, np.float32, False),
+    (np.int16, -2000, 2000, 20, 0, np.float32, False),
+    # Non integral slopes and intercepts
+    (np.int16, -1024, 3071, 0.5, 0, np.float32, False),
+    (np.uint16, 0, 4095, 1, -1024.5, np.float32, False),
+    (np.uint16, 0, 4095, 1.25, -1024.25, np.float32, False),
+]
+
+
+def random_pixels(seed, dtype, low, high, shape=(64, 48)):
+    pixels = np.random.default_rng(seed).integers(low, high, shape, endpoint=True).astype(dtype)
+    # Both ends of the range are in the slice, they decide the path
+    pixels.flat[0], pixels.flat[-1] = low, high
+    return pixels
+
+
+@pytest.mark.parametrize('dtype, low, high, slope, intercept, hu_dtype, in_place', RESCALES)
+@pytest.mark.parametrize('seed', range(3))
+def test_rescale_matches_slope_and_intercept(seed, dtype, low, high, slope, intercept, hu_dtype, in_place):
+    pixels = random_pixels(seed, dtype, low, high)
+    original = pixels.copy()
+    expected = pixels.astype(np.float64) * slope + intercept
+
+    hu_image = rescale_to_hu(pixels, slope, intercept)
+
+    assert hu_image.dtype == hu_dtype
+    assert np.shares_memory(hu_image, pixels) == in_place
+    if not in_place:
+        np.testing.assert_array_equal(pixels, original)
+    if hu_dtype == np.int16:
+        np.testing.assert_array_equal(hu_image, expected)
+    else:
+        # float32 holds every value here exactly apart from the non integral rescales of large pixels
+        np.testing.assert_allclose(hu_image, expected, rtol=1e-7, atol=0)
+
+
+@pytest.mark.parametrize('dtype, low, high, slope, intercept, hu_dtype, in_place', RESCALES)
+def test_volume_stores_the_rounded_rescale(dtype, low, high, slope, intercept, hu_dtype, in_place):
+    pixels = random_pixels(0, dtype, low, high)
+    expected = np.clip(np.rint(pixels.astype(np.float64) * slope + intercept), HU_MIN, HU_MAX)
+
+    hu_image = rescale_to_hu(pixels, slope, intercept)
+
+    np.testing.assert_array_equal(hu_to_int16(hu_image) if hu_image.dtype != np.int16 else hu_image, expected)
+
+
+def test_uint16_at_the_top_of_12_bits():
+    # The common stored range of CT, 4095 with the -1024 intercept is 3071 HU
+    pixels = np.array([[0, 1024, 4095]], dtype=np.uint16)
+
+    hu_image = rescale_to_hu(pixels, 1, -1024)
+
+    assert hu_image.dtype == np.int16
+    assert hu_image.tolist() == [[-1024, 0, 3071]]
+
+
+def test_rescale_of_dicom_strings():
+    # pydicom hands the rescale over as DS strings turned into numbers, integral ones must keep the int16 path
+    from pydicom.valuerep import DSfloat
+
+    pixels = np.array([[0, 4095]], dtype=np.uint16)
+    hu_image = rescale_to_hu(pixels, DSfloat('1'), DSfloat('-1024'))
+
+    assert hu_image.dtype == np.int16 and hu_image.tolist() == [[-1024, 3071]]
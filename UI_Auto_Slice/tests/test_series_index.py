@@ -0,0 +1,116 @@
+import numpy as np
+import pydicom
+
+from dicom_series import SLICE_SPACING_MM, constant_slices, write_series
+from series_index import index_folder, scan_series
+
+
+N_SLICES = 12
+
+
+def slice_values(series_index):
+    # The HU value each slice was filled with, i.e. its slice number in the written series
+    values = []
+    for path in series_index.file_paths:
+        ds = pydicom.dcmread(path)
+        values.append(int(ds.pixel_array[0, 0]) + int(ds.RescaleIntercept))
+    return values
+
+
+def test_slices_are_ordered_by_position_not_file_name(tmp_path):
+    # The file names sort in a different order than the slices lie
+    file_names = [f'IMG-0001-{n:05d}.dcm' for n in np.random.default_rng(0).permutation(N_SLICES) + 1]
+    write_series(str(tmp_path), constant_slices(N_SLICES), file_names=file_names)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert slice_values(series_index) == list(range(N_SLICES))
+    assert series_index.positions.tolist() == [-i * SLICE_SPACING_MM for i in range(N_SLICES)]
+    assert series_index.instance_numbers.tolist() == list(range(1, N_SLICES + 1))
+
+
+def test_acquisition_direction_is_kept(tmp_path):
+    # Scanned upwards, the first instance has the lowest position
+    positions = [i * SLICE_SPACING_MM for i in range(N_SLICES)]
+    write_series(str(tmp_path), constant_slices(N_SLICES), positions=positions)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert slice_values(series_index) == list(range(N_SLICES))
+    assert series_index.instance_numbers[0] == 1
+
+
+def test_slice_location_stands_in_for_a_missing_position(tmp_path):
+    paths = write_series(str(tmp_path), constant_slices(N_SLICES), positions=None)
+    for i, path in enumerate(paths):
+        ds = pydicom.dcmread(path)
+        ds.SliceLocation = 100 - i * SLICE_SPACING_MM
+        ds.save_as(path)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert slice_values(series_index) == list(range(N_SLICES))
+    assert series_index.positions.tolist() == [100 - i * SLICE_SPACING_MM for i in range(N_SLICES)]
+    assert series_index.spacing == SLICE_SPACING_MM
+
+
+def test_instance_numbers_order_slices_without_positions(tmp_path):
+    instance_numbers = [int(n) for n in np.random.default_rng(1).permutation(N_SLICES) + 1]
+    write_series(str(tmp_path), constant_slices(N_SLICES), positions=None, instance_numbers=instance_numbers)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert series_index.instance_numbers.tolist() == list(range(1, N_SLICES + 1))
+    assert slice_values(series_index) == [instance_numbers.index(n) for n in range(1, N_SLICES + 1)]
+    # Without positions there is nothing to measure the spacing or gaps with
+    assert np.isnan(series_index.positions).all()
+    assert series_index.spacing is None and series_index.gaps == []
+
+
+def test_file_numbers_order_slices_without_positions_or_instance_numbers(tmp_path):
+    # Unpadded numbers, a plain sort of the names would put 10 before 2
+    file_names = [f'IMG-0001-{i + 1}.dcm' for i in range(N_SLICES)]
+    write_series(str(tmp_path), constant_slices(N_SLICES), positions=None, instance_numbers=None,
+                 file_names=file_names)
+
+    series_index = index_folder(str(tmp_path))
+
+    assert slice_values(series_index) == list(range(N_SLICES))
+    assert (series_index.instance_numbers == -1).all()
+
+
+def test_the_largest_series_is_indexed(tmp_path):
+    write_series(str(tmp_path), constant_slices(4), file_names=[f'SCOUT-{i + 1:05d}.dcm' for i in range(4)],
+                 series_uid='1.2.3.1')
+    write_series(str(tmp_path), constant_slices(N_SLICES), series_uid='1.2.3.2')
+
+    indices = scan_series(str(tmp_path))
+    series_index = index_folder(str(tmp_path))
+
+    assert [(index.series_uid, len(index)) for index in indices] == [('1.2.3.2', N_SLICES), ('1.2.3.1', 4)]
+    assert series_index.series_uid == '1.2.3.2'
+    assert all('SCOUT' not in path for path in series_index.file_paths)
+    assert slice_values(series_index) == list(range(N_SLICES))
+
+
+def test_missing_slices_are_reported_as_gaps(tmp_path):
+    missing = {4, 5, 9}
+    kept = [i for i in range(N_SLICES) if i not in missing]
+    write_series(str(tmp_path), [constant_slices(N_SLICES)[i] for i in kept],
+                 positions=[-i * SLICE_SPACING_MM for i in kept], instance_numbers=[i + 1 for i in kept])
+
+    series_index = index_folder(str(tmp_path))
+
+    assert series_index.spacing == SLICE_SPACING_MM
+    # The indices of the slices that follow each missing run
+    assert series_index.gaps == [kept.index(6), kept.index(10)]
+
+
+def test_a_complete_series_has_no_gaps(tmp_path):
+    write_series(str(tmp_path), constant_slices(N_SLICES))
+
+    series_index = index_folder(str(tmp_path))
+
+    assert series_index.spacing == SLICE_SPACING_MM
+    assert series_index.gaps == []
+    assert series_index.shape == (8, 8) and series_index.slice_thickness == SLICE_SPACING_MM
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from dicom_series import write_series
+from functions import window_image
+from series_index import index_folder
+from slice_provider import SliceProvider
+from volume import Volume
+
+
+N_SLICES = 10
+
+
+@pytest.fixture
+def series_index(tmp_path):
+    rng = np.random.default_rng(0)
+    write_series(str(tmp_path), [rng.integers(-1024, 3072, (16, 16)).astype(np.int16) for _ in range(N_SLICES)])
+    return index_folder(str(tmp_path))
+
+
+def drained(provider):
+    # Waits for the background renders, the provider takes no more prefetches afterwards
+    provider.executor.shutdown(wait=True)
+    return provider
+
+
+def test_frames_match_the_eager_volume(series_index):
+    eager = Volume.from_series_index(series_index)
+    for i in range(N_SLICES):
+        eager.load_slice(i)
+
+    lazy = Volume.from_series_index(series_index)
+    provider = SliceProvider(lazy, cache_size=4, prefetch=2)
+
+    for i in np.random.default_rng(1).permutation(N_SLICES):
+        np.testing.assert_array_equal(provider.get(int(i)), window_image(eager.hu[i]))
+
+    drained(provider)
+    np.testing.assert_array_equal(lazy.hu, eager.hu)
+    assert all(lazy.is_loaded(i) for i in range(N_SLICES))
+
+
+def test_least_recently_used_frames_are_evicted(series_index):
+    provider = SliceProvider(Volume.from_series_index(series_index), cache_size=3, prefetch=0)
+
+    for i in range(6):
+        provider.get(i)
+    assert list(provider.frames) == [3, 4, 5]
+
+    # A cache hit counts as a use
+    provider.get(3)
+    provider.get(6)
+    assert list(provider.frames) == [5, 3, 6]
+
+
+@pytest.mark.parametrize('cache_size', [1, 2, 5])
+def test_cache_never_grows_past_its_size(series_index, cache_size):
+    provider = SliceProvider(Volume.from_series_index(series_index), cache_size=cache_size, prefetch=3)
+
+    for i in list(range(N_SLICES)) + list(range(N_SLICES - 1, -1, -1)):
+        provider.get(i, direction=1)
+        assert len(provider.frames) <= cache_size
+
+    assert len(drained(provider).frames) <= cache_size
+
+
+def test_pinned_frames_are_kept(series_index):
+    provider = SliceProvider(Volume.from_series_index(series_index), cache_size=2, prefetch=0)
+    provider.pin([0, 1, N_SLICES])
+
+    for i in range(2, N_SLICES):
+        provider.get(i)
+
+    # The pinned frames do not count against the cache size, the out of range one is ignored
+    assert sorted(drained(provider).frames) == [0, 1, N_SLICES - 2, N_SLICES - 1]
+
+
+def test_prefetch_follows_the_scroll_direction(series_index):
+    provider = SliceProvider(Volume.from_series_index(series_index), cache_size=8, prefetch=2)
+
+    provider.get(5, direction=1)
+
+    assert sorted(drained(provider).frames) == [5, 6, 7]
@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from detection_index import DetectionIndex
+from metrics import RECOMMENDER_METRICS, slice_metrics_dtype
+from study_cache import CacheVersionError, read_cache, write_cache
+from volume import Volume
+
+
+def small_volume(memmap_dir=None):
+    volume = Volume(3, 4, 5, [f'IMG-0001-{i + 1:05d}.dcm' for i in range(3)], memmap_dir)
+    volume.hu[:] = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    return volume
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_cache_round_trip(tmp_path, memmap):
+    volume = small_volume(str(tmp_path) if memmap else None)
+    detections = DetectionIndex(3)
+    detections.set(1, [(0, 0, 2, 2), (2, 0, 2, 2)], [])
+    metrics = np.zeros(1, dtype=slice_metrics_dtype(RECOMMENDER_METRICS))
+
+    write_cache(str(tmp_path / 'study_cache.pkl'), volume, 1, detections, metrics, 0)
+    cached_volume, recc_file_no, cached_detections, cached_metrics, first_slice = read_cache(str(tmp_path / 'study_cache.pkl'))
+
+    np.testing.assert_array_equal(cached_volume.hu, volume.hu)
+    # A memmap volume comes back in memory, it no longer depends on the temporary file
+    assert type(cached_volume.hu) is np.ndarray and cached_volume.memmap_file is None
+    assert cached_volume.file_paths == volume.file_paths
+    assert (recc_file_no, first_slice) == (1, 0)
+    assert cached_detections.is_valid(1) and not cached_detections.is_valid(0)
+    assert cached_metrics.dtype == metrics.dtype
+
+
+@pytest.mark.parametrize('cached', [
+    # The first releases, (images, file names, datasets, recommended slice)
+    (np.zeros((2, 4, 4, 3)), ['IMG-0001-00001.dcm', 'IMG-0001-00002.dcm'], [None, None], 1),
+    # The unversioned tuples of the volume caches
+    ('volume', 1, 'detections', 'metrics', 0),
+    (0, 'volume', 1, 'detections', 'metrics', 0),
+    {'volume': 'volume'},
+])
+def test_other_cache_layouts_are_rejected(tmp_path, cached):
+    with open(tmp_path / 'study_cache.pkl', 'wb') as f:
+        pickle.dump(cached, f)
+
+    with pytest.raises(CacheVersionError):
+        read_cache(str(tmp_path / 'study_cache.pkl'))
+
+
+def test_truncated_cache_is_rejected(tmp_path):
+    write_cache(str(tmp_path / 'study_cache.pkl'), small_volume(), 1, DetectionIndex(3), None, 0)
+    data = (tmp_path / 'study_cache.pkl').read_bytes()
+    (tmp_path / 'study_cache.pkl').write_bytes(data[:len(data) // 2])
+
+    with pytest.raises(CacheVersionError):
+        read_cache(str(tmp_path / 'study_cache.pkl'))
@@ -0,0 +1,75 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from detection_index import DetectionIndex
+from metrics import RECOMMENDER_METRICS, metric_series
+from recommendation import recommend
+from study_cache import write_cache
+from test_recommendation import study_results, valid_results
+from tune_recommender import DEFAULT_PARAMETERS, evaluate, load_studies, report, sweep
+from volume import Volume
+
+
+def test_load_studies_reads_caches_and_results(tmp_path, capsys):
+    cached_series = metric_series(valid_results(study_results(0, first_slice=40)), RECOMMENDER_METRICS)
+    write_cache(str(tmp_path / 'KneeA_cache.pkl'), Volume(1, 4, 4), 100, DetectionIndex(1), cached_series, 40)
+
+    # A cache of the first releases, (images, file names, datasets, recommended slice)
+    with open(tmp_path / 'KneeB_cache.pkl', 'wb') as f:
+        pickle.dump((np.zeros((1, 4, 4, 3)), ['IMG-0001-00001.dcm'], [None], 0), f)
+
+    results = valid_results(study_results(1))
+    with open(tmp_path / 'results.pickle', 'wb') as f:
+        pickle.dump([{'folder_name': 'KneeC', 'results': results}], f)
+
+    studies = load_studies([str(tmp_path / name) for name in ('KneeA_cache.pkl', 'KneeB_cache.pkl', 'results.pickle')])
+
+    assert sorted(studies) == ['KneeA', 'KneeC']
+    assert studies['KneeA'][1] == 40 and studies['KneeC'][1] == 0
+    assert studies['KneeA'][0].tobytes() == cached_series.tobytes()
+    assert studies['KneeC'][0].tobytes() == metric_series(results).tobytes()
+    assert 'KneeB_cache.pkl' in capsys.readouterr().out
+
+
+@pytest.fixture
+def two_studies(tmp_path):
+    # Two synthetic studies in a results pickle, the ground truth is what the current parameters recommend
+    folder_results = [{'folder_name': f'Knee{seed}', 'results': valid_results(study_results(seed))} for seed in (0, 1)]
+    with open(tmp_path / 'results.pickle', 'wb') as f:
+        pickle.dump(folder_results, f)
+
+    truth = {folder_result['folder_name']: recommend(metric_series(folder_result['results']))[0][0]
+             for folder_result in folder_results}
+    return load_studies([str(tmp_path / 'results.pickle')]), truth
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sweep_and_report_rank_the_parameter_sets(two_studies, workers, capsys):
+    studies, truth = two_studies
+    # Knee1 has no plateau with the steep limit and long runs, Knee0 gets a later slice
+    strict = dict(DEFAULT_PARAMETERS, max_slope=100, min_length=8)
+    empty_range = dict(DEFAULT_PARAMETERS, height_low=12000, height_high=11000)
+
+    results = sweep(studies, truth, [strict, empty_range, DEFAULT_PARAMETERS], workers=workers)
+
+    assert [result['parameters'] for result in results] == [strict, DEFAULT_PARAMETERS]
+    assert results[1]['errors'] == {'Knee0': 0, 'Knee1': 0} and results[1]['accuracy'] == 1
+    assert results[0]['errors'] == {'Knee0': 15, 'Knee1': None} and results[0]['accuracy'] == 0
+    assert results[0]['histogram'].tolist() == [0, 0, 0, 0, 0, 1, 1]
+
+    ranked = report(results, top=1)
+
+    assert [result['parameters'] for result in ranked] == [DEFAULT_PARAMETERS, strict]
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1 and lines[0].startswith('100.0% exact')
+
+
+def test_no_study_with_a_ground_truth_slice(two_studies):
+    studies, _ = two_studies
+
+    with pytest.raises(ValueError, match='ground truth'):
+        sweep(studies, {'KneeX': 100}, [DEFAULT_PARAMETERS], workers=1)
+    with pytest.raises(ValueError, match='ground truth'):
+        evaluate(DEFAULT_PARAMETERS, {}, {})
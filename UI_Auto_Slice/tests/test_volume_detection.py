@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from detection_index import DetectionIndex
+from dicom_series import write_series
+from find_reccomended_image import volumetric_metrics
+from functions import detect_knee_bounding_boxes_hu
+from metrics import RECOMMENDER_METRICS, metric_series
+from pipeline import process_slices, read_slices
+from series_index import index_folder
+from test_pyramid_detection import AIR_HU, knee_phantom
+from volume import Volume
+from volume_detection import detect_volume
+
+
+def phantom_stack(seeds):
+    return np.stack([knee_phantom(seed) for seed in seeds])
+
+
+@pytest.mark.parametrize('slab_slices', [1, 4, 32])
+def test_volume_matches_the_per_slice_detection(slab_slices):
+    hu_volume = phantom_stack(range(10))
+    # A slice without any bone, and one with a single knee
+    hu_volume[3] = AIR_HU
+    hu_volume[6, :, 256:] = AIR_HU
+
+    detection = detect_volume(hu_volume, slab_slices=slab_slices)
+
+    assert len(detection) == len(hu_volume)
+    for i, hu_image in enumerate(hu_volume):
+        bounding_boxes, _, edge_points = detect_knee_bounding_boxes_hu(hu_image)
+        volume_boxes, _, volume_edge_points = detection.detect(i)
+
+        assert volume_boxes == bounding_boxes
+        np.testing.assert_array_equal(volume_edge_points.points, edge_points.points)
+        np.testing.assert_array_equal(volume_edge_points.box_offsets, edge_points.box_offsets)
+
+    assert detection.bounding_boxes[3] == [] and len(detection.bounding_boxes[6]) == 1
+
+
+@pytest.mark.parametrize('slab_slices', [3, 32])
+def test_bones_keep_their_id_through_the_slices(slab_slices):
+    # The same knees in every slice, split by two slices without bone
+    hu_volume = phantom_stack([0] * 12)
+    hu_volume[6:8] = AIR_HU
+
+    bone_ids = detect_volume(hu_volume, slab_slices=slab_slices).bone_ids
+
+    above, below = bone_ids[0], bone_ids[8]
+    assert len(set(above)) == 2 and len(set(below)) == 2
+    assert all(ids == above for ids in bone_ids[:6])
+    assert all(ids == below for ids in bone_ids[8:])
+    assert bone_ids[6] == bone_ids[7] == []
+    assert not set(above) & set(below)
+
+
+def test_check_stops_between_slabs():
+    checked = []
+
+    def check():
+        checked.append(True)
+        if len(checked) == 2:
+            raise InterruptedError
+
+    with pytest.raises(InterruptedError):
+        detect_volume(phantom_stack(range(6)), slab_slices=2, check=check)
+
+
+def test_volumetric_metrics_match_the_slice_pipeline(tmp_path):
+    hu_slices = list(phantom_stack(range(8)))
+    hu_slices[2] = np.full_like(hu_slices[2], AIR_HU)
+    write_series(str(tmp_path), hu_slices)
+    series_index = index_folder(str(tmp_path))
+    slice_range = range(1, 7)
+
+    items = list(process_slices(series_index, slice_range, metrics=RECOMMENDER_METRICS))
+    expected = metric_series([item['metrics'] for item in items if item['metrics']], RECOMMENDER_METRICS)
+
+    volume = Volume.from_series_index(series_index)
+    for item in read_slices(series_index, slice_range):
+        volume.set_slice(item['slice_index'], item['slice_data'].hu, item['slice_data'].header)
+    detections = DetectionIndex(len(volume))
+
+    series = volumetric_metrics(volume, slice_range, RECOMMENDER_METRICS, detections)
+
+    assert series.dtype == expected.dtype and len(series) == len(expected) == 5
+    assert series.tobytes() == expected.tobytes()
+    assert detections.detected.tolist() == [i in slice_range for i in range(len(volume))]
+    for item in items:
+        assert detections.bounding_boxes[item['slice_index']] == item['bounding_boxes']
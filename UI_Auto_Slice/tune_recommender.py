@@ -0,0 +1,230 @@
+import os
+import sys
+import csv
+import time
+import pickle
+import itertools
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import metric_series
+from recommendation import recommend, GAP_SLICES, INTENSITY_RANGE, HEIGHT_RANGE, MAX_SLOPE, MIN_LENGTH
+from study_cache import CacheVersionError, read_cache
+
+
+# Values tried for each parameter, the ranges of recommend are split into their two ends
+PARAMETER_GRID = {
+    'gap_slices': [60, 80, 100, 120, 150],
+    'intensity_low': [5000, 6000, 7000, 8000],
+    'intensity_high': [12000, 13000, 14000, 15000],
+    'height_low': [8000, 8500, 9000, 9500],
+    'height_high': [11000, 11500, 12000, 12500],
+    'max_slope': [100, 150, 200, 250, 300, 400],
+    'min_length': [3, 4, 5, 6, 8],
+}
+
+# The parameters recommend uses today
+DEFAULT_PARAMETERS = {
+    'gap_slices': GAP_SLICES,
+    'intensity_low': INTENSITY_RANGE[0],
+    'intensity_high': INTENSITY_RANGE[1],
+    'height_low': HEIGHT_RANGE[0],
+    'height_high': HEIGHT_RANGE[1],
+    'max_slope': MAX_SLOPE,
+    'min_length': MIN_LENGTH,
+}
+
+# Errors up to this many slices get their own bin in the histogram, larger ones share the last
+MAX_OFF_BY = 4
+
+# Parameter sets printed, best first
+TOP_RESULTS = 10
+
+
+""" LOADING """
+
+def load_studies(paths):
+    """
+    (metric series, first slice searched) of every study in the given files, by folder name.
+
+    Takes the results pickles analysis_script writes, a list of {'folder_name', 'results'} of whole scans, and
+    the {folder}_cache.pkl files of the viewer, see study_cache. Caches of another version are skipped.
+    """
+    studies = {}
+
+    for path in paths:
+        if path.endswith('_cache.pkl'):
+            try:
+                _, _, _, metrics, first_slice = read_cache(path)
+            except CacheVersionError as e:
+                print(f"Skipping {e}")
+                continue
+
+            studies[os.path.basename(path).removesuffix('_cache.pkl')] = (metrics, first_slice)
+            continue
+
+        with open(path, 'rb') as f:
+            for folder_result in pickle.load(f):
+                studies[folder_result['folder_name']] = (metric_series(folder_result['results']), 0)
+
+    return studies
+
+
+def load_ground_truth(path):
+    # CSV with a folder_name and a slice_index column, the index of the right slice counted from 0
+    with open(path, newline='') as f:
+        return {row['folder_name']: int(row['slice_index']) for row in csv.DictReader(f)}
+
+
+""" PARAMETER SETS """
+
+def grid_parameters(grid=PARAMETER_GRID):
+    # Every combination, in order
+    names = list(grid)
+    for values in itertools.product(*grid.values()):
+        yield dict(zip(names, values))
+
+
+def random_parameters(n, grid=PARAMETER_GRID, seed=0):
+    # n combinations drawn independently from the grid values, repeats are possible but rare
+    rng = np.random.default_rng(seed)
+    for _ in range(n):
+        yield {name: values[rng.integers(len(values))] for name, values in grid.items()}
+
+
+def is_valid(parameters):
+    return (parameters['intensity_low'] < parameters['intensity_high']
+            and parameters['height_low'] < parameters['height_high'])
+
+
+def recommend_arguments(parameters):
+    # Keyword arguments of recommend for a parameter set
+    return {
+        'gap_slices': parameters['gap_slices'],
+        'intensity_range': (parameters['intensity_low'], parameters['intensity_high']),
+        'height_range': (parameters['height_low'], parameters['height_high']),
+        'max_slope': parameters['max_slope'],
+        'min_length': parameters['min_length'],
+        'n_candidates': 1,
+    }
+
+
+""" EVALUATION """
+
+# Studies and ground truth of a worker process, sent once when the pool starts instead of with every task
+_studies = None
+_truth = None
+
+
+def init_worker(studies, truth):
+    global _studies, _truth
+    _studies, _truth = studies, truth
+
+
+def evaluate(parameters, studies=None, truth=None):
+    """
+    How far the recommendation is from the right slice in every study, for one parameter set.
+
+    Returns:
+    dict: The parameters, 'errors' with the signed error of each study in slices or None when nothing was
+    recommended, 'histogram' with the number of studies off by 0 .. MAX_OFF_BY slices, more, and with none,
+    and 'accuracy', the fraction of studies recommended exactly. ValueError when there are no studies.
+    """
+    studies = _studies if studies is None else studies
+    truth = _truth if truth is None else truth
+    if not studies:
+        raise ValueError("No studies to evaluate, none of them has a ground truth slice")
+
+    arguments = recommend_arguments(parameters)
+
+    errors = {}
+    for folder_name, (series, first_slice) in studies.items():
+        candidates = recommend(series, first_slice=first_slice, **arguments)
+        errors[folder_name] = candidates[0][0] - truth[folder_name] if candidates else None
+
+    histogram = np.zeros(MAX_OFF_BY + 3, dtype=int)
+    for error in errors.values():
+        histogram[-1 if error is None else min(abs(error), MAX_OFF_BY + 1)] += 1
+
+    return {'parameters': parameters, 'errors': errors, 'histogram': histogram,
+            'accuracy': histogram[0] / len(errors)}
+
+
+def sweep(studies, truth, parameter_sets, workers=None):
+    """
+    evaluate for every parameter set over a process pool, results in the order of parameter_sets.
+
+    Only studies with a ground truth slice are evaluated, ValueError when there are none. Parameter sets with an
+    empty range are dropped.
+    """
+    studies = {name: series for name, series in studies.items() if name in truth}
+    if not studies:
+        raise ValueError(f"None of the {len(truth)} ground truth studies has metrics")
+
+    parameter_sets = [parameters for parameters in parameter_sets if is_valid(parameters)]
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        return [evaluate(parameters, studies, truth) for parameters in parameter_sets]
+
+    # A parameter set takes about a millisecond per ten studies, so each process is handed many at once
+    chunksize = max(len(parameter_sets) // (workers * 4), 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(studies, truth)) as executor:
+        return list(executor.map(evaluate, parameter_sets, chunksize=chunksize))
+
+
+def mean_abs_error(result):
+    errors = [abs(error) for error in result['errors'].values() if error is not None]
+    return np.mean(errors) if errors else np.inf
+
+
+def format_result(result):
+    histogram = result['histogram']
+    bins = ', '.join(f"{n}: {count}" for n, count in enumerate(histogram[:MAX_OFF_BY + 1]))
+    parameters = ', '.join(f"{name}={value}" for name, value in result['parameters'].items())
+    return (f"{result['accuracy']:.1%} exact | off by {bins}, more: {histogram[-2]}, none: {histogram[-1]} "
+            f"| {parameters}")
+
+
+def report(results, top=TOP_RESULTS):
+    # Best accuracy first, closer recommendations break ties and recommending something beats nothing
+    ranked = sorted(results, key=lambda result: (-result['accuracy'], result['histogram'][-1], mean_abs_error(result)))
+    for result in ranked[:top]:
+        print(format_result(result))
+    return ranked
+
+
+if __name__ == "__main__":
+    # python tune_recommender.py results2.pickle[,Chimp_cache.pkl,...] ground_truth.csv [grid | random N]
+    if len(sys.argv) < 3:
+        print("Usage: python tune_recommender.py <metrics pickles, comma separated> <ground truth csv> [grid | random N]")
+        sys.exit(1)
+
+    studies = load_studies(sys.argv[1].split(','))
+    truth = load_ground_truth(sys.argv[2])
+    missing = sorted(set(truth) - set(studies))
+    if missing:
+        print(f"No metrics for {missing}, they are left out")
+    truth = {name: index for name, index in truth.items() if name in studies}
+    studies = {name: series for name, series in studies.items() if name in truth}
+    if not studies:
+        print("No study has both metrics and a ground truth slice, check the folder names of the CSV")
+        sys.exit(1)
+
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'grid'
+    parameter_sets = list(grid_parameters() if mode == 'grid' else random_parameters(int(sys.argv[4])))
+
+    print("Current parameters:")
+    print(format_result(evaluate(DEFAULT_PARAMETERS, studies, truth)))
+
+    start = time.perf_counter()
+    results = sweep(studies, truth, parameter_sets)
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} parameter sets on {len(truth)} studies in {elapsed:.1f} s, "
+          f"{len(results) / elapsed * 60:.0f} per minute")
+
+    ranked = report(results)
+
+    with open('tuning_results.pickle', 'wb') as f:
+        pickle.dump(ranked, f)
@@ -0,0 +1,180 @@
+import tempfile
+import numpy as np
+
+from functions import detect_knee_bounding_boxes_hu, window_image
+from metrics import ALL_METRICS, calculate_metrics
+from multiframe import read_dataset
+
+
+# Compact per slice record kept alongside the pixel volume instead of the full pydicom dataset
+SLICE_HEADER_DTYPE = np.dtype([
+    ('instance_number', np.int32),
+    ('position', np.float64),
+    ('slope', np.float32),
+    ('intercept', np.float32),
+    ('loaded', np.bool_),
+])
+
+HU_MIN = np.iinfo(np.int16).min
+HU_MAX = np.iinfo(np.int16).max
+
+
+def hu_to_int16(hu_image):
+    # CT values are integral after the rescale, rounding only matters for unusual slopes
+    return np.clip(np.rint(hu_image), HU_MIN, HU_MAX).astype(np.int16)
+
+
+def slice_header(dicom_data):
+    header = np.zeros((), dtype=SLICE_HEADER_DTYPE)
+    # -1 only when the tag is missing or empty, instance 0 is a valid number
+    instance_number = dicom_data.get('InstanceNumber')
+    header['instance_number'] = -1 if instance_number is None or instance_number == '' else int(instance_number)
+    header['position'] = float(dicom_data.ImagePositionPatient[2]) if 'ImagePositionPatient' in dicom_data else np.nan
+    header['slope'] = float(dicom_data.get('RescaleSlope', 1))
+    header['intercept'] = float(dicom_data.get('RescaleIntercept', 0))
+    header['loaded'] = True
+    return header
+
+
+def rescale_to_hu(pixels, slope, intercept):
+    """
+    Hounsfield units of a decoded pixel array, in the narrowest dtype that holds them exactly.
+
+    An integral rescale whose results fit int16 is applied in place, on the pixel array itself or an int16 view
+    of it, so nothing beyond the decode is allocated. Anything else is rescaled into a new float32 array.
+    """
+    low, high = int(pixels.min()), int(pixels.max())
+
+    if float(slope).is_integer() and float(intercept).is_integer():
+        slope, intercept = int(slope), int(intercept)
+        ends = [low * slope, high * slope, low * slope + intercept, high * slope + intercept]
+
+        if HU_MIN <= min(ends) and max(ends) <= HU_MAX:
+            if pixels.dtype == np.int16:
+                hu_image = pixels
+            elif pixels.dtype == np.uint16 and high <= HU_MAX:
+                hu_image = pixels.view(np.int16)
+            else:
+                hu_image = pixels.astype(np.int16)
+
+            if slope != 1:
+                hu_image *= slope
+            if intercept != 0:
+                hu_image += intercept
+            return hu_image
+
+    hu_image = pixels.astype(np.float32)
+    hu_image *= slope
+    hu_image += intercept
+    return hu_image
+
+
+class SliceData:
+    """
+    One slice decoded and rescaled once.
+
+    The Hounsfield units are kept in a single array, int16 whenever the rescale allows, see rescale_to_hu.
+    Detection, windowing and metrics are all handed that array or views of it, never a converted copy.
+    """
+
+    def __init__(self, hu_image, header):
+        self.hu = hu_image
+        self.header = header
+
+    @classmethod
+    def from_dataset(cls, dicom_data):
+        """ Takes over the decoded pixel_array of dicom_data, which is rescaled in place """
+        pixels = dicom_data.pixel_array
+
+        if 'RescaleSlope' in dicom_data and 'RescaleIntercept' in dicom_data:
+            hu_image = rescale_to_hu(pixels, dicom_data.RescaleSlope, dicom_data.RescaleIntercept)
+        else:
+            hu_image = rescale_to_hu(pixels, 1, 0)
+
+        return cls(hu_image, slice_header(dicom_data))
+
+    def detect(self, debug=False):
+        return detect_knee_bounding_boxes_hu(self.hu, debug)
+
+    def display_image(self):
+        return window_image(self.hu)
+
+    def metrics(self, bounding_boxes, metrics=ALL_METRICS):
+        return calculate_metrics(self.hu, bounding_boxes, metrics)
+
+
+def read_slice(dicom_data):
+    """ HU pixels and the compact header of one dataset, see SliceData """
+    slice_data = SliceData.from_dataset(dicom_data)
+    return slice_data.hu, slice_data.header
+
+
+class Volume:
+    """
+    Hounsfield units of a whole series in one preallocated, contiguous (slices, rows, columns) int16 array.
+
+    Parameters:
+    n_slices, rows, columns (int): Shape of the volume.
+    file_paths (list of str): Slice files in scan order, the same order as the first axis.
+    frames (list of int): Frame of each slice in its file, -1 for single frame files.
+    memmap_dir (str | None): Back the pixels with a np.memmap of a temporary file in this directory instead of
+    memory. The file has no name on disk and is removed once the volume is closed or collected.
+    """
+
+    def __init__(self, n_slices, rows, columns, file_paths=None, memmap_dir=None, frames=None):
+        shape = (n_slices, rows, columns)
+
+        if memmap_dir is None:
+            self.memmap_file = None
+            self.hu = np.empty(shape, dtype=np.int16)
+        else:
+            self.memmap_file = tempfile.TemporaryFile(dir=memmap_dir)
+            self.hu = np.memmap(self.memmap_file, dtype=np.int16, mode='w+', shape=shape)
+
+        self.headers = np.zeros(n_slices, dtype=SLICE_HEADER_DTYPE)
+        self.file_paths = list(file_paths) if file_paths is not None else [''] * n_slices
+        self.frames = np.asarray(frames, dtype=int) if frames is not None else np.full(n_slices, -1)
+
+    @classmethod
+    def from_series_index(cls, series_index, memmap_dir=None):
+        rows, columns = series_index.shape
+        return cls(len(series_index), rows, columns, series_index.file_paths, memmap_dir, series_index.frames)
+
+    def close(self):
+        # Removes the backing file of a memmap volume, the pixels are gone afterwards
+        if self.memmap_file is not None:
+            self.hu = None
+            self.memmap_file.close()
+            self.memmap_file = None
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return self.hu.shape[0]
+
+    def __getstate__(self):
+        # A memmap is pickled as a plain array so the cache does not depend on the backing file
+        state = self.__dict__.copy()
+        state['hu'] = np.asarray(self.hu)
+        state['memmap_file'] = None
+        return state
+
+    def set_slice(self, index, hu_image, header):
+        if hu_image.shape != self.hu.shape[1:]:
+            raise ValueError(f"Slice {index} has shape {hu_image.shape}, expected {self.hu.shape[1:]}")
+
+        # A float32 slice is rounded like any other non integral rescale, int16 ones are copied straight in
+        self.hu[index] = hu_image if hu_image.dtype == np.int16 else hu_to_int16(hu_image)
+        self.headers[index] = header
+
+    def load_slice(self, index):
+        # Decode a slice the loader has not filled in yet straight from its file, or its frame of a multi-frame file
+        self.set_slice(index, *read_slice(read_dataset(self.file_paths[index], self.frames[index])))
+
+    def is_loaded(self, index):
+        return bool(self.headers['loaded'][index])
+
+    def hu_image(self, index):
+        # A view, the detection reads int16 directly
+        return self.hu[index]
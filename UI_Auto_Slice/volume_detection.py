@@ -0,0 +1,178 @@
+import cv2
+import numpy as np
+
+from scipy import ndimage
+
+from functions import MIN_BOX_SIZE, EdgePoints, blur_stage, sobel_stage, threshold_stage
+
+
+# Slices thresholded and labelled in one call, bounds the float32 and int32 working arrays
+SLAB_SLICES = 32
+
+# Connectivity within a slice only, so every label is a 2D component like a cv2 contour
+IN_PLANE = np.zeros((3, 3, 3), dtype=bool)
+IN_PLANE[1] = True
+
+IN_PLANE_CROSS = np.zeros((3, 3, 3), dtype=bool)
+IN_PLANE_CROSS[1] = ndimage.generate_binary_structure(2, 1)
+
+# In plane neighbours plus the same pixel in the slices above and below
+VOLUMETRIC = IN_PLANE.copy()
+VOLUMETRIC[0, 1, 1] = VOLUMETRIC[2, 1, 1] = True
+
+
+def stack_slices(slab):
+    # The slices one above the other in a single 2D image, each between copies of its second and second last rows,
+    # so a 3x3 cv2 filter over the stack reads every slice's border exactly like BORDER_REFLECT_101 on the slice alone
+    padded = np.pad(slab, ((0, 0), (1, 1), (0, 0)), mode='reflect')
+    return padded.reshape(-1, slab.shape[2])
+
+
+def unstack_slices(image, n_slices):
+    return image.reshape(n_slices, -1, image.shape[1])[:, 1:-1]
+
+
+def edge_mask(hu_slab):
+    """
+    The Sobel edges of detect_knee_bounding_boxes_hu for a stack of slices, with one call of each stage.
+
+    The stages are the per slice ones, so every slice gets exactly the edges it would get on its own.
+    """
+    n_slices = len(hu_slab)
+
+    blurred = blur_stage({'hu_image': stack_slices(hu_slab)})
+    binary = threshold_stage({'blurred_image': blurred})
+
+    # Reflected again from the thresholded slices, the padding rows of the blur are not part of any slice
+    binary = stack_slices(unstack_slices(binary, n_slices))
+    sobel_edge = sobel_stage({'binary_image': binary})
+
+    return np.ascontiguousarray(unstack_slices(sobel_edge, n_slices))
+
+
+def fill_holes(edges):
+    # Background not connected to the slice border is enclosed by an external contour, like cv2's RETR_EXTERNAL
+    background, n_background = ndimage.label(~edges, structure=IN_PLANE_CROSS)
+
+    border = np.zeros(edges.shape[1:], dtype=bool)
+    border[[0, -1], :] = border[:, [0, -1]] = True
+
+    # Lookup per background label, label 0 is the edges themselves
+    inside = np.ones(n_background + 1, dtype=bool)
+    inside[background[:, border]] = False
+    inside[0] = True
+    return inside[background]
+
+
+class BoneUnion:
+    # Union-find over the volumetric labels of all slabs
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, label):
+        root = label
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+
+        while label != root:
+            self.parent[label], label = root, self.parent.get(label, label)
+
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+class VolumeDetection:
+    """
+    Knee bounding boxes of every slice of a volume, from one labelling of the thresholded volume.
+
+    bounding_boxes (list): Per slice, the (x, y, w, h) boxes detect_knee_bounding_boxes_hu finds, sorted by x.
+    bone_ids (list): Per slice, the 3D bone component each box belongs to, the same bone keeps its id from slice to slice.
+    edge_points (list): Per slice, the EdgePoints of the same detection.
+    """
+
+    def __init__(self, bounding_boxes, bone_ids, edge_points):
+        self.bounding_boxes = bounding_boxes
+        self.bone_ids = bone_ids
+        self.edge_points = edge_points
+
+    def __len__(self):
+        return len(self.bounding_boxes)
+
+    def detect(self, index):
+        """ Same return value as detect_knee_bounding_boxes_hu for one slice """
+        return self.bounding_boxes[index], None, self.edge_points[index]
+
+
+def detect_volume(hu_volume, slab_slices=SLAB_SLICES, check=None):
+    """
+    Detect the knee bounding boxes of a whole volume without a per slice detection call.
+
+    The volume is blurred, thresholded and edge filtered slab by slab. Filling the holes of the edge mask leaves
+    the regions cv2's external contours enclose, labelling them in plane gives the per slice boxes in one call and
+    labelling them through the slices ties each box to a bone, stitched across slabs. Only the contour points are
+    still traced per slice, by cv2 on the slab's edges.
+
+    Parameters:
+    hu_volume (np.ndarray): (slices, rows, columns) Hounsfield units, e.g. Volume.hu or a range of its slices.
+    slab_slices (int): Slices processed together.
+    check (callable | None): Called before each slab, may raise to stop, e.g. on cancel.
+
+    Returns:
+    VolumeDetection: The boxes of every slice.
+    """
+    n_slices = hu_volume.shape[0]
+
+    bounding_boxes = [[] for _ in range(n_slices)]
+    box_bones = [[] for _ in range(n_slices)]
+    edge_points = [None] * n_slices
+
+    bones = BoneUnion()
+    next_bone = 1
+    previous_last = None
+
+    for start in range(0, n_slices, slab_slices):
+        if check is not None:
+            check()
+
+        stop = min(start + slab_slices, n_slices)
+        sobel_edge = edge_mask(hu_volume[start:stop])
+        filled = fill_holes(sobel_edge != 0)
+
+        regions, _ = ndimage.label(filled, structure=IN_PLANE)
+        volumes, n_volumes = ndimage.label(filled, structure=VOLUMETRIC)
+
+        # Bone labels unique over the whole volume, joined with the bones touching them in the previous slab
+        volumes[volumes > 0] += next_bone - 1
+        if previous_last is not None:
+            touching = (previous_last > 0) & (volumes[0] > 0)
+            for a, b in set(zip(previous_last[touching].tolist(), volumes[0][touching].tolist())):
+                bones.union(a, b)
+
+        next_bone += n_volumes
+        previous_last = volumes[-1]
+
+        for region, (z, y, x) in enumerate(ndimage.find_objects(regions), start=1):
+            w, h = x.stop - x.start, y.stop - y.start
+
+            if w > MIN_BOX_SIZE and h > MIN_BOX_SIZE:
+                # Every pixel of a region has the same bone label, any one of them will do
+                pixel = np.argmax(regions[z, y, x] == region)
+
+                bounding_boxes[start + z.start].append((x.start, y.start, w, h))
+                box_bones[start + z.start].append(int(volumes[z, y, x].flat[pixel]))
+
+        for z in range(stop - start):
+            i = start + z
+            order = sorted(range(len(bounding_boxes[i])), key=lambda b: bounding_boxes[i][b][0])
+            bounding_boxes[i] = [bounding_boxes[i][b] for b in order]
+            box_bones[i] = [box_bones[i][b] for b in order]
+
+            contours, _ = cv2.findContours(sobel_edge[z], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            edge_points[i] = EdgePoints(contours, bounding_boxes[i])
+
+    bone_ids = [[bones.find(bone) for bone in box_bones[i]] for i in range(n_slices)]
+    return VolumeDetection(bounding_boxes, bone_ids, edge_points)